@@ -0,0 +1,261 @@
+import io
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from contextlib import closing
+
+from flask import current_app
+from PIL import Image, UnidentifiedImageError
+
+from backends import get_backend
+
+
+BANDS = 8                       # A 64 bit hash split into 8 bytes. Two hashes within 7 bits of each other share at least one
+MAX_DISTANCE = BANDS - 1
+
+
+def imagehash(image_data):
+
+    """
+    64 bit difference hash (dHash) of an image, or None if it can't be read.
+
+    The image is shrunk to 9x8 grey pixels and each bit says whether a pixel is brighter than the one to its right, so
+    re-saved, resized or lightly edited copies of a photo hash the same or a few bits apart
+    """
+
+    try:
+        image = Image.open(io.BytesIO(image_data)).convert('L').resize((9, 8), Image.LANCZOS)
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+    pixels = list(image.getdata())
+    value = 0
+
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+
+    return value
+
+
+def bands(value):
+    return [(value >> (8 * band)) & 0xff for band in range(BANDS)]
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def promptkey(prompt):
+    return hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:16]
+
+
+def nearest(value, candidates, maxdistance):
+
+    """The candidate hash closest to value, if it's within maxdistance bits"""
+
+    best = min(candidates, key = lambda candidate: hamming(candidate, value), default = None)
+
+    if best is None or hamming(best, value) > maxdistance:
+        return None
+
+    return best
+
+
+class RedisAICache:
+
+    """
+    AI answers kept in Redis, keyed by prompt and image hash, shared by every worker.
+
+    Each hash is also added to one set per band (byte) of the hash, so near matches are found by reading the 8 sets an
+    image's bands fall in rather than every entry. Entries expire after ttl seconds, and past maxentries the least
+    recently used are dropped.
+    """
+
+    def __init__(self, redis, ttl, maxentries, prefix = 'aicache:'):
+        self.redis = redis
+        self.ttl = ttl
+        self.maxentries = maxentries
+        self.prefix = prefix
+
+    def entrykey(self, prompt, value):
+        return f"{self.prefix}{prompt}:{value:016x}"
+
+    def bandkeys(self, prompt, value):
+        return [f"{self.prefix}{prompt}:band{band}:{byte}" for band, byte in enumerate(bands(value))]
+
+    def lookup(self, value, prompt, maxdistance):
+        prompt = promptkey(prompt)
+        entry = self.redis.get(self.entrykey(prompt, value))
+
+        if entry is None and maxdistance > 0:
+            candidates = [int(candidate, 16) for candidate in self.redis.sunion(self.bandkeys(prompt, value))]
+            match = nearest(value, candidates, maxdistance)
+            if match is not None:
+                value = match
+                entry = self.redis.get(self.entrykey(prompt, value))
+
+        pipe = self.redis.pipeline(transaction = False)
+        pipe.hincrby(f"{self.prefix}stats", 'lookups', 1)
+
+        if entry is not None:
+            entry = json.loads(entry)
+            pipe.hincrby(f"{self.prefix}stats", 'hits', 1)
+            pipe.hincrbyfloat(f"{self.prefix}stats", 'saved_seconds', entry['latency'])
+            pipe.zadd(f"{self.prefix}lru", {f"{prompt}:{value:016x}": time.time()})
+
+        pipe.execute()
+
+        return entry['output'] if entry is not None else None
+
+    def store(self, value, prompt, output, latency):
+        prompt = promptkey(prompt)
+
+        pipe = self.redis.pipeline()
+        pipe.set(self.entrykey(prompt, value), json.dumps({'output': output, 'latency': latency}), ex = self.ttl)
+        for bandkey in self.bandkeys(prompt, value):
+            pipe.sadd(bandkey, f"{value:016x}")
+            pipe.expire(bandkey, self.ttl)
+        pipe.zadd(f"{self.prefix}lru", {f"{prompt}:{value:016x}": time.time()})
+        pipe.zcard(f"{self.prefix}lru")
+        entries = pipe.execute()[-1]
+
+        if entries > self.maxentries:
+            self.evict(entries - self.maxentries)
+
+    def evict(self, count):
+        pipe = self.redis.pipeline()
+
+        for member, score in self.redis.zpopmin(f"{self.prefix}lru", count):
+            prompt, value = (member.decode() if isinstance(member, bytes) else member).split(':')
+            value = int(value, 16)
+            pipe.delete(self.entrykey(prompt, value))
+            for bandkey in self.bandkeys(prompt, value):
+                pipe.srem(bandkey, f"{value:016x}")
+
+        pipe.execute()
+
+    def counters(self):
+        return {key.decode() if isinstance(key, bytes) else key: float(value)
+                for key, value in self.redis.hgetall(f"{self.prefix}stats").items()}
+
+
+class SQLiteAICache:
+
+    """
+    AI answers kept in a local SQLite file, for runs without Redis. Same lookups and eviction as the Redis cache, with
+    the bands as indexed columns. Each call opens its own connection, so it's safe from any thread
+    """
+
+    def __init__(self, path, ttl, maxentries):
+        self.path = path
+        self.ttl = ttl
+        self.maxentries = maxentries
+
+        with self.connect() as connection:
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS entries (
+                                       prompt TEXT, hash TEXT, {', '.join(f'b{band} INTEGER' for band in range(BANDS))},
+                                       output TEXT, latency REAL, created REAL, used REAL, PRIMARY KEY (prompt, hash))""")
+            for band in range(BANDS):
+                connection.execute(f"CREATE INDEX IF NOT EXISTS entries_b{band} ON entries (prompt, b{band})")
+            connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL)")
+
+    def connect(self):
+        return closing(sqlite3.connect(self.path, timeout = 10))
+
+    def count(self, connection, name, amount):
+        connection.execute("INSERT INTO stats VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value", (name, amount))
+
+    def lookup(self, value, prompt, maxdistance):
+        prompt = promptkey(prompt)
+        matches = ' OR '.join(f"b{band} = ?" for band in range(BANDS))
+
+        with self.connect() as connection:
+            rows = connection.execute(f"SELECT hash, output, latency FROM entries WHERE prompt = ? AND created > ? AND ({matches})",
+                                      [prompt, time.time() - self.ttl] + bands(value)).fetchall()
+            entries = {int(hashvalue, 16): (output, latency) for hashvalue, output, latency in rows}
+            match = nearest(value, entries, maxdistance)
+
+            with connection:
+                self.count(connection, 'lookups', 1)
+
+                if match is None:
+                    return None
+
+                output, latency = entries[match]
+                self.count(connection, 'hits', 1)
+                self.count(connection, 'saved_seconds', latency)
+                connection.execute("UPDATE entries SET used = ? WHERE prompt = ? AND hash = ?", (time.time(), prompt, f"{match:016x}"))
+
+        return output
+
+    def store(self, value, prompt, output, latency):
+        now = time.time()
+
+        with self.connect() as connection, connection:
+            connection.execute(f"INSERT OR REPLACE INTO entries VALUES (?, ?, {', '.join('?' * BANDS)}, ?, ?, ?, ?)",
+                               [promptkey(prompt), f"{value:016x}"] + bands(value) + [output, latency, now, now])
+            connection.execute("DELETE FROM entries WHERE created <= ?", (now - self.ttl,))
+            connection.execute("""DELETE FROM entries WHERE rowid IN (
+                                      SELECT rowid FROM entries ORDER BY used LIMIT max(0, (SELECT count(*) FROM entries) - ?))""", (self.maxentries,))
+
+    def counters(self):
+        with self.connect() as connection:
+            return dict(connection.execute("SELECT name, value FROM stats").fetchall())
+
+
+def get_ai_cache():
+
+    """Returns the AI answer cache for the current app - in Redis, or a SQLite file at AI_CACHE_PATH without it"""
+
+    ttl = current_app.config.get('AI_CACHE_TTL', 30 * 24 * 3600)
+    maxentries = current_app.config.get('AI_CACHE_MAX_ENTRIES', 10000)
+    path = current_app.config.get('AI_CACHE_PATH', os.path.join(current_app.root_path, 'aicache.sqlite3'))
+
+    return get_backend('aicache', lambda redis: RedisAICache(redis, ttl, maxentries), lambda: SQLiteAICache(path, ttl, maxentries))
+
+
+def cachedanswer(image_data, prompt, ask):
+
+    """
+    Answer to prompt for raw image bytes, from the cache if the same or a near identical image was asked about before.
+
+    Images are matched by perceptual hash, up to AI_CACHE_MAX_DISTANCE bits apart (at most 7, 0 for exact matches only).
+    Otherwise ask() is called and what it returns is cached, along with how long it took for the saved time stats.
+    Images that can't be hashed aren't cached
+    """
+
+    value = imagehash(image_data)
+
+    if value is None:
+        return ask()
+
+    cache = get_ai_cache()
+    maxdistance = min(current_app.config.get('AI_CACHE_MAX_DISTANCE', 4), MAX_DISTANCE)
+
+    output = cache.lookup(value, prompt, maxdistance)
+    if output is not None:
+        return output
+
+    start = time.perf_counter()
+    output = ask()
+    cache.store(value, prompt, output, time.perf_counter() - start)
+
+    return output
+
+
+def aicachestats():
+
+    """Lookups, hits, hit rate and model time saved by the AI answer cache"""
+
+    counters = get_ai_cache().counters()
+    lookups = int(counters.get('lookups', 0))
+    hits = int(counters.get('hits', 0))
+
+    return {'lookups': lookups,
+            'hits': hits,
+            'misses': lookups - hits,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'saved_seconds': round(counters.get('saved_seconds', 0), 3)}
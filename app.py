@@ -7,12 +7,16 @@ from dotenv import load_dotenv
 import redis
 
 from models import connect_db
+from jsonprovider import OrjsonProvider
+import relatedproducts                      # Registers the listeners that keep related products up to date as tags change
+import search                               # Registers the listener that adds the full text search index to new databases
 
 load_dotenv()                               # Load environmental variables
 
 # Creating an application factory
 def create_app(db_uri):                                 # Having the db_uri as an argument allows us to pass in different databases for testing/configuration
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)                      # orjson for every JSON response, much faster than the stdlib encoder
 
     with app.app_context(): # Need this for Flask 3
         connect_db(app, db_uri)
@@ -31,12 +35,69 @@ app.config["SQLALCHEMY_ECHO"] = True
 app.config["SECRET_KEY"] = "seekrat"
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
+# Product images are kept out of the database in a content-addressed image store
+app.config['IMAGE_STORE_BACKEND'] = os.environ.get("IMAGE_STORE_BACKEND", "local")   # local or object
+app.config['IMAGE_STORE_PATH'] = os.environ.get("IMAGE_STORE_PATH", os.path.join(app.root_path, "imagestore"))
+app.config['IMAGE_VARIANT_FORMAT'] = 'WEBP'          # Format for resized image variants, WEBP or JPEG
+app.config['IMAGE_PIPELINE_WORKERS'] = int(os.environ.get("IMAGE_PIPELINE_WORKERS", 2))   # Processes per gunicorn worker for resizing uploads
+
+# Keyset pagination for the /v1 list routes
+app.config['API_PAGE_SIZE_DEFAULT'] = int(os.environ.get("API_PAGE_SIZE_DEFAULT", 50))
+app.config['API_PAGE_SIZE_MAX'] = int(os.environ.get("API_PAGE_SIZE_MAX", 200))
+
+# One Redis connection pool shared by sessions, carts, caches, rate limits and jobs. Without REDIS_URL each of those is
+# kept in the web process instead (see backends.py), which is fine for running locally but not with several workers
+REDIS_URL = os.environ.get("REDIS_URL")
+app.config['REDIS_CLIENT'] = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Catalog API responses are cached in Redis, and dropped when products are uploaded or deleted
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get("RESPONSE_CACHE_TTL", 300))     # Seconds
+
+# Carts are Redis hashes of product id to quantity, kept per user rather than in the session
+app.config['CART_TTL'] = int(os.environ.get("CART_TTL", 30 * 24 * 3600))       # Seconds since the cart last changed
+
+# Password hashing runs on a bounded pool per gunicorn worker, and only BCRYPT_SLOTS hashes run at once across all of them
+# (counted in Redis). Logins past that get a 503
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))     # Stored hashes are upgraded at login when this changes
+app.config['BCRYPT_WORKERS'] = int(os.environ.get("BCRYPT_WORKERS", 2))
+app.config['BCRYPT_QUEUE'] = int(os.environ.get("BCRYPT_QUEUE", 4))          # Extra waiting hashes per process without Redis
+app.config['BCRYPT_SLOTS'] = int(os.environ.get("BCRYPT_SLOTS", 4))          # Size it to about the cores the web servers can spare for bcrypt
+app.config['BCRYPT_SLOT_TTL'] = 30                  # Seconds before a slot a dead worker never gave back is freed
+
+# Mistral calls take a token from a per model bucket in Redis, shared by every worker and script, instead of sleeping
+app.config['MISTRAL_RATE_LIMITS'] = {'default': (1, 1),                 # Requests per second and burst
+                                     'pixtral-12b-2409': (1, 2),
+                                     'mistral-large-latest': (1, 2)}
+app.config['MISTRAL_RATE_LIMIT_WAIT'] = 10          # Seconds a call waits for a token before giving up (the job worker waits as long as it takes)
+
+# AI processing for uploads is queued in Redis and run by the job worker (python3 jobqueue.py), clients poll for the result
+app.config['JOB_TTL'] = int(os.environ.get("JOB_TTL", 3600))                  # Seconds a job and its result are kept
+
+# AI answers are cached by perceptual image hash and prompt, in Redis (or a SQLite file without it), so repeat photos skip Mistral
+app.config['AI_CACHE_TTL'] = int(os.environ.get("AI_CACHE_TTL", 30 * 24 * 3600))     # Seconds
+app.config['AI_CACHE_MAX_ENTRIES'] = int(os.environ.get("AI_CACHE_MAX_ENTRIES", 10000))
+app.config['AI_CACHE_MAX_DISTANCE'] = int(os.environ.get("AI_CACHE_MAX_DISTANCE", 4))     # Bits two image hashes can differ by and still match, 0 to 7
+app.config['AI_CACHE_PATH'] = os.environ.get("AI_CACHE_PATH", os.path.join(app.root_path, "aicache.sqlite3"))
+
+# Facets on /v1/search are counted over at most this many matches
+app.config['SEARCH_FACET_SAMPLE'] = 10000
+app.config['SEARCH_FACETS'] = 20
+
+# List the home page in a random order, kept the same from page to page for each visitor
+app.config['HOMEPAGE_SHUFFLE'] = True
+
+# How many related products are kept for each product
+app.config['RELATED_PRODUCTS_KEPT'] = 20
+
+# /@me responses are cached per user and dropped when the user changes
+app.config['PROFILE_CACHE_TTL'] = int(os.environ.get("PROFILE_CACHE_TTL", 300))     # Seconds
+
 ########### Flask-Session with Redis ###########
 
 # Redis session configuration
 app.config['SESSION_TYPE'] = 'redis' # filesystem, memcached, redis, etc.
 # app.config['SESSION_REDIS'] = redis.from_url("redis://localhost:6379")
-app.config['SESSION_REDIS'] = redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379"))
+app.config['SESSION_REDIS'] = app.config['REDIS_CLIENT']
 app.config['SESSION_COOKIE_PATH'] = '/'
 app.config['SESSION_COOKIE_SECURE'] = True # This fixed race condition issue.
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'
@@ -52,9 +113,26 @@ app.config['SESSION_COOKIE_MAX_AGE'] = 3600    # 1 hour session lifetime
 # Fix for bytes/string issue with Redis sessions
 app.config['SESSION_REDIS_DECODE_RESPONSES'] = True
 
-# Initialize Flask-Session
-from flask_session import Session
-server_session = Session(app)
+# Push a session's Redis TTL back once less than this fraction of its lifetime is left
+app.config['SESSION_REFRESH_THRESHOLD'] = 0.5
+
+# Cookie that holds anonymous visitors' sessions, they only get a Redis session once they log in
+app.config['SESSION_ANONYMOUS_COOKIE_NAME'] = 'anon_session'
+
+# Without Redis, every session stays in Flask's own signed cookie
+if app.config['REDIS_CLIENT'] is not None:
+
+    # Initialize Flask-Session
+    from flask_session import Session
+    server_session = Session(app)
+
+    # Swap in the session interface that keeps anonymous visitors in a signed cookie and logged in users in Redis,
+    # as msgpack that's only written when it changes
+    from sessioninterface import HybridSessionInterface
+    app.session_interface = HybridSessionInterface(app.config['SESSION_REDIS'], app.config['SESSION_KEY_PREFIX'],
+                                                   app.config['SESSION_USE_SIGNER'], app.config['SESSION_PERMANENT'],
+                                                   app.config.get('SESSION_ID_LENGTH', 32), app.config['SESSION_REFRESH_THRESHOLD'],
+                                                   app.config['SESSION_ANONYMOUS_COOKIE_NAME'])
 
 ####################################################################
 
@@ -0,0 +1,20 @@
+from flask import current_app
+
+
+def get_backend(name, redisbackend, localbackend):
+
+    """
+    Returns the app's name extension, made on first use and kept in app.extensions.
+
+    redisbackend(redis) makes it when REDIS_CLIENT is set (app.py sets it from REDIS_URL), shared by every worker.
+    Otherwise localbackend() makes one that only this process sees, for running without Redis and for tests
+    """
+
+    backend = current_app.extensions.get(name)
+
+    if backend is None:
+        redis = current_app.config.get('REDIS_CLIENT')
+        backend = redisbackend(redis) if redis is not None else localbackend()
+        current_app.extensions[name] = backend
+
+    return backend
@@ -0,0 +1,70 @@
+import argparse
+
+from flask import current_app
+from sqlalchemy import select
+
+from models import Product, db
+from imagestore import get_image_store
+from imagepipeline import render_variants, save_variants
+
+
+def backfill_variants(batch_size = 100, after = 0):
+
+    """
+    Renders image variants for products that have an image in the image store but no variants.
+
+    That's products whose images were moved over by migrateimages.py, seeded products, and uploads whose variants
+    failed in the background. Works through them in productid order a batch at a time, and each product's variants are
+    saved and committed as soon as they're made, so it can be stopped and rerun. Images that can't be rendered are
+    logged and skipped. Pass after to skip ahead to a productid.
+
+    Returns the number of products given variants.
+    """
+
+    store = get_image_store()
+    format = current_app.config.get('IMAGE_VARIANT_FORMAT', 'WEBP')
+    backfilled = 0
+
+    while True:
+        batch = db.session.execute(
+            select(Product.productid, Product.image_hash)
+                .where(Product.image_hash.is_not(None))
+                .where(Product.image_variants.is_(None))
+                .where(Product.productid > after)
+                .order_by(Product.productid)
+                .limit(batch_size)
+        ).all()
+        db.session.commit()                         # Don't hold the read open while rendering
+
+        if not batch:
+            break
+
+        for productid, imagehash in batch:
+            image_data = store.get(imagehash)
+
+            try:
+                if image_data is None:
+                    raise ValueError(f"image {imagehash} isn't in the image store")
+                save_variants(productid, render_variants(image_data, format))
+                backfilled += 1
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception("Couldn't make image variants for product %s", productid)
+
+        after = batch[-1][0]
+        print(f"Made image variants for {backfilled} products, last productid was {after}")
+
+    return backfilled
+
+
+if __name__ == '__main__':
+
+    from app import app
+
+    parser = argparse.ArgumentParser(description = "Make resized image variants for products that don't have them")
+    parser.add_argument('--batch-size', type = int, default = 100, help = "Products to look up at a time")
+    parser.add_argument('--after', type = int, default = 0, help = "Only backfill products with a productid greater than this")
+    args = parser.parse_args()
+
+    with app.app_context():
+        backfill_variants(batch_size = args.batch_size, after = args.after)
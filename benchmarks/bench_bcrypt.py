@@ -0,0 +1,59 @@
+"""
+Login throughput against bcrypt cost factor.
+
+For each cost, a number of client threads check a password through the PasswordHasher pool at the same time, like
+concurrent logins on one gunicorn worker. Prints how long one check takes, logins per second, and how many were
+turned away with HashingBusy. Run from the project root:
+
+    $ python3 benchmarks/bench_bcrypt.py 8          # 8 concurrent logins
+"""
+
+import os
+import sys
+import time
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwordhashing import PasswordHasher, HashingBusy
+
+
+def login(hasher, passwordhash, seconds):
+
+    latencies = []
+    busy = 0
+    end = time.perf_counter() + seconds
+
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            hasher.check(passwordhash, 'password')
+            latencies.append(time.perf_counter() - start)
+        except HashingBusy:
+            busy += 1
+            time.sleep(0.01)                        # Like a client honouring a short Retry-After
+
+    return latencies, busy
+
+
+def main(clients, seconds = 3):
+
+    workers = min(4, os.cpu_count() or 1)
+    print(f"{clients} concurrent logins, {workers} bcrypt threads, {seconds}s per cost")
+
+    for rounds in range(8, 15):
+        hasher = PasswordHasher(rounds, workers = workers, queue = workers)
+        passwordhash = hasher.hash('password')
+
+        with ThreadPoolExecutor(max_workers = clients) as pool:
+            results = list(pool.map(lambda x: login(hasher, passwordhash, seconds), range(clients)))
+
+        latencies = [latency for result in results for latency in result[0]]
+        busy = sum(result[1] for result in results)
+
+        print(f"  cost {rounds:>2}  {statistics.median(latencies) * 1000:8.1f} ms/login  {len(latencies) / seconds:8.1f} logins/s  {busy:6} turned away")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8)
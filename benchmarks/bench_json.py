@@ -0,0 +1,64 @@
+"""
+Serialization throughput of Flask's default JSON provider against the orjson provider.
+
+Builds a synthetic catalog the shape of the /v1/productimages response, once with image URLs and once with
+inline base64 images like the API used to send, and times building the JSON response for each. Run from the project root:
+
+    $ python3 benchmarks/bench_json.py 10000
+"""
+
+import os
+import sys
+import base64
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from jsonprovider import OrjsonProvider
+
+
+def catalog(n, inlineimages):
+
+    image = base64.b64encode(os.urandom(6 * 1024)).decode('ascii')         # About the size of an old 200x200 JPEG
+
+    products = []
+    for x in range(n):
+        product = {
+            'productid': x,
+            'productname': f'Product {x}',
+            'productdescription': 'A gently used product which is in good condition',
+            'price': x % 100,
+            'user_id': x % 50,
+        }
+        if inlineimages:
+            product['image'] = image
+        else:
+            product['image_url'] = f'/v1/products/{x}/image/card?v=0123456789abcdef'
+            product['image_variants'] = {name: f'/v1/products/{x}/image/{name}?v=0123456789abcdef' for name in ['detail', 'card', 'thumbnail']}
+        products.append(product)
+
+    return {'Products': products, 'next_cursor': None}
+
+
+def main(n):
+
+    app = Flask(__name__)
+    providers = [('default', DefaultJSONProvider(app)), ('orjson', OrjsonProvider(app))]
+
+    for label, inlineimages in [('image URLs', False), ('inline base64 images', True)]:
+        payload = catalog(n, inlineimages)
+        print(f"{n:,} products with {label}")
+
+        for name, provider in providers:
+            provider.sort_keys = False
+            with app.app_context():
+                best = min(timeit.repeat(lambda: provider.response(payload), number = 1, repeat = 5))
+                size = len(provider.response(payload).get_data())
+            print(f"  {name:<8} {best * 1000:8.1f} ms  {n / best:12,.0f} products/s  {size / best / 2**20:8.1f} MiB/s")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,57 @@
+"""
+Micro-benchmark for the serialization hot path.
+
+Compares the old per-row inspect() serializer with the cached serializer plans and the row tuple fast path.
+Run from the project root:
+
+    $ python3 benchmarks/bench_serialize.py 10000
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import inspect
+
+from models import Product
+from serializers import serialize, serializerow
+
+FIELDS = ('productid', 'productname', 'productdescription', 'price', 'user_id')
+
+
+def inspectserialize(object, params):
+
+    """The serializer the routes used before serializers.py, walking every mapper attribute for every row"""
+
+    mapper = inspect(object)
+    output = {}
+
+    for column in mapper.attrs:
+        if column.key in params:
+            output[column.key] = getattr(object, column.key)
+
+    return output
+
+
+def main(n):
+
+    products = [Product(productid = x, productname = f'Product {x}', productdescription = 'A product description',
+                        price = x % 100, user_id = x % 50) for x in range(n)]
+    rows = [(x, f'Product {x}', 'A product description', x % 100, x % 50) for x in range(n)]
+    params = list(FIELDS)
+
+    cases = [
+        ('inspect() per row', lambda: [inspectserialize(product, params) for product in products]),
+        ('cached serializer', lambda: [serialize(product, FIELDS) for product in products]),
+        ('row tuples', lambda: [serializerow(row, FIELDS) for row in rows]),
+    ]
+
+    for name, case in cases:
+        best = min(timeit.repeat(case, number = 1, repeat = 5))
+        print(f"{name:<20} {best * 1000:8.2f} ms  {n / best:12,.0f} rows/s")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
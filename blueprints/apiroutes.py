@@ -1,22 +1,37 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request, Response, current_app, stream_with_context
 from flask_cors import cross_origin
 from models import User, Product
-from sqlalchemy import inspect
+from imagestore import get_image_store, imagemimetype
+from imagepipeline import VARIANTS
+from pagination import PaginationError, keysetpage
+from serializers import PRODUCT_FIELDS, serialize, columns, serializerow, serializeproductimages
+from responsecache import cachedresponse, cachestats
+from aicache import aicachestats
+from search import SearchError, searchparams, searchquery, tagfacets
 
 
 apiroutes = Blueprint("apiroutes", __name__)
 
+STREAM_FORMATS = ['ndjson', 'stream']              # Values of ?format= that stream a route's response
+
+USER_FIELDS = ('id', 'username', 'firstname', 'lastname')
+
+# List routes are paged with ?limit= and an opaque ?cursor= taken from the previous page's next_cursor
+
+@apiroutes.errorhandler(PaginationError)
+@apiroutes.errorhandler(SearchError)
+def paginationerror(e):
+    return jsonify({"error": str(e)}), 400
+
 @apiroutes.route('/users')
 def getusers():
 
-    # get all users
-    sqlausers = User.query.all()
-
-    params = ['id', 'username', 'firstname', 'lastname']
+    # get a page of users, as plain rows since we only need their columns
+    userrows, next_cursor = keysetpage(User.query.with_entities(*columns(User, USER_FIELDS)), User.id)
 
-    users = [serialize(sqlauser, params) for sqlauser in sqlausers]
+    users = [serializerow(userrow, USER_FIELDS) for userrow in userrows]
 
-    return jsonify(Users=users)
+    return jsonify(Users=users, next_cursor=next_cursor)
 
 @apiroutes.route('/users/<userid>')
 def getsingleuser(userid):
@@ -25,8 +40,7 @@ def getsingleuser(userid):
     if not user:
         return jsonify({"error": "User not found"}), 404
     
-    params = ['id', 'username', 'firstname', 'lastname']
-    user = serialize(user, params)
+    user = serialize(user, USER_FIELDS)
 
     return jsonify(User=user)
 
@@ -37,39 +51,46 @@ def getsingleuserproducts(userid):
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    userproducts = []
+    # Get a page of the user's products to list on page
+    userproducts, next_cursor = keysetpage(Product.query.filter_by(user_id=user.id), Product.productid)
+    products = [serializeproductimages(product) for product in userproducts]
 
-    for product in user.products: # Get all user products to list on page
-        product.image = product.decode_image()
-        userproducts.append(product)
+    user = serialize(user, USER_FIELDS)
 
-    params = ['id', 'username', 'firstname', 'lastname']
-    user = serialize(user, params)
-
-    products = [serialize(product, ['productid', 'productname', 'productdescription', 'price', 'user_id', 'image']) for product in userproducts]
     user['products'] = products
 
-    return jsonify(User=user)
+    return jsonify(User=user, next_cursor=next_cursor)
 
 @apiroutes.route('/products')
+@cachedresponse('products')
 def getproducts():
 
-    sqlaproducts = Product.query.all()
-    params = ['productid', 'productname', 'productdescription', 'price', 'user_id']
-    products = [serialize(product, params) for product in sqlaproducts]
+    """
+    Route to get a page of products. Passing ?format=ndjson or ?format=stream streams every product instead of paging
+    """
+
+    productrows = Product.query.with_entities(*columns(Product, PRODUCT_FIELDS))     # Plain rows, no ORM objects needed
+
+    streamformat = request.args.get('format')
+    if streamformat in STREAM_FORMATS:
+        products = (serializerow(productrow, PRODUCT_FIELDS) for productrow in streamproducts(productrows))
+        return streamresponse('Products', products, streamformat)
+
+    productrows, next_cursor = keysetpage(productrows, Product.productid)
+    products = [serializerow(productrow, PRODUCT_FIELDS) for productrow in productrows]
 
-    return jsonify(Products=products)
+    return jsonify(Products=products, next_cursor=next_cursor)
 
-@apiroutes.route('/products/<productid>')
+@apiroutes.route('/products/<int:productid>')
 @cross_origin(supports_credentials=True)
+@cachedresponse('product:{productid}')
 def getsingleproduct(productid):
 
     product = Product.query.get(productid)
     if not product:
         return jsonify({"error": "Product not found"}), 404
     
-    params = ['productid', 'productname', 'productdescription', 'price', 'user_id']
-    product = serialize(product, params)
+    product = serialize(product, PRODUCT_FIELDS)
 
     return jsonify(Product=product)
 
@@ -78,64 +99,185 @@ def getsingleproduct(productid):
 def getproductsimages():
 
     """
-    Route to get all products with their images decoded
+    Route to get a page of products with the URLs of their images. Passing ?format=ndjson or ?format=stream streams every product instead
     """
 
-    sqlaproducts = Product.query.all()
-    for product in sqlaproducts:
-        product.image = product.decode_image()
-    params = ['productid', 'productname', 'productdescription', 'price', 'user_id', 'image']
-    products = [serialize(product, params) for product in sqlaproducts]
+    streamformat = request.args.get('format')
+    if streamformat in STREAM_FORMATS:
+        products = (serializeproductimages(product) for product in streamproducts(Product.query))
+        return streamresponse('Products', products, streamformat)
 
-    return jsonify(Products=products)
+    sqlaproducts, next_cursor = keysetpage(Product.query, Product.productid)
+    products = [serializeproductimages(product) for product in sqlaproducts]
 
-@apiroutes.route('/productsimages/<productid>')
+    return jsonify(Products=products, next_cursor=next_cursor)
+
+@apiroutes.route('/search')
 @cross_origin(supports_credentials=True)
+def searchproducts():
+
+    """
+    Route to search products by words in their name or description (?q=) and by tags (?tags=shoes,red).
+
+    ?match=all (the default) only returns products with every tag, ?match=any returns products with any of them.
+    Results are paged like the other list routes. The first page also has facets, how many matching products have each tag.
+    """
+
+    text, tagnames, matchall = searchparams(request.args)
+    query = searchquery(text, tagnames, matchall)
+
+    sqlaproducts, next_cursor = keysetpage(query, Product.productid)
+    products = [serializeproductimages(product) for product in sqlaproducts]
+
+    if request.args.get('cursor'):
+        return jsonify(Products=products, next_cursor=next_cursor)
+
+    return jsonify(Products=products, facets=tagfacets(query), next_cursor=next_cursor)
+
+@apiroutes.route('/productsimages/<int:productid>')
+@cross_origin(supports_credentials=True)
+@cachedresponse('product:{productid}')
 def getsingleproductimages(productid):
 
     """
-    Route to get a single product with its image decoded
+    Route to get a single product with the URL of its image
     """
 
     product = Product.query.get(productid)
     if not product:
         return jsonify({"error": "Product not found"}), 404
     
-    username = product.user.username
-    product.username = username
-    product.image = product.decode_image()
-    params = ['productid', 'productname', 'productdescription', 'price', 'image', 'user_id', 'user.username']
-
-    mapper = inspect(product)
-    output = {}
-
-    for column in mapper.attrs:
-        if column.key in params:
-            output[column.key] = getattr(product, column.key)
-    
-    output['username'] = username
+    output = serialize(product, PRODUCT_FIELDS + ('user.username',))
+    output['image_url'] = product.variant_url('detail')
+    output['image_variants'] = product.variant_urls()
     product = output
 
     return jsonify(Product=product)
 
+@apiroutes.route('/products/<int:productid>/image')
+@cross_origin(supports_credentials=True)
+def getproductimage(productid):
 
-def serialize(object, params): # Helper function for serializing different SQLA objects
+    """
+    Route that serves a product's original image as raw bytes.
 
+    The ETag is the image's content hash, so a client holding the same image gets a 304 with no body.
+    Image URLs are versioned by content hash which lets browsers and CDNs cache them as immutable.
     """
-    Serializer helper function. All it needs is the object and its respective params to serialize.
 
-    Takes the object to be serialized as well as the params to serialize it with
+    product = Product.withimage().get(productid)
+    if not product or not product.has_image():
+        return jsonify({"error": "Image not found"}), 404
+
+    if product.image_hash:
+        return imageresponse(product.image_hash, product.image_mimetype or 'image/jpeg')
+
+    # Legacy rows still have their image in the products table
+    etag = product.image_etag()
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status = 304)
+    else:
+        image_data = product.get_image()
+        resp = Response(image_data, mimetype = imagemimetype(image_data) or 'image/jpeg')
+
+    return cacheforever(resp, etag)
+
+@apiroutes.route('/products/<int:productid>/image/<variant>')
+@cross_origin(supports_credentials=True)
+def getproductimagevariant(productid, variant):
+
     """
+    Route that serves one of a product's resized image variants (thumbnail, card or detail) as raw bytes.
 
-    # TODO: Refactor to allow SQLA relationships
+    Falls back to the original image if the variant hasn't been generated yet.
+    """
+
+    if variant not in VARIANTS:
+        return jsonify({"error": "Unknown image variant"}), 404
+
+    product = Product.query.get(productid)
+    if not product or not product.has_image():
+        return jsonify({"error": "Image not found"}), 404
+
+    image_variant = product.variant(variant)
+    if image_variant is None:
+        return getproductimage(productid)
+
+    return imageresponse(image_variant['hash'], image_variant['mimetype'])
+
+
+@apiroutes.route('/cachestats')
+def getcachestats():
+
+    """
+    Route with the response cache's hit and miss counts for each cached route
+    """
+
+    return jsonify(CacheStats=cachestats(), AICache=aicachestats())
+
+
+def imageresponse(imagehash, mimetype):
+
+    """
+    Builds a response for an image in the image store, streaming its bytes or answering If-None-Match with a 304.
+    The image is opened first, so one missing from the store is a 404 rather than a broken body cached for a year
+    """
+
+    if request.if_none_match.contains(imagehash):
+        resp = Response(status = 304)
+    else:
+        opened = get_image_store().stream(imagehash)
+        if opened is None:
+            return jsonify({"error": "Image not found"}), 404
+
+        chunks, size = opened
+        resp = Response(chunks, mimetype = mimetype)
+        resp.content_length = size
+
+    return cacheforever(resp, imagehash)
+
+
+def cacheforever(resp, etag):
+
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 31536000       # One year, the versioned URL changes if the image does
+    resp.cache_control.immutable = True
+
+    return resp
+
+
+def streamproducts(query):
+
+    """Yields every product (or product row) from query in productid order, fetched in batches from a server-side cursor rather than all at once"""
+
+    return query.order_by(Product.productid).yield_per(current_app.config.get('API_STREAM_BATCH_SIZE', 500))
+
+
+def streamresponse(key, items, streamformat):
+
+    """
+    Streams serialized items as they're produced so memory stays flat no matter how many there are.
+
+    ndjson writes one JSON object per line. stream writes the same {key: [...]} document the regular routes return, in chunks.
+    """
 
-    mapper = inspect(object)
-    output = {}
+    dumps = current_app.json.dumps
 
-    for column in mapper.attrs:
-        if column.key in params:
-            output[column.key] = getattr(object, column.key)
+    if streamformat == 'ndjson':
+        def generate():
+            for item in items:
+                yield dumps(item) + '\n'
 
-    return output
+        return Response(stream_with_context(generate()), mimetype = 'application/x-ndjson')
 
+    def generate():
+        yield '{' + dumps(key) + ':['
+        separator = ''
+        for item in items:
+            yield separator + dumps(item)
+            separator = ','
+        yield ']}'
 
+    return Response(stream_with_context(generate()), mimetype = 'application/json')
@@ -1,19 +1,23 @@
 from flask import Blueprint, session, jsonify, make_response
+from sqlalchemy.orm import load_only
 from models import Product
+from cartstore import get_cart_store
 from flask_cors import cross_origin
 
 cartroutes = Blueprint("cartroutes", __name__)
 
-############################################################## Cart Routes #####################################################################
+# Columns the cart needs to show a product and link its thumbnail
+CART_COLUMNS = (Product.productid, Product.productname, Product.productdescription, Product.price,
+                Product.image_hash, Product.image_variants, Product.has_legacy_image)
 
-# TODO: Add quantities to cart
+############################################################## Cart Routes #####################################################################
 
 @cartroutes.route('/cart')
 @cross_origin(supports_credentials=True)
 def cart():
 
     """
-    Route that returns the products in the cart session object.
+    Route that returns the products in the user's cart with their quantities.
     """
 
     userid = session.get('userid', None)
@@ -24,39 +28,19 @@ def cart():
         return jsonify({'status': 'error', 'message': 'Please log in to view your cart'}), 401
 
 
-    # Retrieve all product ids that are in the cart session object, if any.
-    try:
-        productids = session['cart']
-    except:
-        productids = []
-
-    products = []
-    subtotal = 0
-
-    # Get all product objects and derive other features
-    for productid in productids:
-        product = Product.query.get(productid)
-
-        if product is None:                 # Check to see if a productid doesn't exist for whatever reason - it shouldn't be in the cart session
-            productids = session['cart']
-            productids.remove(productid)
-            session['cart'] = productids
-            continue                        # Go on to the next product
-
-        products.append(product)
-        subtotal += product.price
-        session['cart_subtotal'] = subtotal
+    cartproducts, subtotal = loadcart(userid)
 
     productoutput = {}
 
-    # Serializing the product to send as JSON
-    for product in products:
+    # Serializing the products to send as JSON, in the order they were added
+    for product, quantity in cartproducts:
         productoutput[product.productid] = {
             'productid': product.productid,
             'productname': product.productname,
             'productdescription': product.productdescription,
             'price': product.price,
-            'image': product.decode_image()
+            'quantity': quantity,
+            'image_url': product.variant_url('thumbnail')
         }
 
     productoutput['cart_subtotal'] = subtotal
@@ -80,12 +64,7 @@ def addtocart(productid):
         if not product:
             return jsonify({'status': 'error', 'message': 'Product not found'}), 404
         
-        try:                                # Because we will have nothing in the cart initially, we'll just initialize it in the except block
-            products = session['cart']
-            products.append(productid)
-            session['cart'] = products
-        except:
-            session['cart'] = [productid]
+        get_cart_store().add(userid, productid)
 
         return jsonify({'status': 'success', 'message': 'Added to Cart!'}), 200
 
@@ -99,32 +78,61 @@ def addtocart(productid):
 def removefromcart(productid):
 
     """
-    Route that removes product from session cart object."""
-
-    try:                                    # If theres nothing to remove from the cart, then we don't need to do anything
-        products = session['cart']
-        products.remove(productid)
-        session['cart'] = products
-        return jsonify({'status': 'success', 'message': 'Removed from Cart!'}), 200
-    except:
+    Route that takes one of a product out of the user's cart.
+    """
+
+    userid = session.get('userid', None)
+
+    # If theres nothing to remove from the cart, then we don't need to do anything
+    if not userid or get_cart_store().remove(userid, productid) is None:
         return jsonify ({'status': 'error', 'message': 'Not in Cart'}), 401
 
+    return jsonify({'status': 'success', 'message': 'Removed from Cart!'}), 200
+
 @cartroutes.route('/cart/clearall', methods = ['POST'])
 @cross_origin(supports_credentials=True)
 def clearallfromcart():
 
     """
-    Route that removes all products from cart session. Called after a checkout is complete.
+    Route that removes all products from the user's cart. Called after a checkout is complete.
     """
 
-    session.pop('cart', None)
+    userid = session.get('userid', None)
+    if userid:
+        get_cart_store().clear(userid)
 
     # Make sure we're properly clearing the cart session
     resp = make_response(jsonify("Cart Session Cleared"))
     resp.delete_cookie('cart')
 
-    print("From /cart/clearall route, cart session cleared", session.get('cart', None))
+    print("From /cart/clearall route, cart cleared for userid", userid)
 
     return resp
 
+
+def loadcart(userid):
+
+    """
+    Loads the products in a user's cart in one query, with just the columns the cart shows.
+
+    Products that no longer exist are dropped from the cart. Returns a list of (product, quantity) in the order they were added, and the subtotal
+    """
+
+    items = get_cart_store().items(userid)
+
+    products = {}
+    if items:
+        query = Product.query.options(load_only(*CART_COLUMNS)).filter(Product.productid.in_([productid for productid, _ in items]))
+        products = {product.productid: product for product in query}
+
+    # Check to see if any productids don't exist for whatever reason - they shouldn't be in the cart
+    staleids = [productid for productid, _ in items if productid not in products]
+    if staleids:
+        get_cart_store().discard(userid, staleids)
+
+    cartproducts = [(products[productid], quantity) for productid, quantity in items if productid in products]
+    subtotal = sum(product.price * quantity for product, quantity in cartproducts)
+
+    return cartproducts, subtotal
+
 ################################################################################################################################################
@@ -2,6 +2,7 @@ import json
 
 from flask import Blueprint, session, jsonify
 from stripe_payment import create_payment_intent
+from blueprints.cart import loadcart
 from flask_cors import cross_origin
 
 productcheckout = Blueprint("checkout", __name__)
@@ -13,7 +14,10 @@ def stripe_key():
     """
     Route that returns the Stripe API key to the frontend.
     """
-    payment_data = {"amount" : session.get('cart_subtotal', 1)}
+    userid = session.get('userid', None)
+    subtotal = loadcart(userid)[1] if userid else 0                 # Priced from the cart itself, not a total saved by an earlier request
+
+    payment_data = {"amount" : subtotal or 1}
 
     amount = int(payment_data['amount'])
     intent = create_payment_intent(amount)                          # Intent returns a response object
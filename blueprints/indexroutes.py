@@ -1,38 +1,82 @@
-from flask import Blueprint, session, render_template, request
-from models import Product
+from flask import Blueprint, current_app, render_template, request, url_for
+from sqlalchemy import func
+
+from models import Product, db
+from sampling import newseed, shuffledpage
 
 indexroutes = Blueprint("indexroutes", __name__)
 
 
+HOMEPAGE_SIZE = 20
+
 @indexroutes.route('/')
 def home_page():
 
-    offset = request.args.get('page', None)                      # We'll set the offset based on whether user selects 'next' or 'previous'
-    pagination = session.get('page', 0)
-
-    # Offset will either be "next" or "previous", we'll then increase pagination and use that in our SQLA query
-    if not offset:                                           
-        session['page'] = 0
-        pagination = 0
-    elif offset == 'next':
-        pagination = session.get('page', 0)
-        pagination += 1
-        session['page'] = pagination
+    """
+    Home page listing products 20 at a time.
+
+    Paging is carried in the URL rather than the session - ?after=<productid> for the next page and ?before=<productid>
+    for the previous one - so browsing never writes a session, and each page is an index range scan on productid instead of an OFFSET.
+
+    With HOMEPAGE_SHUFFLE on, products come in a random order instead. The URL also carries the shuffle's seed and span,
+    so each visitor keeps the same order from page to page, and after and before are positions in that order.
+    """
+
+    after = request.args.get('after', None, type = int)
+    before = request.args.get('before', None, type = int)
+
+    if current_app.config.get('HOMEPAGE_SHUFFLE', False):
+        return shuffled_home_page(after, before)
+
+    # Get a bunch of products to display on the homepage, plus one to tell if there's another page
+    if before is not None:
+        products = Product.query.filter(Product.productid < before).order_by(Product.productid.desc()).limit(HOMEPAGE_SIZE + 1).all()
+        hasprevious = len(products) > HOMEPAGE_SIZE
+        products = products[:HOMEPAGE_SIZE][::-1]
+        hasnext = True
     else:
-        pagination = session.get('page', 0)
-        pagination -= 1
-        session['page'] = pagination
+        query = Product.query
+        if after is not None:
+            query = query.filter(Product.productid > after)
+        products = query.order_by(Product.productid).limit(HOMEPAGE_SIZE + 1).all()
+        hasnext = len(products) > HOMEPAGE_SIZE
+        products = products[:HOMEPAGE_SIZE]
+        hasprevious = after is not None
+
+    nextpage = previouspage = None
+    if products:
+        if hasnext:
+            nextpage = url_for('indexroutes.home_page', after = products[-1].productid)
+        if hasprevious:
+            previouspage = url_for('indexroutes.home_page', before = products[0].productid)
+    elif after is not None:                                 # Paged past the end, previous goes back to the last page
+        previouspage = url_for('indexroutes.home_page', before = after + 1)
+
+    return render_template('index.html', products = products, nextpage = nextpage, previouspage = previouspage)
+
+def shuffled_home_page(after, before):
+
+    seed = request.args.get('seed', None, type = int)
+    span = request.args.get('span', None, type = int)
+    highest = db.session.query(func.max(Product.productid)).scalar() or 0
 
+    if seed is None or span is None:                        # First visit, start a new shuffle of the products there are now
+        seed = newseed()
+        span = highest
+        after = before = None
 
-    if pagination < 1:  # To prevent negative pages
-        pagination = 0
-        session['page'] = pagination
+    span = max(0, min(span, highest))                       # Spans come from the URL, there's no point shuffling keys no product has
 
-    pagination = pagination* 20
+    found, previousbefore, nextafter = shuffledpage(Product.query, Product.productid, seed, span, HOMEPAGE_SIZE, after = after, before = before)
+    products = [product for position, product in found]
 
-    products = Product.query.offset(pagination).limit(20).all() # Get a bunch of products to display on the homepage. TODO: Randomize order of products listed
+    nextpage = previouspage = None
+    if nextafter is not None:
+        nextpage = url_for('indexroutes.home_page', seed = seed, span = span, after = nextafter)
+    if previousbefore is not None:
+        previouspage = url_for('indexroutes.home_page', seed = seed, span = span, before = previousbefore)
 
-    return render_template('index.html', products = products)
+    return render_template('index.html', products = products, nextpage = nextpage, previouspage = previouspage)
 
 @indexroutes.app_errorhandler(404)                      # Uses .app_errorhandler because regular error handlers only latch onto blueprints and not entire app
 def page_not_found(e):
@@ -1,6 +1,7 @@
 from flask import Blueprint, session, render_template, jsonify
-from models import Product, db
-from sqlalchemy import inspect
+from models import Product, RelatedProduct, db
+from serializers import serializeproductimages
+from responsecache import invalidate
 
 productroutes = Blueprint("productroutes", __name__)
 
@@ -19,23 +20,21 @@ def getproduct(productid):
 @productroutes.route('/product/<int:productid>/related', methods = ['POST'])
 def getrelatedproducts(productid):
     """
-    Get related products based on the product ID.
+    Get related products based on the product ID, from the precomputed related products table.
     """
-    # Check if the product exists first
-    product = Product.query.get(productid)
-    if not product:
-        return jsonify({"error": "Product not found"}), 404
-
     productlimit = 4
 
-    # Get related products
-    related_products = Product.query.filter(Product.tags.any(Product.tags.any(Product.productid != productid))).limit(productlimit).all()
+    # Get related products, best match first
+    related_products = (Product.query.join(RelatedProduct, RelatedProduct.relatedid == Product.productid)
+                                     .filter(RelatedProduct.productid == productid)
+                                     .order_by(RelatedProduct.score.desc(), RelatedProduct.relatedid)
+                                     .limit(productlimit).all())
 
-    for product in related_products:
-        product.image = product.decode_image()
+    # Only products without any related products need the check that the product exists
+    if not related_products and not Product.query.get(productid):
+        return jsonify({"error": "Product not found"}), 404
 
-    params = ['productid', 'productname', 'productdescription', 'price', 'user_id', 'image']
-    serialized_related_products = [serialize(product, params) for product in related_products]
+    serialized_related_products = [serializeproductimages(product) for product in related_products]
 
     # print("Related Products are", serialized_related_products)
 
@@ -51,6 +50,8 @@ def deleteproduct(productid):
     try:
         db.session.delete(product)
         db.session.commit()
+
+        invalidate('products', f'product:{productid}')          # Drop cached API responses that still have it
     except Exception as e:
         db.session.rollback()
         print("Error deleting product:", e)
@@ -59,23 +60,4 @@ def deleteproduct(productid):
     return jsonify({'status': 'success', 'message': 'Product deleted successfully.'}), 200
 
 
-def serialize(object, params): # Helper function for serializing different SQLA objects
-
-    """
-    Serializer helper function. All it needs is the object and its respective params to serialize.
-
-    Takes the object to be serialized as well as the params to serialize it with
-    """
-
-    # TODO: Refactor to allow SQLA relationships
-
-    mapper = inspect(object)
-    output = {}
-
-    for column in mapper.attrs:
-        if column.key in params:
-            output[column.key] = getattr(object, column.key)
-
-    return output
-
 ################################################################################################################################################
\ No newline at end of file
@@ -1,13 +1,13 @@
-import io
-from time import sleep
-
-from flask import Blueprint, session, render_template, redirect, flash, request, jsonify
-from PIL import Image
+from flask import Blueprint, session, render_template, redirect, flash, request, jsonify, url_for, current_app
 from flask_cors import cross_origin
 
 
 from models import User, Product, db
-from mistraldescription import getproductdescription, encodeimage, decodeimage
+from imagestore import imagemimetype
+from imagepipeline import generate_variants
+from responsecache import invalidate
+from mistraldescription import encodeimage, decodeimage
+from jobqueue import get_job_queue
 
 
 uploadroutes = Blueprint("uploadroutes", __name__)
@@ -56,62 +56,113 @@ def pictureupload(userid):
     print("File ext: ", file_ext)
     if file_ext not in ['jpg', 'jpeg', 'png']:
         errors['file'] = 'Invalid File Type'          # If invalid file type, we'll add an error to session and display it after a redirect
-    else:
-        if file_ext == 'jpg':
-            file_ext = 'jpeg'
+
+    # The original is stored as uploaded, resized variants are made off the request by the image pipeline
+    image_data = file.read()
+    mimetype = imagemimetype(image_data)
+    if mimetype is None:
+        errors['productImage'] = 'Invalid image file'
+        return jsonify({"error": errors}), 400
 
     try:                  # Try to commit the product to the database and if not, return errors that might have prevented that
         # Generate new product and attach it to passed userid
         product = Product(productname = productname, productdescription = productdescription, price = productprice, user_id = userid)
 
-        # Resizing and formatting the image into an acceptable format to add to the database
-        image = Image.open(file)
-        newsize = (200,200)
-        image = image.resize(newsize)
-        stream = io.BytesIO()
-        image.save(stream, format = file_ext.replace('.','').upper())
-        file = stream.getvalue()
-
-        # Save the file as base64 encoding to its image filed in DB.
-        product.encode_image(file)
+        # Save the image bytes to the image store, the product row only keeps the content hash
+        product.store_image(image_data, mimetype = mimetype)
 
         db.session.add(product)
         db.session.commit()
 
-        return jsonify({"success": "Product Listed Successfully"}), 200
-
     except Exception as e:         # If anything happens during the commit, we send an error JSON back to client
         print(e)
-        errors['Misc'] = e
+        errors['Misc'] = str(e)
         return jsonify({"error": errors}), 400
 
+    # The product is listed now. Nothing past here should tell the client otherwise, or a retry would list it twice
+    try:
+        invalidate('products')                  # Cached product lists don't have the new product yet
+    except Exception:
+        current_app.logger.exception("Couldn't drop cached product lists after listing product %s", product.productid)
+
+    try:
+        generate_variants(product.productid, image_data)
+    except Exception:                           # Pages fall back to the original image, backfillvariants.py can make them later
+        current_app.logger.exception("Couldn't start image variants for product %s", product.productid)
+
+    return jsonify({"success": "Product Listed Successfully"}), 200
+
 
 @uploadroutes.route('/upload/aiprocess', methods = ['POST'])
 @cross_origin(supports_credentials=True)
 def aiprocess():
 
+    """
+    Queues an AI title and description for an uploaded image and returns the job's ID straight away.
+    The Mistral calls are made by the job worker, poll the status URL for the result.
+    """
+
     if session.get("userid", None) is None:                       # Shouldn't be able to get here from the standard browser.
         print("From /upload/ai route - returned here, userid is: ", session.get("userid", None))
         return jsonify({"error": "Please login to upload products"}), 401
 
     image = request.files['file']
-    title_prompt = "Give me a short title for this picture that is 2-5 words long. This title should describe the picture as a product"
-    description_prompt = "Give me a product description for this picture that is about 6-12 words long."
 
     img_data = encodeimage(image)               # Need both an encoded and decoded image for the HTML and API calls respectively
     img_data_decoded = decodeimage(img_data)
 
-    # Temporarily changed to use the encoded image for the API call
-    title = getproductdescription(img_data_decoded, title_prompt)     # Get both the title and description from Mistral AI
-    sleep(2) # To avoid Mistral API's rate limit
-    description = getproductdescription(img_data_decoded, description_prompt)
+    jobqueue = get_job_queue()
+    jobid = jobqueue.enqueue('aiprocess', {'image_data': img_data_decoded}, session['userid'])
+
+    resp = jsonify(jobview(jobid, jobqueue.status(jobid)))
+    resp.headers['Location'] = url_for('uploadroutes.aiprocessstatus', jobid = jobid)
+
+    return resp, 202
+
+
+def jobview(jobid, job):
+
+    """A job's status for the client, with where to check on it"""
+
+    view = {'job_id': jobid,
+            'status': job['status'],
+            'status_url': url_for('uploadroutes.aiprocessstatus', jobid = jobid)}
 
-    output = {"title" : title,
-              "description" : description}
+    for name in ('result', 'error', 'retry_after'):
+        if name in job:
+            view[name] = job[name]
+
+    return view
+
+
+def ownjob(jobid):
+
+    """The logged in user's job, or None if there's no such job or it's someone else's"""
+
+    job = get_job_queue().status(jobid)
+
+    if job is None or job['owner'] != session.get("userid", None):
+        return None
+
+    return job
+
+
+@uploadroutes.route('/upload/aiprocess/<jobid>')
+@cross_origin(supports_credentials=True)
+def aiprocessstatus(jobid):
+
+    """
+    Route to check on an AI processing job. Once it's done, result has the title and description
+    """
+
+    if session.get("userid", None) is None:
+        return jsonify({"error": "Please login to upload products"}), 401
 
-    print("From /upload/ai route - output is:", output)
+    job = ownjob(jobid)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
 
-    return jsonify(output)
+    return jsonify(jobview(jobid, job))
 
 
 @uploadroutes.route('/upload/<int:userid>/aiconfirm')
@@ -1,6 +1,10 @@
+import hashlib
+
 from flask import Blueprint, session, render_template, redirect, flash, request, jsonify, make_response, current_app
 from flask_cors import cross_origin
 from models import User, db
+from profilecache import get_profile_cache
+from passwordhashing import HashingBusy
 from forms import SignUpForm, ProductUploadForm
 from sqlalchemy.exc import IntegrityError
 
@@ -8,6 +12,15 @@ userroutes = Blueprint("userroutes", __name__)
 
 ############################################################### User Routes ###############################################################
 
+# Signups and logins past what the password hasher can take are turned away quickly so they can be retried
+
+@userroutes.errorhandler(HashingBusy)
+def hashingbusy(e):
+    db.session.rollback()
+    resp = jsonify({"error": "Too many logins right now, please try again"})
+    resp.headers['Retry-After'] = current_app.config.get('BCRYPT_RETRY_AFTER', 1)
+    return resp, 503
+
 @userroutes.route('/user/<int:userid>')
 def profile(userid):
 
@@ -161,13 +174,12 @@ def login():
 @cross_origin(supports_credentials=True)
 def logout():
 
-    # When you log out, remove userid from session and clear cart from session
+    # When you log out, remove userid from session. The cart is kept server side for the next login
 
     session.pop('userid', None)
     session.pop('username', None)
     session.pop('userfirstname', None)
     session.pop('userlastname', None)
-    session.pop('cart', None)
 
     # Trying to remove everything from session after logout
 
@@ -188,6 +200,9 @@ def me():
 
     """
     A route for a React frontend to check if a user is logged in and get their user information.
+
+    The response is cached until the user changes, so polling doesn't hit the database. It carries an ETag
+    so a client sending If-None-Match gets an empty 304 while nothing has changed.
     """
 
     userid = session.get('userid', None)
@@ -196,17 +211,31 @@ def me():
 
     if not userid:
         return jsonify({"user": "null"}), 401
-    
-    # Since we have a userid in session via logging in we dont need to check if the userid exists - that was already done
-    user = User.query.filter_by(id=userid).first()
-    return jsonify({
-        "user": {
-            "id": user.id,
-            "username": user.username,
-            "firstname": user.firstname,
-            "lastname": user.lastname
-        }
-    })
+
+    profilecache = get_profile_cache()
+    body = profilecache.get(userid)
+
+    if body is None:
+        user = User.query.filter_by(id=userid).first()
+        if not user:                                    # Deleted since they logged in
+            return jsonify({"user": "null"}), 401
+
+        body = current_app.json.dumps({
+            "user": {
+                "id": user.id,
+                "username": user.username,
+                "firstname": user.firstname,
+                "lastname": user.lastname
+            }
+        }).encode('utf-8')
+        profilecache.set(userid, body)
+
+    resp = current_app.response_class(body, mimetype = 'application/json')
+    resp.set_etag(hashlib.sha1(body).hexdigest())
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True                  # Browsers may keep it but have to check the ETag every time
+
+    return resp.make_conditional(request)
 
 # TODO: Delete User route - need to test this
 
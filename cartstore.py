@@ -0,0 +1,149 @@
+import time
+import threading
+
+from flask import current_app
+
+from backends import get_backend
+
+
+# Takes one off a product's quantity and drops it from the cart when it reaches zero, in one atomic step
+REMOVE_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+local quantity = redis.call('HINCRBY', KEYS[1], ARGV[1], -tonumber(ARGV[2]))
+if quantity <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    quantity = 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return quantity
+"""
+
+
+class RedisCartStore:
+
+    """
+    Carts kept in Redis, one hash per user of product id to quantity.
+
+    Every change is a single atomic command or script on the user's keys, so concurrent requests from
+    different tabs can't overwrite each other and a change costs the same no matter how big the cart is.
+    A sorted set keeps the order products were first added in. Both expire after ttl seconds without changes.
+    """
+
+    def __init__(self, redis, ttl, prefix = 'cart:'):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self.removescript = redis.register_script(REMOVE_SCRIPT)
+
+    def keys(self, userid):
+        return f"{self.prefix}{userid}", f"{self.prefix}{userid}:order"
+
+    def items(self, userid):
+        cartkey, orderkey = self.keys(userid)
+
+        pipe = self.redis.pipeline(transaction = False)
+        pipe.hgetall(cartkey)
+        pipe.zrange(orderkey, 0, -1)
+        quantities, order = pipe.execute()
+
+        quantities = {int(productid): int(quantity) for productid, quantity in quantities.items()}
+
+        return [(int(productid), quantities[int(productid)]) for productid in order if int(productid) in quantities]
+
+    def add(self, userid, productid, quantity = 1):
+        cartkey, orderkey = self.keys(userid)
+
+        pipe = self.redis.pipeline()                    # MULTI/EXEC so the quantity and order can't disagree
+        pipe.hincrby(cartkey, productid, quantity)
+        pipe.zadd(orderkey, {productid: time.time()}, nx = True)
+        pipe.expire(cartkey, self.ttl)
+        pipe.expire(orderkey, self.ttl)
+
+        return pipe.execute()[0]
+
+    def remove(self, userid, productid, quantity = 1):
+        quantity = self.removescript(keys = self.keys(userid), args = [productid, quantity, self.ttl])
+
+        return None if quantity < 0 else quantity
+
+    def discard(self, userid, productids):
+        cartkey, orderkey = self.keys(userid)
+
+        pipe = self.redis.pipeline()
+        pipe.hdel(cartkey, *productids)
+        pipe.zrem(orderkey, *productids)
+        pipe.execute()
+
+    def clear(self, userid):
+        self.redis.delete(*self.keys(userid))
+
+
+class MemoryCartStore:
+
+    """Carts in this process's memory, for running without Redis. They're lost on restart and each worker has its own"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.carts = {}
+        self.lock = threading.Lock()
+
+    def cart(self, userid, touch = True):
+        cart, expires = self.carts.get(userid, ({}, 0))
+
+        if expires < time.monotonic():
+            cart = {}
+            expires = 0
+
+        if touch:                                       # Changes push the expiry back, like EXPIRE does in Redis
+            expires = time.monotonic() + self.ttl
+
+        self.carts[userid] = (cart, expires)
+
+        return cart
+
+    def items(self, userid):
+        with self.lock:
+            return list(self.cart(userid, touch = False).items())          # Dicts keep the order products were first added in
+
+    def add(self, userid, productid, quantity = 1):
+        with self.lock:
+            cart = self.cart(userid)
+            cart[productid] = cart.get(productid, 0) + quantity
+
+            return cart[productid]
+
+    def remove(self, userid, productid, quantity = 1):
+        with self.lock:
+            cart = self.cart(userid)
+            if productid not in cart:
+                return None
+
+            cart[productid] -= quantity
+            if cart[productid] <= 0:
+                del cart[productid]
+                return 0
+
+            return cart[productid]
+
+    def discard(self, userid, productids):
+        with self.lock:
+            cart = self.cart(userid)
+            for productid in productids:
+                cart.pop(productid, None)
+
+    def clear(self, userid):
+        with self.lock:
+            self.carts.pop(userid, None)
+
+
+def get_cart_store():
+
+    """Returns the cart store for the current app"""
+
+    ttl = current_app.config.get('CART_TTL', 30 * 24 * 3600)
+
+    return get_backend('cartstore', lambda redis: RedisCartStore(redis, ttl), lambda: MemoryCartStore(ttl))
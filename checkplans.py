@@ -0,0 +1,101 @@
+"""
+Query plan check for the main query behind each route.
+
+Runs EXPLAIN on each one against the app's database and flags any that read a whole table. On Postgres sequential
+scans are turned off for the check, so one only shows up when there's no index the query can use at all, however
+many rows the database has been seeded with. Run from the project root against a seeded database:
+
+    $ python3 checkplans.py
+
+Exits with status 1 if any query is flagged.
+"""
+
+import sys
+
+from sqlalchemy import text
+
+from models import Product, ProductTag, RelatedProduct, Tag, User, db
+from search import searchquery
+
+
+def routequeries():
+
+    """(name, query) for the main query behind each route, with made up ids and names that don't need to exist"""
+
+    return [
+        ('/ next page', Product.query.filter(Product.productid > 20).order_by(Product.productid).limit(21)),
+        ('/ shuffled', Product.query.filter(Product.productid.in_([3, 1, 4, 15, 9]))),
+        ('/product/<id>', Product.query.filter(Product.productid == 1)),
+        ('/product/<id> tags', Tag.query.join(ProductTag, ProductTag.tagid == Tag.tagid).filter(ProductTag.productid == 1)),
+        ('/product/<id>/related', Product.query.join(RelatedProduct, RelatedProduct.relatedid == Product.productid)
+                                               .filter(RelatedProduct.productid == 1)
+                                               .order_by(RelatedProduct.score.desc(), RelatedProduct.relatedid).limit(4)),
+        ('/user/<id>', User.query.filter(User.id == 1)),
+        ('/user/<id> products', Product.query.filter(Product.user_id == 1)),
+        ('/login', User.query.filter(User.username == 'johndoe')),
+        ('/cart', Product.query.filter(Product.productid.in_([1, 2, 3]))),
+        ('/v1/users', User.query.filter(User.id > 50).order_by(User.id).limit(51)),
+        ('/v1/users/<id>/products', Product.query.filter(Product.user_id == 1, Product.productid > 50).order_by(Product.productid).limit(51)),
+        ('/v1/products', Product.query.filter(Product.productid > 50).order_by(Product.productid).limit(51)),
+        ('/v1/search text', searchquery('running shoes', [], True).order_by(Product.productid).limit(51)),
+        ('/v1/search tags', searchquery('', ['shoes', 'red'], True).order_by(Product.productid).limit(51)),
+        ('tag products', Product.query.join(ProductTag, ProductTag.productid == Product.productid).filter(ProductTag.tagid == 1)),
+        ('tagging', Tag.query.filter(Tag.tagname.in_(['shoes', 'red']))),
+    ]
+
+
+def fullscans(plan):
+
+    """Names of the tables a Postgres JSON plan reads with a sequential scan"""
+
+    scans = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+
+    for child in plan.get('Plans', []):
+        scans.extend(fullscans(child))
+
+    return scans
+
+
+def explain(connection, query):
+
+    """Names of the tables the query would read in full"""
+
+    compiled = query.statement.compile(dialect = connection.dialect, compile_kwargs = {'render_postcompile': True})
+    params = tuple(compiled.params[name] for name in compiled.positiontup) if compiled.positional else compiled.params
+
+    if connection.dialect.name == 'postgresql':
+        plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), params).scalar()
+        return fullscans(plan[0]['Plan'])
+
+    # SQLite says SCAN <table> for a full scan and SEARCH <table> for an index lookup
+    details = [row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params)]
+    return [detail.split()[1] for detail in details if detail.startswith('SCAN ') and 'VIRTUAL TABLE' not in detail]
+
+
+def checkplans():
+
+    """Explains every route query. Returns {name: tables read in full} for the ones that need an index"""
+
+    flagged = {}
+
+    with db.engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text("SET LOCAL enable_seqscan = off"))      # Only for this transaction, rolled back at the end
+
+        for name, query in routequeries():
+            tables = explain(connection, query)
+            print(f"{'SEQ SCAN' if tables else 'ok':>8}  {name}" + (f"  ({', '.join(tables)})" if tables else ''))
+            if tables:
+                flagged[name] = tables
+
+    return flagged
+
+
+if __name__ == '__main__':
+
+    from app import app
+
+    with app.app_context():
+        flagged = checkplans()
+
+    sys.exit(1 if flagged else 0)
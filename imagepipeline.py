@@ -0,0 +1,155 @@
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps, features
+from flask import current_app
+from sqlalchemy import update
+
+from imagestore import get_image_store
+from models import Product, db
+from responsecache import invalidate
+
+
+# Variant sizes are bounding boxes, images keep their aspect ratio and are never upscaled.
+# Ordered largest to smallest so each variant can be resized from the one before it.
+VARIANTS = {
+    'detail': {'size': (1200, 1200), 'quality': 82},
+    'card': {'size': (400, 400), 'quality': 75},
+    'thumbnail': {'size': (150, 150), 'quality': 65},
+}
+
+VARIANT_FORMATS = {
+    'WEBP': 'image/webp',
+    'JPEG': 'image/jpeg',
+}
+
+_pool = None
+
+
+def render_variants(image_data, format = 'WEBP'):
+
+    """
+    Renders every size in VARIANTS from raw image bytes. Runs in a pool process so it only deals in bytes.
+
+    Returns a dict of variant name to (bytes, mimetype, width, height)
+    """
+
+    if format == 'WEBP' and not features.check('webp'):          # Pillow builds without libwebp fall back to JPEG
+        format = 'JPEG'
+
+    image = Image.open(io.BytesIO(image_data))
+
+    # JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale which skips most of the decode work for big photos
+    largest = VARIANTS['detail']['size']
+    image.draft('RGB', largest)
+
+    image = ImageOps.exif_transpose(image)
+    transparent = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    image = image.convert('RGBA' if format == 'WEBP' and transparent else 'RGB')
+
+    variants = {}
+
+    for name, spec in VARIANTS.items():
+        # reducing_gap lets Pillow use Image.reduce for the integer part of the downscale before resampling
+        image.thumbnail(spec['size'], Image.LANCZOS, reducing_gap = 3.0)
+
+        stream = io.BytesIO()
+        if format == 'WEBP':
+            image.save(stream, format = 'WEBP', quality = spec['quality'], method = 4)
+        else:
+            image.save(stream, format = 'JPEG', quality = spec['quality'], optimize = True, progressive = True)
+
+        variants[name] = (stream.getvalue(), VARIANT_FORMATS[format], image.width, image.height)
+
+    return variants
+
+
+def get_pool():
+
+    """Process pool for image work, created lazily so every gunicorn worker gets its own after forking"""
+
+    global _pool
+
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers = current_app.config.get('IMAGE_PIPELINE_WORKERS', 2),
+                                    mp_context = multiprocessing.get_context('spawn'))
+
+    return _pool
+
+
+def discard_pool(pool):
+
+    """Drops a pool that broke (a child died, say from running out of memory on a huge image) so the next job gets a new one"""
+
+    global _pool
+
+    if _pool is pool:
+        _pool = None
+
+    pool.shutdown(wait = False, cancel_futures = True)
+
+
+def save_variants(productid, variants):
+
+    """Puts rendered variants in the image store and records them on the product. Needs an app context"""
+
+    store = get_image_store()
+    image_variants = {}
+
+    for name, (image_data, mimetype, width, height) in variants.items():
+        image_variants[name] = {
+            'hash': store.put(image_data),
+            'mimetype': mimetype,
+            'width': width,
+            'height': height,
+            'size': len(image_data)
+        }
+
+    db.session.execute(update(Product).where(Product.productid == productid).values(image_variants = image_variants))
+    db.session.commit()
+
+    invalidate(f'product:{productid}')              # Cached product responses still have the fallback image URLs
+
+    return image_variants
+
+
+def generate_variants(productid, image_data):
+
+    """
+    Renders and saves image variants for a product.
+
+    The resizing runs on the process pool and the variants are saved from the pool's callback, so the request
+    that uploaded the image can return straight away. Until the variants land, product pages fall back to the original image.
+    With IMAGE_PIPELINE_SYNC set (for testing) everything runs inline instead.
+    """
+
+    app = current_app._get_current_object()
+    format = app.config.get('IMAGE_VARIANT_FORMAT', 'WEBP')
+
+    if app.config.get('IMAGE_PIPELINE_SYNC', False):
+        return save_variants(productid, render_variants(image_data, format))
+
+    pool = get_pool()
+
+    def on_done(future):
+        try:
+            with app.app_context():
+                save_variants(productid, future.result())
+        except BrokenProcessPool:
+            app.logger.exception("Image pool broke making variants for product %s", productid)
+            discard_pool(pool)
+        except Exception:
+            app.logger.exception("Image variants failed for product %s", productid)
+
+    try:
+        future = pool.submit(render_variants, image_data, format)
+    except BrokenProcessPool:                       # Broke since the last upload, try once more on a new pool
+        discard_pool(pool)
+        pool = get_pool()
+        future = pool.submit(render_variants, image_data, format)
+
+    future.add_done_callback(on_done)
+
+    return future
@@ -0,0 +1,258 @@
+import os
+import base64
+import binascii
+import hashlib
+import threading
+
+from flask import current_app
+
+
+class ImageStore:
+
+    """
+    Content-addressed image store interface. Images are keyed by the sha256 hex digest of their bytes,
+    so storing the same picture twice only keeps one copy.
+
+    Backends need to implement put_bytes, get, exists and delete.
+    """
+
+    @staticmethod
+    def hashimage(data):
+        """Returns the content hash (sha256 hex digest) that an image is keyed by"""
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data):
+        """Stores image bytes and returns their content hash"""
+        key = self.hashimage(data)
+
+        if not self.exists(key):                # Same content, same key - nothing to write
+            self.put_bytes(key, data)
+
+        return key
+
+    def put_bytes(self, key, data):
+        raise NotImplementedError
+
+    def get(self, key):
+        """Returns image bytes for a key or None if the key isn't in the store"""
+        raise NotImplementedError
+
+    def stream(self, key, chunksize = 64 * 1024):
+        """
+        Opens an image to send in chunks, so responses don't need to hold the whole image. Returns (chunks, size), or None
+        if the key isn't in the store, before any response is started. Backends that can read incrementally override this
+        """
+        data = self.get(key)
+
+        if data is None:
+            return None
+
+        return (data[start:start + chunksize] for start in range(0, len(data), chunksize)), len(data)
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class LocalImageStore(ImageStore):
+
+    """Image store backed by a local directory. Files are fanned out by hash prefix (ab/cd/abcd...) to keep directories small"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put_bytes(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temp file and rename so readers never see a half written image
+        tmppath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmppath, 'wb') as file:
+            file.write(data)
+        os.replace(tmppath, path)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def stream(self, key, chunksize = 64 * 1024):
+        try:
+            file = open(self._path(key), 'rb')          # Opened now, so a missing file is found before the response starts
+        except FileNotFoundError:
+            return None
+
+        def chunks():
+            with file:
+                while True:
+                    chunk = file.read(chunksize)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        return chunks(), os.fstat(file.fileno()).st_size
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class ObjectImageStore(ImageStore):
+
+    """
+    Image store backed by an object store bucket (S3, Supabase Storage, etc).
+
+    Takes any client with put_object/get_object/head_object/delete_object methods
+    that take Bucket and Key keyword arguments, the same shape as boto3's S3 client.
+    """
+
+    def __init__(self, client, bucket, prefix='images/'):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _objectkey(self, key):
+        return self.prefix + key
+
+    def put_bytes(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._objectkey(key), Body=data)
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._objectkey(key))
+        except KeyError:
+            return None
+
+        return response['Body'].read()
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._objectkey(key))
+        except KeyError:
+            return False
+
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._objectkey(key))
+
+
+class LocalObjectClient:
+
+    """
+    In-memory stand-in for an object store client, used for local runs and testing.
+
+    Missing objects raise KeyError, real clients should be wrapped to do the same.
+    """
+
+    class _Body:
+        def __init__(self, data):
+            self.data = data
+
+        def read(self):
+            return self.data
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        with self.lock:
+            self.objects[(Bucket, Key)] = bytes(Body)
+
+    def get_object(self, Bucket, Key):
+        return {'Body': self._Body(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+
+
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def imagemimetype(data):
+
+    """Sniffs the mimetype of raw image bytes from their magic number. Returns None if the bytes aren't a known image format"""
+
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+
+    return None
+
+
+def rawimagebytes(data):
+
+    """
+    Compatibility layer for images written before raw storage. Returns raw image bytes whether
+    data already is a raw image or the old base64 encoded form.
+    """
+
+    data = bytes(data)
+
+    if imagemimetype(data):
+        return data
+
+    try:
+        return base64.b64decode(data, validate = True)
+    except binascii.Error:
+        return data
+
+
+def create_image_store(config):
+
+    """
+    Builds an image store from app config.
+
+    IMAGE_STORE_BACKEND is either 'local' (default) or 'object'.
+    The local backend writes to IMAGE_STORE_PATH. The object backend uses IMAGE_STORE_CLIENT if it is set
+    and falls back to the in-memory stand-in otherwise.
+    """
+
+    backend = config.get('IMAGE_STORE_BACKEND', 'local')
+
+    if backend == 'local':
+        return LocalImageStore(config.get('IMAGE_STORE_PATH', os.path.join(os.getcwd(), 'imagestore')))
+    if backend == 'object':
+        client = config.get('IMAGE_STORE_CLIENT') or LocalObjectClient()
+        return ObjectImageStore(client, config.get('IMAGE_STORE_BUCKET', 'pishposh'))
+
+    raise ValueError(f"Unknown image store backend: {backend}")
+
+
+def get_image_store():
+
+    """Returns the image store for the current app, creating it from config on first use"""
+
+    store = current_app.extensions.get('imagestore')
+
+    if store is None:
+        store = create_image_store(current_app.config)
+        current_app.extensions['imagestore'] = store
+
+    return store
@@ -0,0 +1,235 @@
+"""
+Background jobs for slow work, so web requests don't wait on it.
+
+A request queues a job and gets its id back straight away, and the job is run by a separate worker process. Jobs
+are kept in Redis (a list for the queue, a hash per job for its status and result) and expire JOB_TTL seconds after
+they're queued. Without Redis they run on a thread in the web process instead. Run the worker from the project root:
+
+    $ python3 jobqueue.py
+"""
+
+import json
+import math
+import time
+import uuid
+import queue
+import argparse
+import threading
+
+from flask import current_app
+
+from backends import get_backend
+from mistraldescription import getproductlisting
+from ratelimiter import RateLimited
+
+
+# What each kind of job runs. Payloads are passed as keyword arguments and results need to be JSON
+JOBS = {
+    'aiprocess': getproductlisting,
+}
+
+
+# Sets fields on a job's hash, but only if it's still there. A job that expired stays gone rather than coming back
+# as a hash with no owner and no TTL
+UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class RedisJobQueue:
+
+    """
+    Jobs kept in Redis, shared by every web worker and worker process.
+
+    Job ids are pushed onto one list that workers block on, and each job's kind, owner, payload, status and result are
+    a hash. The payload is dropped once a worker picks the job up, so big ones (images) don't sit in Redis for the TTL.
+    A worker that dies mid job leaves it running until it expires
+    """
+
+    def __init__(self, redis, ttl, prefix = 'jobs:'):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self.updatescript = redis.register_script(UPDATE_SCRIPT)
+
+    def jobkey(self, jobid):
+        return f"{self.prefix}{jobid}"
+
+    def enqueue(self, kind, payload, owner):
+        jobid = uuid.uuid4().hex
+
+        pipe = self.redis.pipeline()
+        pipe.hset(self.jobkey(jobid), mapping = {'kind': kind, 'owner': owner, 'status': 'queued',
+                                                 'payload': json.dumps(payload), 'created': time.time()})
+        pipe.expire(self.jobkey(jobid), self.ttl)
+        pipe.lpush(f"{self.prefix}queue", jobid)
+        pipe.execute()
+
+        return jobid
+
+    def next(self, timeout):
+
+        """Waits up to timeout seconds for a job and marks it running. Returns (jobid, kind, payload) or None"""
+
+        item = self.redis.brpop(f"{self.prefix}queue", timeout = timeout)
+        if item is None:
+            return None
+
+        jobid = decode(item[1])
+        kind, payload = self.redis.hmget(self.jobkey(jobid), 'kind', 'payload')
+
+        if kind is None or payload is None:             # Expired while it was queued
+            return None
+
+        pipe = self.redis.pipeline()
+        self.update(jobid, {'status': 'running', 'started': time.time()}, pipe)
+        pipe.hdel(self.jobkey(jobid), 'payload')
+        pipe.execute()
+
+        return jobid, decode(kind), json.loads(payload)
+
+    def update(self, jobid, fields, client = None):
+        self.updatescript(keys = [self.jobkey(jobid)], args = [item for field in fields.items() for item in field], client = client)
+
+    def finish(self, jobid, status, **fields):
+        self.update(jobid, {'status': status, 'finished': time.time(), **{name: json.dumps(value) for name, value in fields.items()}})
+
+    def status(self, jobid):
+
+        """The job's owner, status and any result, error or retry_after, or None if there's no such job"""
+
+        owner, status, result, error, retryafter = self.redis.hmget(self.jobkey(jobid), 'owner', 'status', 'result', 'error', 'retry_after')
+
+        if status is None or owner is None:
+            return None
+
+        job = {'owner': int(owner), 'status': decode(status)}
+        for name, value in (('result', result), ('error', error), ('retry_after', retryafter)):
+            if value is not None:
+                job[name] = json.loads(value)
+
+        return job
+
+
+class MemoryJobQueue:
+
+    """Jobs run one at a time on a thread in the web process, for running without Redis (or inline with JOB_QUEUE_SYNC set)"""
+
+    def __init__(self, app, ttl, sync = False):
+        self.app = app
+        self.ttl = ttl
+        self.sync = sync
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def enqueue(self, kind, payload, owner):
+        jobid = uuid.uuid4().hex
+        now = time.time()
+
+        with self.lock:
+            for expired in [key for key, job in self.jobs.items() if job['created'] < now - self.ttl]:
+                del self.jobs[expired]
+
+            self.jobs[jobid] = {'kind': kind, 'owner': owner, 'status': 'queued', 'payload': payload, 'created': now}
+
+        self.pending.put(jobid)
+
+        if self.sync:
+            runjob(self, *self.next(0))
+        elif self.worker is None:
+            self.worker = threading.Thread(target = work, args = (self.app, self), daemon = True)
+            self.worker.start()
+
+        return jobid
+
+    def next(self, timeout):
+        try:
+            jobid = self.pending.get(timeout = timeout) if timeout else self.pending.get_nowait()
+        except queue.Empty:
+            return None
+
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if job is None:
+                return None
+
+            job['status'] = 'running'
+            payload = job.pop('payload')
+
+        return jobid, job['kind'], payload
+
+    def finish(self, jobid, status, **fields):
+        with self.lock:
+            if jobid in self.jobs:
+                self.jobs[jobid].update(status = status, **fields)
+
+    def status(self, jobid):
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if job is None:
+                return None
+
+            return {name: value for name, value in job.items() if name in ('owner', 'status', 'result', 'error', 'retry_after')}
+
+
+def get_job_queue():
+
+    """Returns the job queue for the current app"""
+
+    app = current_app._get_current_object()
+    ttl = app.config.get('JOB_TTL', 3600)
+
+    return get_backend('jobqueue', lambda redis: RedisJobQueue(redis, ttl), lambda: MemoryJobQueue(app, ttl, app.config.get('JOB_QUEUE_SYNC', False)))
+
+
+def runjob(jobqueue, jobid, kind, payload):
+
+    """Runs one job and records how it went. Needs an app context"""
+
+    try:
+        result = JOBS[kind](**payload)
+    except RateLimited as e:
+        jobqueue.finish(jobid, 'failed', error = "AI descriptions are busy right now, please try again", retry_after = math.ceil(e.retry_after))
+    except Exception as e:
+        print(f"Job {jobid} ({kind}) failed:", e)
+        jobqueue.finish(jobid, 'failed', error = "Something went wrong, please try again")
+    else:
+        jobqueue.finish(jobid, 'done', result = result)
+
+
+def work(app, jobqueue, timeout = 5, stop = None):
+
+    """Runs jobs as they're queued, each in its own app context, until stop (a threading.Event) is set"""
+
+    while stop is None or not stop.is_set():
+        job = jobqueue.next(timeout)
+
+        if job is not None:
+            with app.app_context():
+                runjob(jobqueue, *job)
+
+
+if __name__ == '__main__':
+
+    from app import app
+
+    parser = argparse.ArgumentParser(description = "Run queued background jobs")
+    parser.add_argument('--timeout', type = int, default = 5, help = "Seconds to wait for a job before checking again")
+    args = parser.parse_args()
+
+    app.config['MISTRAL_RATE_LIMIT_WAIT'] = None        # Nobody's request is held up here, so Mistral calls wait their turn
+
+    with app.app_context():
+        jobqueue = get_job_queue()
+
+    work(app, jobqueue, timeout = args.timeout)
@@ -0,0 +1,57 @@
+import base64
+from decimal import Decimal
+
+import orjson
+from flask.json.provider import JSONProvider
+
+
+def default(o):
+
+    """Handles the types orjson can't serialize itself. orjson already covers datetimes (as ISO 8601), UUIDs and dataclasses"""
+
+    if isinstance(o, Decimal):
+        return str(o)                                   # Same as Flask's default provider, keeps the exact value
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return base64.b64encode(o).decode('ascii')
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+
+    """
+    Flask JSON provider built on orjson, which is several times faster than the stdlib encoder on big payloads.
+
+    Responses are built straight from the bytes orjson returns, without decoding to a str and encoding back.
+    Keeps the sort_keys and compact attributes of Flask's default provider, so app.json.sort_keys = False still works.
+    """
+
+    sort_keys = True
+    compact = None
+    mimetype = 'application/json'
+
+    def options(self, pretty = False):
+        option = orjson.OPT_NON_STR_KEYS                # Routes like /cart key dicts by integer product ids
+
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+
+        return option
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default = default, option = self.options()).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = self.compact is False or (self.compact is None and self._app.debug)
+
+        return self._app.response_class(orjson.dumps(obj, default = default, option = self.options(pretty)), mimetype = self.mimetype)
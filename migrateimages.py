@@ -0,0 +1,79 @@
+import argparse
+
+from sqlalchemy import select, update
+
+from models import Product, db
+from imagestore import get_image_store, imagemimetype, rawimagebytes
+from responsecache import invalidate
+from backfillvariants import backfill_variants
+
+
+def migrate_images(batch_size = 500, after = 0):
+
+    """
+    Moves images out of the legacy products.image column (base64 or raw) into the image store as raw bytes.
+
+    Works through products in productid order one batch at a time. Each batch streams its rows from a
+    server-side cursor (yield_per) and is committed on its own, so transactions stay short and memory stays flat.
+    Migrated rows have their legacy column cleared, which makes the migration resumable - rerunning it
+    just picks up whatever rows still have a legacy image. Pass after to skip ahead to a productid.
+
+    Returns the number of products migrated.
+    """
+
+    store = get_image_store()
+    migrated = 0
+
+    while True:
+        batch = (
+            select(Product.productid, Product.image)
+                .where(Product.image.is_not(None))
+                .where(Product.productid > after)
+                .order_by(Product.productid)
+                .limit(batch_size)
+                .execution_options(yield_per = 100)
+        )
+
+        updates = []
+
+        for productid, image in db.session.execute(batch):
+            image_data = rawimagebytes(image)
+
+            updates.append({
+                'productid': productid,
+                'image_hash': store.put(image_data),
+                'image_mimetype': imagemimetype(image_data) or 'image/jpeg',
+                'image_size': len(image_data),
+                'image': None
+            })
+
+        if not updates:
+            break
+
+        db.session.execute(update(Product), updates)                # Bulk UPDATE by primary key
+        db.session.commit()
+
+        invalidate(*(f"product:{row['productid']}" for row in updates))       # Their image URLs changed
+
+        after = updates[-1]['productid']
+        migrated += len(updates)
+        print(f"Migrated {migrated} product images, last productid was {after}")
+
+    return migrated
+
+
+if __name__ == '__main__':
+
+    from app import app
+
+    parser = argparse.ArgumentParser(description = "Move legacy product images into the image store")
+    parser.add_argument('--batch-size', type = int, default = 500, help = "Products to migrate per transaction")
+    parser.add_argument('--after', type = int, default = 0, help = "Only migrate products with a productid greater than this")
+    parser.add_argument('--skip-variants', action = 'store_true', help = "Don't make resized variants of the migrated images")
+    args = parser.parse_args()
+
+    with app.app_context():
+        migrate_images(batch_size = args.batch_size, after = args.after)
+
+        if not args.skip_variants:                  # Migrated images only have their originals until these are made
+            backfill_variants(after = args.after)
@@ -0,0 +1,60 @@
+"""baseline schema
+
+The tables as db.create_all() made them before migrations, with product images in the products table.
+Databases made that way are already at this revision: run `flask db stamp 4117550308eb` on them once, then `flask db upgrade`
+
+Revision ID: 4117550308eb
+Revises: 
+Create Date: 2026-10-18 07:08:01.800311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4117550308eb'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('users',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('username', sa.String(length=50), nullable=False),
+        sa.Column('passwordhash', sa.String(), nullable=False),
+        sa.Column('firstname', sa.String(length=50), nullable=False),
+        sa.Column('lastname', sa.String(length=50), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username')
+    )
+    op.create_table('tags',
+        sa.Column('tagid', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('tagname', sa.String(length=50), nullable=False),
+        sa.PrimaryKeyConstraint('tagid')
+    )
+    op.create_table('products',
+        sa.Column('productid', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('productname', sa.String(length=200), nullable=False),
+        sa.Column('productdescription', sa.String(), nullable=True),
+        sa.Column('price', sa.Integer(), nullable=False),
+        sa.Column('image', sa.LargeBinary(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('productid')
+    )
+    op.create_table('products_tags',
+        sa.Column('tagid', sa.Integer(), nullable=False),
+        sa.Column('productid', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['productid'], ['products.productid'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['tagid'], ['tags.tagid'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('tagid', 'productid')
+    )
+
+
+def downgrade():
+    op.drop_table('products_tags')
+    op.drop_table('products')
+    op.drop_table('tags')
+    op.drop_table('users')
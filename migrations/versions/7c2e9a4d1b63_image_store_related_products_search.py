@@ -0,0 +1,96 @@
+"""image store, related products and search
+
+Adds the image store columns to products (images already in the image column are moved with migrateimages.py),
+the related products table (filled by relatedproducts.py) and the full text search index.
+
+The search DDL is written out here rather than taken from search.py, so this revision stays the same if that changes
+
+Revision ID: 7c2e9a4d1b63
+Revises: 4117550308eb
+Create Date: 2026-10-18 07:08:04.512937
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2e9a4d1b63'
+down_revision = '4117550308eb'
+branch_labels = None
+depends_on = None
+
+
+# Postgres: a generated tsvector over the name and description with a GIN index
+POSTGRES_SEARCH_DDL = [
+    """ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+           setweight(to_tsvector('english', coalesce(productname, '')), 'A') ||
+           setweight(to_tsvector('english', coalesce(productdescription, '')), 'B') ||
+           setweight(to_tsvector('simple', coalesce(productname, '')), 'C')
+       ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_products_search_vector ON products USING gin (search_vector)",
+]
+
+# SQLite: an external content FTS5 table over products kept in sync by triggers, built from the rows already there
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+           productname, productdescription, content = 'products', content_rowid = 'productid'
+       )""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+           INSERT INTO products_fts (rowid, productname, productdescription) VALUES (new.productid, new.productname, new.productdescription);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+           INSERT INTO products_fts (products_fts, rowid, productname, productdescription) VALUES ('delete', old.productid, old.productname, old.productdescription);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF productname, productdescription ON products BEGIN
+           INSERT INTO products_fts (products_fts, rowid, productname, productdescription) VALUES ('delete', old.productid, old.productname, old.productdescription);
+           INSERT INTO products_fts (rowid, productname, productdescription) VALUES (new.productid, new.productname, new.productdescription);
+       END""",
+    "INSERT INTO products_fts (products_fts) VALUES ('rebuild')",
+]
+
+POSTGRES_DROP_SEARCH_DDL = [
+    "DROP INDEX IF EXISTS ix_products_search_vector",
+    "ALTER TABLE products DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_DROP_SEARCH_DDL = [
+    "DROP TRIGGER IF EXISTS products_fts_insert",
+    "DROP TRIGGER IF EXISTS products_fts_delete",
+    "DROP TRIGGER IF EXISTS products_fts_update",
+    "DROP TABLE IF EXISTS products_fts",
+]
+
+
+def upgrade():
+    op.add_column('products', sa.Column('image_hash', sa.String(length=64), nullable=True))
+    op.add_column('products', sa.Column('image_mimetype', sa.String(length=50), nullable=True))
+    op.add_column('products', sa.Column('image_size', sa.Integer(), nullable=True))
+    op.add_column('products', sa.Column('image_variants', sa.JSON(), nullable=True))
+
+    op.create_table('related_products',
+        sa.Column('productid', sa.Integer(), nullable=False),
+        sa.Column('relatedid', sa.Integer(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['productid'], ['products.productid'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['relatedid'], ['products.productid'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('productid', 'relatedid')
+    )
+    op.create_index('ix_related_products_relatedid', 'related_products', ['relatedid'], unique=False)
+
+    for statement in {'postgresql': POSTGRES_SEARCH_DDL, 'sqlite': SQLITE_SEARCH_DDL}.get(op.get_bind().dialect.name, []):
+        op.execute(statement)
+
+
+def downgrade():
+    for statement in {'postgresql': POSTGRES_DROP_SEARCH_DDL, 'sqlite': SQLITE_DROP_SEARCH_DDL}.get(op.get_bind().dialect.name, []):
+        op.execute(statement)
+
+    op.drop_index('ix_related_products_relatedid', table_name='related_products')
+    op.drop_table('related_products')
+
+    with op.batch_alter_table('products') as batch_op:
+        batch_op.drop_column('image_variants')
+        batch_op.drop_column('image_size')
+        batch_op.drop_column('image_mimetype')
+        batch_op.drop_column('image_hash')
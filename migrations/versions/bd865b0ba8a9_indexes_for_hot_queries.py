@@ -0,0 +1,46 @@
+"""indexes for hot queries
+
+Indexes products.user_id (user.products on profile pages) and products_tags.productid (product.tags, the primary key
+starts with tagid), and makes tags.tagname unique, which tagging already assumed. Tags with the same name are merged
+into the oldest one first
+
+Revision ID: bd865b0ba8a9
+Revises: 7c2e9a4d1b63
+Create Date: 2026-10-18 07:08:06.074119
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bd865b0ba8a9'
+down_revision = '7c2e9a4d1b63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_products_user_id', 'products', ['user_id'], unique=False)
+    op.create_index('ix_products_tags_productid', 'products_tags', ['productid'], unique=False)
+
+    # Move products over to the oldest tag of each name, then drop the duplicates
+    op.execute("""
+        INSERT INTO products_tags (tagid, productid)
+        SELECT DISTINCT tags.keep, products_tags.productid
+        FROM products_tags
+        JOIN (SELECT tagid, min(tagid) OVER (PARTITION BY tagname) AS keep FROM tags) AS tags ON tags.tagid = products_tags.tagid
+        WHERE tags.keep <> tags.tagid
+          AND NOT EXISTS (SELECT 1 FROM products_tags AS kept WHERE kept.tagid = tags.keep AND kept.productid = products_tags.productid)
+    """)
+    duplicates = "SELECT tagid FROM tags WHERE tagid NOT IN (SELECT min(tagid) FROM tags GROUP BY tagname)"
+    op.execute(f"DELETE FROM products_tags WHERE tagid IN ({duplicates})")
+    op.execute(f"DELETE FROM tags WHERE tagid IN ({duplicates})")
+
+    op.create_index('ix_tags_tagname', 'tags', ['tagname'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_tags_tagname', table_name='tags')
+    op.drop_index('ix_products_tags_productid', table_name='products_tags')
+    op.drop_index('ix_products_user_id', table_name='products')
@@ -1,16 +1,39 @@
 import requests
 import base64
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
 from mistralai import Mistral
 import os
 
+from aicache import cachedanswer
+from ratelimiter import RateLimitedClient
+
 # Retrieve the API key from environment variables
 api_key = os.environ["MISTRAL_API_KEY"]
 
 # Specify model
 model = "pixtral-12b-2409"
 
-# Initialize the Mistral client
-client = Mistral(api_key=api_key)
+# Initialize the Mistral client. Calls share the app's per model rate limit, waiting up to MISTRAL_RATE_LIMIT_WAIT for it
+client = RateLimitedClient(Mistral(api_key=api_key))
+
+# One prompt for both halves of a listing, answered as a JSON object
+LISTING_PROMPT = ("Describe the product in this picture for a store listing. Reply with only a JSON object with two keys: "
+                  "\"title\", a short title for the product that is 2-5 words long, and "
+                  "\"description\", a product description that is about 6-12 words long.")
+
+# Prompts for asking for each half on its own, if the JSON answer can't be used
+TITLE_PROMPT = "Give me a short title for this picture that is 2-5 words long. This title should describe the picture as a product"
+DESCRIPTION_PROMPT = "Give me a product description for this picture that is about 6-12 words long."
+
+TITLE_LENGTH = 200              # Same as the productname column
+DESCRIPTION_LENGTH = 2000
+
+
+class ListingError(ValueError):
+    """Raised when the model's answer doesn't have a usable title and description"""
 
 # base64_image = getimages()
 
@@ -72,15 +95,122 @@ def getproductdescription(image_data, prompt=None):
         }
     ]
 
-    # Get the chat response
-    chat_response = client.chat.complete(
-        model=model,
-        messages=messages
-    )
+    def ask():
+        # Get the chat response
+        chat_response = client.chat.complete(
+            model=model,
+            messages=messages
+        )
+
+        # Print the content of the response and return as output
+        print(chat_response.choices[0].message.content)
+
+        return chat_response.choices[0].message.content
+
+    # The same or a near identical image asked the same thing before gets the cached answer
+    output = cachedanswer(base64.b64decode(image_data), f"{model}\n{message_data}", ask)
+
+    return output
+
+
+def cleanfield(value, length):
+
+    """Tidies a title or description from the model - collapsed whitespace, no wrapping quotes, cut to length. Returns None if nothing's left"""
+
+    if not isinstance(value, str):
+        return None
+
+    value = re.sub(r'\s+', ' ', value).strip().strip('"\'*').strip()
+
+    return value[:length] or None
+
+
+def parselisting(text):
+
+    """
+    Reads {"title", "description"} out of a model's answer.
+
+    Models sometimes wrap the JSON in a code fence or a sentence, so this takes the outermost {...} in the text.
+    Raises ListingError if there's no JSON object or either field is missing or empty
+    """
+
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end < start:
+        raise ListingError("No JSON object in the answer")
+
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        raise ListingError("Answer isn't valid JSON")
+
+    if not isinstance(data, dict):
+        raise ListingError("Answer isn't a JSON object")
+
+    listing = {'title': cleanfield(data.get('title'), TITLE_LENGTH),
+               'description': cleanfield(data.get('description'), DESCRIPTION_LENGTH)}
+
+    if not all(listing.values()):
+        raise ListingError("Answer is missing a title or description")
+
+    return listing
+
+
+def getproductlisting(image_data):
+
+    """
+    Gets a title and description for base64 utf-8 image data from Mistral's AI.
+
+    Both come back from one call in JSON mode, cached by image like getproductdescription's answers. If that answer
+    can't be parsed, the title and description are asked for separately, with the two calls made at the same time so it
+    only costs one more round trip.
+    Returns {"title", "description"}
+    """
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": LISTING_PROMPT
+                },
+                {
+                    "type": "image_url",
+                    "image_url": f"data:image/jpeg;base64,{image_data}"
+                }
+            ]
+        }
+    ]
+
+    def ask():
+        chat_response = client.chat.complete(
+            model=model,
+            messages=messages,
+            response_format={"type": "json_object"}
+        )
+
+        output = chat_response.choices[0].message.content
+
+        try:
+            return json.dumps(parselisting(output))             # Only answers that parse are cached
+        except ListingError:
+            print("From getproductlisting() - can't use the answer:", output)
+            raise
+
+    try:
+        return json.loads(cachedanswer(base64.b64decode(image_data), f"{model}\n{LISTING_PROMPT}", ask))
+    except ListingError as e:
+        print("From getproductlisting() - falling back to separate calls:", e)
+
+    app = current_app._get_current_object()
 
-    # Print the content of the response and return as output
-    print(chat_response.choices[0].message.content)
+    def ask(prompt):
+        with app.app_context():                         # The rate limiter comes from the app
+            return getproductdescription(image_data, prompt)
 
-    output = chat_response.choices[0].message.content
+    with ThreadPoolExecutor(max_workers = 2) as pool:
+        title = pool.submit(ask, TITLE_PROMPT)
+        description = pool.submit(ask, DESCRIPTION_PROMPT)
 
-    return output
\ No newline at end of file
+        return {'title': cleanfield(title.result(), TITLE_LENGTH) or '',
+                'description': cleanfield(description.result(), DESCRIPTION_LENGTH) or ''}
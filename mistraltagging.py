@@ -1,17 +1,17 @@
 import os
-from time import sleep
 
-from mistralai.client import MistralClient
-from sqlalchemy import func
+from mistralai import Mistral
 from app import app
 
 from models import Product, db, Tag
+from sampling import randomrows
+from ratelimiter import RateLimitedClient
 from sqlalchemy.exc import IntegrityError
 
 api_key = os.environ["MISTRAL_API_KEY"]
 model = "mistral-large-latest"
 
-client = MistralClient(api_key=api_key)
+client = RateLimitedClient(Mistral(api_key=api_key), wait = None)     # Waits as long as it takes for the shared rate limit
 
 def get_product_tag(desc, prompt=None):
 
@@ -41,42 +41,35 @@ def get_product_tag(desc, prompt=None):
 
     return output
 
-def get_random_product_description():
+def get_random_product_descriptions(sample = 1):
     """
-    Fetches one random product description from the Product model
+    Fetches random product descriptions from the Product model
     using Flask-SQLAlchemy's `Product.query`.
 
     This function is used to benchmark the AI model and see how well it performs on random products data.
+    Products are picked with random primary key lookups rather than ORDER BY random(), which sorts the whole table.
 
-    :return: A single description string, or None if no products exist.
+    :return: A list of up to sample description strings, empty if no products exist.
     """
-    random_func = func.random()  # Getting a random number
 
     with app.app_context():
-        result = (
-            Product.query
-                .with_entities(Product.productname)
-                .order_by(random_func)
-                .limit(1)
-                .first()
-        )
+        products = randomrows(Product.query.with_entities(Product.productid, Product.productname), Product.productid, sample)
 
-    return result[0] if result else None
+    return [product.productname for product in products]
 
 def testing(sample = 1):
     """
     Test function to get a random product description and generate tags and see how this works
     """
-    for x in range(sample):
+    descriptions = get_random_product_descriptions(sample)
+    if not descriptions:
+        print("No product descriptions found.")
+
+    with app.app_context():                                 # The rate limiter comes from the app
+        for desc in descriptions:
 
-        desc = get_random_product_description()
-        if desc:
             print(f"Random Product Description: {desc}")
             get_product_tag(desc)                           # This function prints the tags
-        else:
-            print("No product descriptions found.")
-
-        sleep(5)  # Sleep to avoid rate limits
 
 
 def bulk_tag_all_products():
@@ -92,7 +85,6 @@ def bulk_tag_all_products():
             # Determine which tag-names to attach to this product
             desired_tag_names = get_product_tag(product.productname)
             desired_tag_names = set(desired_tag_names.split(","))
-            sleep(5)  # Sleep to avoid rate limits
 
             print("Desired Tag Names are", desired_tag_names)
 
@@ -1,22 +1,29 @@
+import os
+
+from flask import url_for
+from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from random import randint
-import base64
 
-db = SQLAlchemy()
+from imagestore import ImageStore, get_image_store, rawimagebytes
+from passwordhashing import HashingBusy, get_password_hasher
 
-bcrypt = Bcrypt()
+db = SQLAlchemy()
+migrate = Migrate()
 
 
 def connect_db(app, db_uri):                        # Inits the app context with supplied db_uri
-    """Connect to database."""
+    """
+    Connect to database.
+
+    The schema is managed by the migrations in migrations/, run `flask db upgrade` to create or update it
+    """
 
     app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
 
     db.app = app
     db.init_app(app)
-    db.create_all()
-    # db.drop_all() # For debugging if we want to start with a new table each time
+    migrate.init_app(app, db, directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
 
 class User(db.Model):
 
@@ -46,12 +53,12 @@ class User(db.Model):
     def hashpassword(cls, username, password, firstname, lastname):
 
         """
-        Hashes inputted password and returns user instance with hashedpassword in password field
+        Hashes inputted password and returns user instance with hashedpassword in password field.
+        Hashing runs on the password hasher's pool and raises HashingBusy if it's full
 
         """
 
-        hashpw = bcrypt.generate_password_hash(password)
-        hashedpw_utf8 = hashpw.decode('utf8')
+        hashedpw_utf8 = get_password_hasher().hash(password)
 
         return cls(username=username, passwordhash=hashedpw_utf8, firstname=firstname, lastname=lastname)
     
@@ -61,12 +68,21 @@ class User(db.Model):
         """
         Checking if user is in fact there and checking if password matches.
         
-        Returns user if True and returns False if check fails
+        Returns user if True and returns False if check fails.
+        A password hash made with a different BCRYPT_LOG_ROUNDS than the current one is replaced while we have the password,
+        unless every hashing slot is taken by then, in which case it's left for a later login
         """
 
         user = User.query.filter_by(username=username).first()
-
-        if user and bcrypt.check_password_hash(user.passwordhash, password):
+        hasher = get_password_hasher()
+
+        if user and hasher.check(user.passwordhash, password):
+            if hasher.needs_rehash(user.passwordhash):
+                try:
+                    user.passwordhash = hasher.hash(password)
+                    db.session.commit()
+                except HashingBusy:
+                    pass                            # The password checked out, so the login still goes through
             return user
         else:
             return False
@@ -91,12 +107,23 @@ class Product(db.Model):
     price = db.Column(db.Integer,
                       nullable = False)
     
-    image = db.Column(db.LargeBinary)
+    # Images live in the image store keyed by content hash, the row only keeps the hash and metadata
+    image_hash = db.Column(db.String(64))
+    image_mimetype = db.Column(db.String(50))
+    image_size = db.Column(db.Integer)
+
+    image_variants = db.Column(db.JSON)         # Resized copies from imagepipeline.py, variant name -> hash, mimetype, width, height, size
+
+    # Legacy image column (base64 or raw), only read for rows that migrateimages.py hasn't moved to the image store.
+    # It's deferred so catalog queries don't pull image bytes, endpoints that need it opt in with Product.withimage()
+    image = db.deferred(db.Column(db.LargeBinary), group = 'image')
+    has_legacy_image = db.column_property(image.columns[0].is_not(None))
     
     user_id = db.Column(db.Integer,
                         db.ForeignKey('users.id'
                                       , ondelete = 'cascade'
-                                      ))
+                                      ),
+                        index = True)           # For user.products on profile pages
 
     @classmethod
     def generateprice(cls):
@@ -105,19 +132,82 @@ class Product(db.Model):
 
         return price
 
-    def encode_image(self, image_data):
-        """Encodes image data to binary for storage."""
-        image_data = base64.b64encode(image_data)
+    @classmethod
+    def withimage(cls):
+        """Product query that loads the deferred legacy image column along with the rest of the row"""
+        return cls.query.options(db.undefer_group('image'))
 
-        self.image = image_data
+    def store_image(self, image_data, mimetype = 'image/jpeg'):
+        """Puts raw image bytes in the image store and points this product at them."""
+        self.image_hash = get_image_store().put(image_data)
+        self.image_mimetype = mimetype
+        self.image_size = len(image_data)
 
+    def get_image(self):
+        """Returns raw image bytes from the image store (or the legacy image column) or None if there is no image"""
+        if self.image_hash:
+            return get_image_store().get(self.image_hash)
 
-    def decode_image(self):
-        """Decodes binary image data to string for display in HTML. Returns image or None if no image attribute"""
         if self.image:
-            return self.image.decode('utf-8')
+            return rawimagebytes(self.image)
+
+        return None
+
+    def has_image(self):
+        if self.image_hash:
+            return True
+
+        if self.has_legacy_image is None:            # Not loaded from the database yet, so check the column itself
+            return self.image is not None
+
+        return self.has_legacy_image
+
+    def image_etag(self):
+        """Strong ETag for the image - its content hash, which only has to be computed for legacy rows"""
+        if self.image_hash:
+            return self.image_hash
+
+        return ImageStore.hashimage(self.get_image())
+
+    def variant(self, name):
+        """
+        Returns the metadata of the smallest variant that's at least as big as the named one, or None if there isn't one.
+        Variants are generated off the request so a fresh upload might not have them yet.
+        """
+        from imagepipeline import VARIANTS
+
+        variants = self.image_variants or {}
+        names = list(VARIANTS)
+
+        for candidate in reversed(names[:names.index(name) + 1]):          # The named variant, then larger ones
+            if candidate in variants:
+                return variants[candidate]
 
         return None
+
+    def variant_url(self, name):
+        """URL of the named image variant, falling back to the original image if it hasn't been generated"""
+        variant = self.variant(name)
+
+        if variant is None:
+            return self.image_url
+
+        return url_for('apiroutes.getproductimagevariant', productid = self.productid, variant = name, v = variant['hash'][:16])
+
+    def variant_urls(self):
+        """URLs of every image variant this product has"""
+        return {name: self.variant_url(name) for name in (self.image_variants or {})}
+
+    @property
+    def image_url(self):
+        """URL of the binary image route for this product, or None if there is no image. The content hash versions the URL so it can be cached forever"""
+        if not self.has_image():
+            return None
+
+        if self.image_hash:
+            return url_for('apiroutes.getproductimage', productid = self.productid, v = self.image_hash[:16])
+
+        return url_for('apiroutes.getproductimage', productid = self.productid)
     
 
 class Tag(db.Model):
@@ -131,7 +221,9 @@ class Tag(db.Model):
                       autoincrement = True)
     
     tagname = db.Column(db.String(50),
-                        nullable = False)
+                        nullable = False,
+                        unique = True,
+                        index = True)           # Tags are looked up by name when products are tagged
 
     products = db.relationship('Product',
                                secondary = 'products_tags',
@@ -153,3 +245,30 @@ class ProductTag(db.Model):
                           db.ForeignKey('products.productid',
                         ondelete = 'cascade'),
                           primary_key = True)
+
+    __table_args__ = (db.Index('ix_products_tags_productid', 'productid'),)            # The primary key starts with tagid, this is for product.tags
+
+
+class RelatedProduct(db.Model):
+
+    """
+    Precomputed related products. Each product keeps its closest matches by Jaccard similarity of their tag sets
+    (shared tags over all tags between the two). Kept up to date by relatedproducts.py as tags change
+    """
+
+    __tablename__ = 'related_products'
+
+    productid = db.Column(db.Integer,
+                          db.ForeignKey('products.productid',
+                        ondelete = 'cascade'),
+                          primary_key = True)
+
+    relatedid = db.Column(db.Integer,
+                          db.ForeignKey('products.productid',
+                        ondelete = 'cascade'),
+                          primary_key = True)
+
+    score = db.Column(db.Float,
+                      nullable = False)
+
+    __table_args__ = (db.Index('ix_related_products_relatedid', 'relatedid'),)          # For finding the lists a product is in when its tags change
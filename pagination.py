@@ -0,0 +1,85 @@
+import json
+import base64
+import binascii
+
+from flask import current_app, request
+
+
+class PaginationError(ValueError):
+    """Raised for a bad limit or cursor query parameter"""
+
+
+def encodecursor(values):
+
+    """Packs cursor values into an opaque URL-safe string. Clients just hand it back to get the next page"""
+
+    data = json.dumps(values, separators = (',', ':')).encode('utf-8')
+
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decodecursor(cursor):
+
+    """Unpacks a cursor made by encodecursor. Raises PaginationError if it has been tampered with or mangled"""
+
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, ValueError):
+        raise PaginationError("Invalid cursor")
+
+    if not isinstance(values, dict):
+        raise PaginationError("Invalid cursor")
+
+    return values
+
+
+def pagelimit():
+
+    """Page size from the limit query parameter, defaulting to API_PAGE_SIZE_DEFAULT and capped at API_PAGE_SIZE_MAX"""
+
+    default = current_app.config.get('API_PAGE_SIZE_DEFAULT', 50)
+    maximum = current_app.config.get('API_PAGE_SIZE_MAX', 200)
+
+    limit = request.args.get('limit', default)
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise PaginationError("limit must be a number")
+
+    if limit < 1:
+        raise PaginationError("limit must be at least 1")
+
+    return min(limit, maximum)
+
+
+def keysetpage(query, keycolumn):
+
+    """
+    Fetches one page of query using keyset pagination on keycolumn (a unique, indexed column like a primary key).
+
+    Rather than an OFFSET scan that gets slower the deeper you page, each page is
+    WHERE key > :last ORDER BY key LIMIT n, an index range scan that costs the same on every page.
+    Reads limit and cursor from the request's query parameters.
+
+    Returns the page's items and the cursor for the next page (None on the last page)
+    """
+
+    limit = pagelimit()
+    cursor = request.args.get('cursor')
+
+    if cursor:
+        after = decodecursor(cursor).get('after')
+        if not isinstance(after, int):
+            raise PaginationError("Invalid cursor")
+        query = query.filter(keycolumn > after)
+
+    items = query.order_by(keycolumn).limit(limit + 1).all()       # One extra row tells us if there's another page
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encodecursor({'after': getattr(items[-1], keycolumn.key)})
+
+    return items, next_cursor
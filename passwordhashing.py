@@ -0,0 +1,126 @@
+import os
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from flask_bcrypt import Bcrypt
+
+from backends import get_backend
+
+
+class HashingBusy(Exception):
+    """Raised when every password hashing slot is taken, so the request can be turned away instead of queueing"""
+
+
+# Takes a hashing slot if fewer than ARGV[1] are held. Slots are members of a sorted set scored by when they were taken,
+# and ones older than ARGV[2] milliseconds are dropped first, so slots held by a worker that died free themselves
+SLOT_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[3])
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+class RedisHashingSlots:
+
+    """
+    Hashing slots counted in Redis, so the limit holds across every gunicorn worker rather than per process.
+
+    With sync workers each process only hashes for one request at a time, so a limit per process would never be reached.
+    acquire() returns a token to release() with, or None if all count slots are taken. Slots not released within ttl
+    seconds (a worker that died mid hash) are given back
+    """
+
+    def __init__(self, redis, count, ttl, key = 'bcrypt:slots'):
+        self.redis = redis
+        self.count = count
+        self.ttl = ttl
+        self.key = key
+        self.slotscript = redis.register_script(SLOT_SCRIPT)
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        return token if self.slotscript(keys = [self.key], args = [self.count, int(self.ttl * 1000), token]) else None
+
+    def release(self, token):
+        self.redis.zrem(self.key, token)
+
+
+class MemoryHashingSlots:
+
+    """Hashing slots counted in this process, for running without Redis. Each process gets count slots of its own"""
+
+    def __init__(self, count):
+        self.semaphore = threading.BoundedSemaphore(count)
+
+    def acquire(self):
+        return True if self.semaphore.acquire(blocking = False) else None
+
+    def release(self, token):
+        self.semaphore.release()
+
+
+class PasswordHasher:
+
+    """
+    Runs bcrypt on a small, bounded thread pool, for as many requests at once as there are hashing slots.
+
+    bcrypt releases the GIL while it hashes, so the pool uses real cores, and capping it at a few threads means a burst of
+    logins can only take that many cores away from the rest of the app. Slots are shared by every worker when they're
+    kept in Redis, otherwise up to queue requests past the pool's threads may wait in this process.
+    Past that, hash() and check() raise HashingBusy straight away rather than stalling the worker.
+
+    Hashes are made with log_rounds, and needs_rehash() says whether a stored hash was made with a different cost.
+    """
+
+    def __init__(self, log_rounds = 12, workers = 2, queue = 4, slots = None):
+        self.log_rounds = log_rounds
+        self.bcrypt = Bcrypt()
+        self.pool = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'bcrypt')
+        self.slots = slots if slots is not None else MemoryHashingSlots(workers + queue)
+
+    def run(self, function, *args):
+        token = self.slots.acquire()
+        if token is None:
+            raise HashingBusy()
+
+        try:
+            return self.pool.submit(function, *args).result()
+        finally:
+            self.slots.release(token)
+
+    def hash(self, password):
+        return self.run(self.bcrypt.generate_password_hash, password, self.log_rounds).decode('utf8')
+
+    def check(self, passwordhash, password):
+        return self.run(self.bcrypt.check_password_hash, passwordhash, password)
+
+    def needs_rehash(self, passwordhash):
+        """Hashes look like $2b$12$<salt and hash>, where 12 is the log rounds they were made with"""
+        return int(passwordhash.split('$')[2]) != self.log_rounds
+
+
+def get_password_hasher():
+
+    """
+    Returns the password hasher for the current app, set up from BCRYPT_LOG_ROUNDS and BCRYPT_WORKERS. Its slots are
+    BCRYPT_SLOTS shared in Redis, or BCRYPT_WORKERS + BCRYPT_QUEUE per process without it
+    """
+
+    log_rounds = current_app.config.get('BCRYPT_LOG_ROUNDS', 12)
+    workers = current_app.config.get('BCRYPT_WORKERS', min(4, os.cpu_count() or 1))
+    queue = current_app.config.get('BCRYPT_QUEUE', 2 * workers)
+    slots = current_app.config.get('BCRYPT_SLOTS', workers + queue)
+    ttl = current_app.config.get('BCRYPT_SLOT_TTL', 30)
+
+    return get_backend('passwordhasher',
+                       lambda redis: PasswordHasher(log_rounds, workers, queue, RedisHashingSlots(redis, slots, ttl)),
+                       lambda: PasswordHasher(log_rounds, workers, queue))
@@ -0,0 +1,83 @@
+import time
+import threading
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from backends import get_backend
+from models import User
+
+
+class RedisProfileCache:
+
+    """Serialized user profiles kept in Redis for ttl seconds, so routes that just echo the logged in user skip the database"""
+
+    def __init__(self, redis, ttl, prefix = 'profile:'):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, userid):
+        return self.redis.get(f"{self.prefix}{userid}")
+
+    def set(self, userid, body):
+        self.redis.set(f"{self.prefix}{userid}", body, ex = self.ttl)
+
+    def delete(self, *userids):
+        self.redis.delete(*(f"{self.prefix}{userid}" for userid in userids))
+
+
+class MemoryProfileCache:
+
+    """Profiles cached in this process's memory, for running without Redis. A change only clears the copy in the worker that made it"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    def get(self, userid):
+        body, expires = self.profiles.get(userid, (None, 0))
+
+        return body if expires > time.monotonic() else None
+
+    def set(self, userid, body):
+        with self.lock:
+            self.profiles[userid] = (body, time.monotonic() + self.ttl)
+
+    def delete(self, *userids):
+        with self.lock:
+            for userid in userids:
+                self.profiles.pop(userid, None)
+
+
+def get_profile_cache():
+
+    """Returns the profile cache for the current app"""
+
+    ttl = current_app.config.get('PROFILE_CACHE_TTL', 300)
+
+    return get_backend('profilecache', lambda redis: RedisProfileCache(redis, ttl), lambda: MemoryProfileCache(ttl))
+
+
+# Cached profiles are dropped once a change to their user is committed. Changes are collected as they're flushed
+# and only acted on after the commit, so a request can't cache the old row again in between.
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def userchanged(mapper, connection, user):
+    object_session(user).info.setdefault('changedusers', set()).add(user.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def dropchangedprofiles(session):
+    changed = session.info.pop('changedusers', None)
+
+    if changed and has_app_context():
+        get_profile_cache().delete(*changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forgetchangedprofiles(session):
+    session.info.pop('changedusers', None)
@@ -0,0 +1,198 @@
+import time
+import threading
+from email.utils import parsedate_to_datetime
+
+from flask import current_app
+from mistralai.models import SDKError
+
+from backends import get_backend
+
+
+# Takes a token from a model's bucket, topping it up for the time since the last call first. Returns 0 if it got one,
+# or how many milliseconds until it could. Uses the Redis server's clock so every worker agrees on the time.
+# KEYS[2] is set with a TTL when the API answers 429, and nothing is handed out until it expires.
+TAKE_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local blocked = redis.call('PTTL', KEYS[2])
+if blocked > 0 then
+    return blocked
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local rate = tonumber(ARGV[1]) / 1000
+local capacity = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate) + 1000)
+return wait
+"""
+
+
+class RateLimited(Exception):
+
+    """Raised when a call can't get a token in the time it's allowed to wait"""
+
+    def __init__(self, model, retry_after):
+        super().__init__(f"Rate limited on {model}, retry in {retry_after:.1f}s")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class RedisRateLimiter:
+
+    """
+    Token buckets in Redis, one per model, shared by every gunicorn worker and script using the same Redis.
+
+    limits maps a model to (requests per second, burst), with 'default' for models that aren't listed.
+    Taking a token is one script call, so concurrent callers can't both take the last one.
+    """
+
+    def __init__(self, redis, limits, prefix = 'ratelimit:'):
+        self.redis = redis
+        self.limits = limits
+        self.prefix = prefix
+        self.takescript = redis.register_script(TAKE_SCRIPT)
+
+    def take(self, model):
+        rate, burst = self.limits.get(model, self.limits['default'])
+        return self.takescript(keys = [f"{self.prefix}{model}", f"{self.prefix}{model}:blocked"], args = [rate, burst]) / 1000
+
+    def block(self, model, seconds):
+        self.redis.set(f"{self.prefix}{model}:blocked", 1, px = max(1, int(seconds * 1000)))
+
+
+class MemoryRateLimiter:
+
+    """Token buckets in this process's memory, for running without Redis. Each process gets the whole limit to itself"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+        self.blocked = {}
+        self.lock = threading.Lock()
+
+    def take(self, model):
+        rate, burst = self.limits.get(model, self.limits['default'])
+
+        with self.lock:
+            now = time.monotonic()
+
+            if self.blocked.get(model, 0) > now:
+                return self.blocked[model] - now
+
+            tokens, updated = self.buckets.get(model, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+
+            self.buckets[model] = (tokens, now)
+
+            return wait
+
+    def block(self, model, seconds):
+        with self.lock:
+            self.blocked[model] = time.monotonic() + seconds
+
+
+def get_rate_limiter():
+
+    """Returns the Mistral rate limiter for the current app"""
+
+    limits = current_app.config.get('MISTRAL_RATE_LIMITS', {'default': (1, 1)})
+
+    return get_backend('ratelimiter', lambda redis: RedisRateLimiter(redis, limits), lambda: MemoryRateLimiter(limits))
+
+
+def acquire(limiter, model, deadline):
+
+    """Waits for a token for model, or raises RateLimited if there won't be one before deadline (a time.monotonic() time, None to wait as long as it takes)"""
+
+    while True:
+        wait = limiter.take(model)
+
+        if wait <= 0:
+            return
+
+        if deadline is not None and time.monotonic() + wait > deadline:
+            raise RateLimited(model, wait)
+
+        time.sleep(wait)
+
+
+def retryafter(response, default = 1):
+
+    """Seconds to wait from a 429 response's Retry-After header, which is either a number of seconds or an HTTP date"""
+
+    value = response.headers.get('retry-after') if response is not None else None
+
+    if not value:
+        return default
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimitedChat:
+
+    def __init__(self, chat, wait):
+        self.chat = chat
+        self.wait = wait
+
+    def complete(self, **kwargs):
+
+        """
+        chat.complete(), after taking a token for the model. A 429 from the API blocks the model for everyone for its
+        Retry-After, then the call is tried again if there's still time
+        """
+
+        model = kwargs['model']
+        limiter = get_rate_limiter()
+        wait = current_app.config.get('MISTRAL_RATE_LIMIT_WAIT', 10) if self.wait == 'config' else self.wait
+        deadline = None if wait is None else time.monotonic() + wait
+
+        while True:
+            acquire(limiter, model, deadline)
+
+            try:
+                return self.chat.complete(**kwargs)
+            except SDKError as e:
+                if e.status_code != 429:
+                    raise
+                limiter.block(model, retryafter(e.raw_response))
+
+
+class RateLimitedClient:
+
+    """
+    Wraps a Mistral client so chat completions go through the app's rate limiter. Anything else is passed straight through.
+
+    wait is how many seconds a call may wait for a token before raising RateLimited - 0 fails fast, None waits as long
+    as it takes (for scripts), and 'config' uses MISTRAL_RATE_LIMIT_WAIT. Calls need an app context
+    """
+
+    def __init__(self, client, wait = 'config'):
+        self.client = client
+        self.chat = RateLimitedChat(client.chat, wait)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,163 @@
+import argparse
+
+from flask import current_app
+from sqlalchemy import Float, and_, cast, delete, event, func, insert, inspect, or_, select, tuple_
+from sqlalchemy.orm import Session
+
+from models import Product, ProductTag, RelatedProduct, Tag, db
+
+
+def relatedscores(condition):
+
+    """
+    Select of (productid, relatedid, score, rank) for every pair of products that share a tag, where condition(productid) holds.
+
+    score is the Jaccard similarity of the two products' tags and rank is 1 for each product's best match
+    """
+
+    producttags = ProductTag.__table__
+    a = producttags.alias('a')
+    b = producttags.alias('b')
+
+    shared = (
+        select(a.c.productid, b.c.productid.label('relatedid'), func.count().label('shared'))
+            .select_from(a.join(b, and_(a.c.tagid == b.c.tagid, a.c.productid != b.c.productid)))
+            .where(condition(a.c.productid))
+            .group_by(a.c.productid, b.c.productid)
+            .subquery('shared')
+    )
+
+    # Number of tags on each product in a pair, only counted for the products involved
+    sizes = (
+        select(producttags.c.productid, func.count().label('tags'))
+            .where(or_(producttags.c.productid.in_(select(shared.c.productid)), producttags.c.productid.in_(select(shared.c.relatedid))))
+            .group_by(producttags.c.productid)
+    )
+    productsizes = sizes.subquery('productsizes')
+    relatedsizes = sizes.subquery('relatedsizes')
+
+    score = cast(shared.c.shared, Float) / (productsizes.c.tags + relatedsizes.c.tags - shared.c.shared)
+
+    return (
+        select(shared.c.productid, shared.c.relatedid, score.label('score'),
+               func.row_number().over(partition_by = shared.c.productid, order_by = (score.desc(), shared.c.relatedid)).label('rank'))
+            .join(productsizes, productsizes.c.productid == shared.c.productid)
+            .join(relatedsizes, relatedsizes.c.productid == shared.c.relatedid)
+            .subquery('scores')
+    )
+
+
+def topscores(scores, kept):
+    return select(scores.c.productid, scores.c.relatedid, scores.c.score).where(scores.c.rank <= kept)
+
+
+def refresh_related(connection, productids, kept):
+
+    """
+    Recomputes related products for products whose tags changed, inside the caller's transaction.
+
+    Their own lists are rebuilt, and they're added to (or dropped from) the lists of the products they share tags with,
+    which are then trimmed back to the best kept. A product that drops out of another's list isn't replaced by its next
+    best match until that product's own tags change or rebuild_related() runs.
+    """
+
+    productids = list(productids)
+    related = RelatedProduct.__table__
+
+    connection.execute(delete(related).where(or_(related.c.productid.in_(productids), related.c.relatedid.in_(productids))))
+
+    columns = [related.c.productid, related.c.relatedid, related.c.score]
+    scores = relatedscores(lambda productid: productid.in_(productids))
+    connection.execute(insert(related).from_select(columns, topscores(scores, kept)))
+
+    # Same scores the other way round, into the lists of the products that share tags with them
+    reverse = select(scores.c.relatedid, scores.c.productid, scores.c.score).where(scores.c.relatedid.not_in(productids))
+    connection.execute(insert(related).from_select(columns, reverse))
+
+    ranked = (
+        select(related.c.productid, related.c.relatedid,
+               func.row_number().over(partition_by = related.c.productid, order_by = (related.c.score.desc(), related.c.relatedid)).label('rank'))
+            .where(related.c.productid.in_(select(related.c.productid).where(related.c.relatedid.in_(productids))))
+            .subquery('ranked')
+    )
+    overflow = select(ranked.c.productid, ranked.c.relatedid).where(ranked.c.rank > kept)
+    connection.execute(delete(related).where(tuple_(related.c.productid, related.c.relatedid).in_(overflow)))
+
+
+def rebuild_related(batch_size = 500):
+
+    """
+    Rebuilds the whole related products table, for backfills or after bulk tag changes.
+
+    Products are done in keyset batches by productid. Each batch's old rows are replaced in the same transaction as its
+    new ones are written, so transactions stay short and readers never see a product without its related products.
+    Returns the number of related product rows written
+    """
+
+    kept = current_app.config.get('RELATED_PRODUCTS_KEPT', 20)
+    related = RelatedProduct.__table__
+    columns = [related.c.productid, related.c.relatedid, related.c.score]
+
+    after = 0
+    written = 0
+
+    while True:
+        batch = db.session.execute(
+            select(Product.productid).where(Product.productid > after).order_by(Product.productid).limit(batch_size)
+        ).scalars().all()
+
+        if not batch:
+            break
+
+        first, last = batch[0], batch[-1]
+        db.session.execute(delete(related).where(related.c.productid > after, related.c.productid <= last))
+
+        scores = relatedscores(lambda productid: productid.between(first, last))
+        written += db.session.execute(insert(related).from_select(columns, topscores(scores, kept))).rowcount
+        db.session.commit()
+
+        after = last
+        print(f"Rebuilt related products up to productid {after}, {written} rows so far")
+
+    return written
+
+
+# Products whose tags changed in a flush have their related products refreshed at the end of that flush,
+# in the same transaction. Tags can change from either side: product.tags or tag.products.
+
+@event.listens_for(Session, 'after_flush')
+def collecttagchanges(session, context):
+
+    changed = set()
+
+    for instance in session.dirty | session.new:
+        if isinstance(instance, Product) and inspect(instance).attrs.tags.history.has_changes():
+            changed.add(instance.productid)
+
+        elif isinstance(instance, Tag):
+            added, unchanged, deleted = inspect(instance).attrs.products.history
+            changed.update(product.productid for product in (added or []) + (deleted or []))
+
+    if changed:
+        session.info.setdefault('tagchanges', set()).update(changed)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def refreshtagchanges(session, context):
+
+    changed = session.info.pop('tagchanges', None)
+
+    if changed:
+        refresh_related(session.connection(), changed, current_app.config.get('RELATED_PRODUCTS_KEPT', 20))
+
+
+if __name__ == '__main__':
+
+    from app import app
+
+    parser = argparse.ArgumentParser(description = "Rebuild the related products table from product tags")
+    parser.add_argument('--batch-size', type = int, default = 500, help = "Products to rebuild per transaction")
+    args = parser.parse_args()
+
+    with app.app_context():
+        rebuild_related(batch_size = args.batch_size)
@@ -0,0 +1,185 @@
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, request, make_response
+
+from backends import get_backend
+
+
+class RedisCacheBackend:
+
+    """
+    Response cache in Redis.
+
+    Namespaces have a version counter and every entry key includes the versions of its namespaces, so invalidating
+    a namespace is a single INCR - old entries stop being looked up and age out with their TTL.
+    Lookups and misses are counted in a hash so every worker's numbers add up in one place. A miss stores the
+    response it was filled with in the same round trip.
+    """
+
+    def __init__(self, redis, prefix = 'cache:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def versions(self, namespaces):
+        values = self.redis.mget([f"{self.prefix}version:{namespace}" for namespace in namespaces])
+        return [int(value or 0) for value in values]
+
+    def lookup(self, key, statname):
+        pipe = self.redis.pipeline(transaction = False)
+        pipe.get(self.prefix + key)
+        pipe.hincrby(f"{self.prefix}stats", f"{statname}:lookups", 1)
+        value, _ = pipe.execute()
+
+        return value
+
+    def miss(self, statname, key = None, value = None, ttl = None):
+        pipe = self.redis.pipeline(transaction = False)
+        if value is not None:
+            pipe.set(self.prefix + key, value, ex = ttl)
+        pipe.hincrby(f"{self.prefix}stats", f"{statname}:misses", 1)
+        pipe.execute()
+
+    def bump(self, namespaces):
+        pipe = self.redis.pipeline(transaction = False)
+        for namespace in namespaces:
+            pipe.incr(f"{self.prefix}version:{namespace}")
+        pipe.execute()
+
+    def counters(self):
+        return {key.decode() if isinstance(key, bytes) else key: int(value)
+                for key, value in self.redis.hgetall(f"{self.prefix}stats").items()}
+
+
+class MemoryCacheBackend:
+
+    """Response cache in this process's memory, for running without Redis. Each worker caches on its own, up to maxentries entries"""
+
+    def __init__(self, maxentries = 1000):
+        self.maxentries = maxentries
+        self.entries = OrderedDict()
+        self.versioncounters = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def versions(self, namespaces):
+        return [self.versioncounters.get(namespace, 0) for namespace in namespaces]
+
+    def lookup(self, key, statname):
+        with self.lock:
+            self.stats[f"{statname}:lookups"] = self.stats.get(f"{statname}:lookups", 0) + 1
+            entry = self.entries.get(key)
+
+            if entry is None or entry[1] < time.monotonic():
+                return None
+
+            return entry[0]
+
+    def miss(self, statname, key = None, value = None, ttl = None):
+        with self.lock:
+            self.stats[f"{statname}:misses"] = self.stats.get(f"{statname}:misses", 0) + 1
+            if value is None:
+                return
+
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last = False)
+
+    def bump(self, namespaces):
+        with self.lock:
+            for namespace in namespaces:
+                self.versioncounters[namespace] = self.versioncounters.get(namespace, 0) + 1
+
+    def counters(self):
+        return dict(self.stats)
+
+
+def get_cache():
+
+    """Returns the response cache backend for the current app"""
+
+    return get_backend('responsecache', RedisCacheBackend, MemoryCacheBackend)
+
+
+def cachekey(versions):
+
+    """Cache key for the current request - its path, normalized (sorted) query args and the versions of its namespaces"""
+
+    args = urlencode(sorted(request.args.items(multi = True)))
+    version = '.'.join(str(number) for number in versions)
+
+    return f"{request.path}?{args}:v{version}"
+
+
+def cachedresponse(*namespaces, ttl = None):
+
+    """
+    Decorator that caches a view's 200 responses.
+
+    Namespaces can use the view's URL arguments, e.g. 'product:{productid}'. Calling invalidate() with any of
+    a response's namespaces drops it. Entries expire after ttl seconds, RESPONSE_CACHE_TTL by default.
+    Streamed responses are never cached.
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get('RESPONSE_CACHE_ENABLED', True):
+                return view(*args, **kwargs)
+
+            cache = get_cache()
+            names = [namespace.format(**kwargs) for namespace in namespaces]
+            key = cachekey(cache.versions(names))
+
+            cached = cache.lookup(key, request.endpoint)
+            if cached is not None:
+                mimetype, body = cached.split(b'\n', 1)
+                resp = current_app.response_class(body, mimetype = mimetype.decode())
+                resp.headers['X-Cache'] = 'HIT'
+                return resp
+
+            resp = make_response(view(*args, **kwargs))
+
+            if resp.status_code == 200 and not resp.is_streamed:
+                cache.miss(request.endpoint, key, resp.mimetype.encode() + b'\n' + resp.get_data(), ttl or current_app.config.get('RESPONSE_CACHE_TTL', 300))
+            else:
+                cache.miss(request.endpoint)            # Counted, but errors and streams aren't cached
+
+            resp.headers['X-Cache'] = 'MISS'
+
+            return resp
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*namespaces):
+
+    """Drops every cached response in the given namespaces. Call after writes that change what they'd return"""
+
+    get_cache().bump(namespaces)
+
+
+def cachestats():
+
+    """Hit and miss counts per cached endpoint, gathered from every worker when the cache is in Redis"""
+
+    counters = get_cache().counters()
+    stats = {}
+
+    for name, value in counters.items():
+        endpoint, counter = name.rsplit(':', 1)
+        stats.setdefault(endpoint, {'lookups': 0, 'misses': 0})[counter] = value
+
+    for endpoint in stats.values():
+        endpoint['hits'] = endpoint['lookups'] - endpoint['misses']
+        endpoint['hit_rate'] = round(endpoint['hits'] / endpoint['lookups'], 4) if endpoint['lookups'] else 0.0
+
+    return stats
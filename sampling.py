@@ -0,0 +1,127 @@
+import random
+
+from sqlalchemy import func
+
+
+def newseed():
+    return random.getrandbits(31)
+
+
+ROUNDS = 4
+
+
+def mix(value, key):
+
+    """Scrambles a 32 bit value with a key, for the rounds of the shuffle"""
+
+    value = ((value ^ key) * 0x45d9f3b) & 0xffffffff
+    value = ((value ^ (value >> 16)) * 0x45d9f3b) & 0xffffffff
+
+    return value ^ (value >> 16)
+
+
+def permutation(seed, span):
+
+    """
+    Seeded shuffle of the keys 1..span. Returns key(position) for positions 0..span - 1.
+
+    Positions are shuffled with a small Feistel network keyed by the seed, which is a permutation of every number of
+    its bit width, and numbers that land past span are shuffled again until they're in range. So each key comes up at
+    exactly one position, and any position's key can be worked out on its own without touching the rest of the order
+    """
+
+    if span <= 1:
+        return lambda position: position + 1
+
+    halfbits = ((span - 1).bit_length() + 1) // 2
+    mask = (1 << halfbits) - 1
+    rng = random.Random(seed)
+    roundkeys = [rng.getrandbits(32) for x in range(ROUNDS)]
+
+    def key(position):
+        value = position
+
+        while True:                                     # At most 4 times as many numbers as keys, so this goes round a few times at most
+            left, right = value >> halfbits, value & mask
+            for roundkey in roundkeys:
+                left, right = right, left ^ (mix(right, roundkey) & mask)
+            value = (left << halfbits) | right
+
+            if value < span:
+                return value + 1
+
+    return key
+
+
+def shuffledpage(query, keycolumn, seed, span, size, after = None, before = None, probes = 1000):
+
+    """
+    Fetches one page of query in a seeded random order that stays the same from page to page.
+
+    keycolumn is an integer primary key and span the largest key when the shuffle started, carried from page to page with
+    the seed so rows added since don't reshuffle it. Like keysetpage, paging is by position: after=<position> for the
+    next page and before=<position> for the previous one. Keys are worked out for the positions needed and fetched with
+    an IN on the key, so a page costs about the same no matter how big the table is, with more lookups only where many
+    keys have been deleted. At most probes positions are looked at, and a page that runs out of them comes back short,
+    with the next page carrying on from where it stopped.
+
+    Returns the page's items with their positions, and the before and after positions for the previous and next pages
+    (None if there isn't one)
+    """
+
+    key = permutation(seed, span)
+
+    if before is not None:
+        positions = range(min(before, span) - 1, -1, -1)
+    else:
+        positions = range(0 if after is None else max(0, after + 1), span)
+
+    found = []
+    chunk = size + 1
+    start = 0
+    end = min(len(positions), probes)
+
+    while len(found) <= size and start < end:                      # One extra row tells us if there's another page
+        batch = positions[start:min(start + chunk, end)]
+        keys = {key(position): position for position in batch}
+        items = query.filter(keycolumn.in_(keys)).all()
+
+        found.extend(sorted(((keys[getattr(item, keycolumn.key)], item) for item in items), reverse = before is not None))
+
+        start += len(batch)
+        chunk *= 2                                                  # Sparse key ranges take a few lookups, not one per gap
+
+    if len(found) > size:
+        found = found[:size]
+        edge = found[-1][0]
+    elif start < len(positions):                                    # Ran out of probes, carry on after the last one looked at
+        edge = positions[start - 1]
+    else:
+        edge = None
+
+    if before is not None:
+        found = found[::-1]
+        return found, edge, found[-1][0] if found else before - 1
+
+    if after is None:
+        return found, None, edge
+
+    return found, found[0][0] if found else after + 1, edge
+
+
+def randomrows(query, keycolumn, count):
+
+    """
+    Picks count rows of query at random, by probing random keys between the smallest and largest.
+
+    Each probe is one index lookup (the first key at or after a random number) instead of ORDER BY random(), which sorts
+    the whole table. Rows right after a gap in the keys are a little more likely to be picked. Returns fewer rows if
+    the query has none
+    """
+
+    lowest, highest = query.with_entities(func.min(keycolumn), func.max(keycolumn)).one()
+
+    if lowest is None:
+        return []
+
+    return [query.filter(keycolumn >= random.randint(lowest, highest)).order_by(keycolumn).first() for x in range(count)]
@@ -0,0 +1,166 @@
+import re
+
+from flask import current_app
+from sqlalchemy import DDL, column, event, func, literal_column, select, table
+
+from models import Product, ProductTag, Tag, db
+
+
+class SearchError(ValueError):
+    """Raised for a bad search query parameter"""
+
+
+# Postgres: a generated tsvector with a GIN index. It has the stemmed words of the name and description, plus the name's words
+# unstemmed so prefixes of them match too (what a trigram index would be for, without a second index the planner has to OR in).
+# Every statement is idempotent so this can run on existing databases.
+POSTGRES_SEARCH_DDL = [
+    """ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+           setweight(to_tsvector('english', coalesce(productname, '')), 'A') ||
+           setweight(to_tsvector('english', coalesce(productdescription, '')), 'B') ||
+           setweight(to_tsvector('simple', coalesce(productname, '')), 'C')
+       ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_products_search_vector ON products USING gin (search_vector)",
+]
+
+# SQLite: an external content FTS5 table over products, kept in sync by triggers, so search runs locally and in tests
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+           productname, productdescription, content = 'products', content_rowid = 'productid'
+       )""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+           INSERT INTO products_fts (rowid, productname, productdescription) VALUES (new.productid, new.productname, new.productdescription);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+           INSERT INTO products_fts (products_fts, rowid, productname, productdescription) VALUES ('delete', old.productid, old.productname, old.productdescription);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF productname, productdescription ON products BEGIN
+           INSERT INTO products_fts (products_fts, rowid, productname, productdescription) VALUES ('delete', old.productid, old.productname, old.productdescription);
+           INSERT INTO products_fts (rowid, productname, productdescription) VALUES (new.productid, new.productname, new.productdescription);
+       END""",
+    "INSERT INTO products_fts (products_fts) VALUES ('rebuild')",          # Index rows that were there before the table
+]
+
+searchvector = literal_column('products.search_vector')
+productsfts = table('products_fts', column('rowid'), column('products_fts'))
+
+
+@event.listens_for(Product.__table__, 'after_create')
+def create_search_index(target, connection, **kw):
+
+    """Adds the full text search index for the connection's database. Runs when the products table is created"""
+
+    statements = {'postgresql': POSTGRES_SEARCH_DDL, 'sqlite': SQLITE_SEARCH_DDL}.get(connection.dialect.name, [])
+
+    for statement in statements:
+        connection.execute(DDL(statement))
+
+
+@event.listens_for(Product.__table__, 'before_drop')
+def drop_search_index(target, connection, **kw):
+
+    if connection.dialect.name == 'sqlite':             # Postgres drops the generated column and its indexes with the table
+        connection.execute(DDL("DROP TABLE IF EXISTS products_fts"))
+
+
+def notsearchobject(object, name, type_, reflected, compare_to):
+
+    """Alembic include_object hook, so autogenerated migrations leave the search index alone rather than dropping it"""
+
+    return not (name or '').startswith(('search_vector', 'ix_products_search_vector', 'products_fts'))
+
+
+def textfilter(text):
+
+    """Clause matching products whose name or description contain the words in text"""
+
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+
+    if db.session.get_bind().dialect.name == 'sqlite':
+        ftsquery = ' '.join('"' + word + '"*' for word in words)           # Every word, each as a prefix
+        return Product.productid.in_(select(productsfts.c.rowid).where(productsfts.c.products_fts.op('MATCH')(ftsquery)))
+
+    # Stemmed words (so shoe finds shoes), or every word as a prefix of a word in the name (so runn finds running)
+    prefixes = ' & '.join(word + ':*' for word in words)
+    tsquery = func.websearch_to_tsquery('english', text).op('||')(func.to_tsquery('simple', prefixes))
+
+    return searchvector.op('@@')(tsquery)
+
+
+def tagfilter(tagnames, matchall):
+
+    """Clause matching products with all (or any) of the named tags"""
+
+    tagged = select(ProductTag.productid).join(Tag, Tag.tagid == ProductTag.tagid).where(Tag.tagname.in_(tagnames))
+
+    if matchall:
+        tagged = tagged.group_by(ProductTag.productid).having(func.count(func.distinct(Tag.tagname)) == len(set(tagnames)))
+
+    return Product.productid.in_(tagged)
+
+
+def searchquery(text, tagnames, matchall = True):
+
+    """Product query for a free text search filtered by tags. Either can be empty"""
+
+    query = Product.query
+
+    if text:
+        clause = textfilter(text)
+        if clause is not None:
+            query = query.filter(clause)
+
+    if tagnames:
+        query = query.filter(tagfilter(tagnames, matchall))
+
+    return query
+
+
+def tagfacets(query):
+
+    """
+    Number of matching products with each tag, most common first.
+
+    Counted over the first SEARCH_FACET_SAMPLE matches so broad searches on a big catalog stay fast.
+    Returns a list of {'tag', 'count'}, at most SEARCH_FACETS long
+    """
+
+    sample = current_app.config.get('SEARCH_FACET_SAMPLE', 10000)
+    matches = query.with_entities(Product.productid).order_by(Product.productid).limit(sample).subquery()
+    count = func.count().label('count')
+
+    facets = db.session.execute(
+        select(Tag.tagname, count)
+            .join(ProductTag, ProductTag.tagid == Tag.tagid)
+            .where(ProductTag.productid.in_(select(matches.c.productid)))
+            .group_by(Tag.tagname)
+            .order_by(count.desc(), Tag.tagname)
+            .limit(current_app.config.get('SEARCH_FACETS', 20))
+    )
+
+    return [{'tag': tagname, 'count': count} for tagname, count in facets]
+
+
+def searchparams(args):
+
+    """Reads q, tags (comma separated) and match (all or any) from query args. Raises SearchError for a bad match"""
+
+    text = args.get('q', '').strip()
+    tagnames = [tagname.strip() for tagname in args.get('tags', '').split(',') if tagname.strip()]
+    match = args.get('match', 'all')
+
+    if match not in ('all', 'any'):
+        raise SearchError("match must be all or any")
+
+    return text, tagnames, match == 'all'
+
+
+if __name__ == '__main__':
+
+    from app import app
+
+    # Adds the search index to a database whose products table was created before it existed
+    with app.app_context():
+        with db.engine.begin() as connection:
+            create_search_index(Product.__table__, connection)
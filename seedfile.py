@@ -1,8 +1,9 @@
 from models import User, Product, db
 from app import app
+from flask_migrate import upgrade
 from random import randint
 from mistraldescription import getproductdescription, getimages
-from time import sleep
+from backfillvariants import backfill_variants
 import requests
 import base64
 
@@ -58,25 +59,27 @@ def generateproducts(n):
 
     for x in range(n):
 
-        image = getimages() # get a base64 binary image to store in to PSQL
+        image = getimages() # get a base64 image string for Mistral AI
 
-        productname = getproductdescription(image.decode('utf-8')) # need to decode it for Mistral AI
+        productname = getproductdescription(image)
         productdescription = productname + " which is in " + conditions[randint(0,len(conditions)-1)] + " condition"
         price = Product.generateprice()
                                                                                                    # offsetting user_id by two because we have two existing.
-        product = Product(productname = productname, productdescription = productdescription, price = price, image = image, user_id = x+1)
+        product = Product(productname = productname, productdescription = productdescription, price = price, user_id = x+1)
+        product.store_image(base64.b64decode(image))        # Raw image bytes go to the image store
 
-        sleep(5) # to avoid rate limits with minstral's API
         products.append(product)
 
     return products
 
 
+app.config['MISTRAL_RATE_LIMIT_WAIT'] = None            # Nobody's waiting on the seeding, so Mistral calls wait their turn rather than fail
+
 # Generating the users and products and committing to database.
 with app.app_context():
     # db.session.rollback() # in case there's a failure somewhere
     # db.drop_all()
-    db.create_all()
+    upgrade()                   # Create or update the schema from migrations/
     
     users = generateusers(5)
     db.session.add_all(users)
@@ -84,4 +87,6 @@ with app.app_context():
 
     products = generateproducts(5)
     db.session.add_all(products)
-    db.session.commit()
\ No newline at end of file
+    db.session.commit()
+
+    backfill_variants()         # Resized images for the new products
\ No newline at end of file
@@ -0,0 +1,70 @@
+from functools import lru_cache
+from operator import attrgetter
+
+from sqlalchemy import inspect
+
+
+PRODUCT_FIELDS = ('productid', 'productname', 'productdescription', 'price', 'user_id')     # What product routes send for each product
+
+
+@lru_cache(maxsize = None)
+def serializer(model, fields):
+
+    """
+    Builds the serializer for a model and a tuple of fields, once. Later calls with the same model and fields get the cached one.
+
+    Fields are column or attribute names. Dotted fields follow relationships ('user.username') and are keyed by their last part.
+    Returns a function that takes a model instance and returns a dict.
+    """
+
+    mapper = inspect(model)
+
+    for field in fields:
+        name = field.split('.')[0]
+        if name not in mapper.all_orm_descriptors and not hasattr(model, name):
+            raise ValueError(f"{model.__name__} has no attribute {name}")
+
+    keys = tuple(field.split('.')[-1] for field in fields)
+    getter = attrgetter(*fields)
+
+    if len(fields) == 1:                    # attrgetter with one name returns the value itself rather than a tuple
+        key = keys[0]
+        return lambda object: {key: getter(object)}
+
+    return lambda object: dict(zip(keys, getter(object)))
+
+
+def serialize(object, params): # Helper function for serializing different SQLA objects
+
+    """
+    Serializer helper function. All it needs is the object and its respective params to serialize.
+
+    Takes the object to be serialized as well as the params to serialize it with
+    """
+
+    return serializer(type(object), tuple(params))(object)
+
+
+def columns(model, fields):
+
+    """Column attributes for fields, to pass to Query.with_entities so rows come back as plain tuples instead of ORM objects"""
+
+    return [getattr(model, field) for field in fields]
+
+
+def serializerow(row, fields):
+
+    """Serializes a row tuple from a with_entities query whose columns are in the same order as fields"""
+
+    return dict(zip(fields, row))
+
+
+def serializeproductimages(product):
+
+    """Serializes a product along with the URLs of its images. Clients fetch image bytes from the image routes, which can be cached"""
+
+    output = serialize(product, PRODUCT_FIELDS)
+    output['image_url'] = product.variant_url('card')
+    output['image_variants'] = product.variant_urls()
+
+    return output
@@ -0,0 +1,142 @@
+import msgpack
+from flask.sessions import SecureCookieSessionInterface
+from flask_session.sessions import RedisSessionInterface, total_seconds
+from itsdangerous import BadSignature
+
+
+class CompactRedisSessionInterface(RedisSessionInterface):
+
+    """
+    Flask-Session's Redis interface, changed to write to Redis only when a session's contents actually change.
+
+    Sessions are stored as msgpack instead of pickle, with keys sorted so the same contents always give the same bytes.
+    On save the new bytes are compared with what was loaded and the SET is skipped if they match, even when a route
+    reassigned a key to the value it already had. The TTL is read along with the session and pushed back with an
+    EXPIRE only once less than SESSION_REFRESH_THRESHOLD of the session lifetime is left.
+    """
+
+    def __init__(self, redis, key_prefix, use_signer, permanent, sid_length, refresh_threshold = 0.5):
+        super().__init__(redis, key_prefix, use_signer, permanent, sid_length)
+        self.refresh_threshold = refresh_threshold
+
+    @staticmethod
+    def dumps(session):
+        return msgpack.packb(dict(sorted(session.items())), use_bin_type = True)
+
+    @staticmethod
+    def loads(value):
+        return msgpack.unpackb(value, raw = False)
+
+    def fetch_session(self, sid):
+        pipe = self.redis.pipeline(transaction = False)
+        pipe.get(self.key_prefix + sid)
+        pipe.ttl(self.key_prefix + sid)
+        value, ttl = pipe.execute()
+
+        if value is not None:
+            try:
+                session = self.session_class(self.loads(value), sid = sid)
+                session.stored, session.ttl = value, ttl                # What's in Redis now, to compare against on save
+                return session
+            except (ValueError, msgpack.UnpackException):        # Sessions pickled before the switch just start over
+                pass
+
+        return self.session_class(sid = sid, permanent = self.permanent)
+
+    def save_session(self, app, session, response):
+        stored = getattr(session, 'stored', None)
+
+        if not session:
+            if session.modified or stored is not None:
+                self.redis.delete(self.key_prefix + session.sid)
+                response.delete_cookie(app.config["SESSION_COOKIE_NAME"], domain = self.get_cookie_domain(app), path = self.get_cookie_path(app))
+            return
+
+        lifetime = total_seconds(app.permanent_session_lifetime)
+        value = self.dumps(session)
+
+        if value != stored:
+            self.redis.set(self.key_prefix + session.sid, value, ex = lifetime)
+        elif session.ttl < lifetime * self.refresh_threshold:
+            self.redis.expire(self.key_prefix + session.sid, lifetime)
+
+        # The cookie only needs setting when the session changed or its expiry should move
+        if value != stored or (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']):
+            self.set_cookie_to_response(app, session, response, self.get_expiration_time(app, session))
+
+
+class HybridSessionInterface(CompactRedisSessionInterface):
+
+    """
+    Keeps anonymous visitors' sessions in a signed cookie and only moves a session to Redis when it needs to be server side.
+
+    A session goes to Redis once it holds one of server_keys, which happens at login. Whatever the visitor had in their
+    cookie session (like lastviewedproduct) moves with it, and the cookie session is deleted. Until then browsing never touches Redis.
+    Anonymous sessions are signed with the app's SECRET_KEY, the same way Flask's default cookie sessions are.
+    """
+
+    server_keys = ('userid',)
+
+    def __init__(self, redis, key_prefix, use_signer, permanent, sid_length, refresh_threshold = 0.5, anonymous_cookie_name = 'anon_session'):
+        super().__init__(redis, key_prefix, use_signer, permanent, sid_length, refresh_threshold)
+        self.anonymous_cookie_name = anonymous_cookie_name
+        self.cookie_interface = SecureCookieSessionInterface()
+
+    def open_session(self, app, request):
+        stale = False
+
+        if request.cookies.get(app.config["SESSION_COOKIE_NAME"]):
+            session = super().open_session(app, request)
+            if getattr(session, 'stored', None) is not None:           # Only sessions that are actually in Redis, expired ones start over as anonymous
+                return session
+            stale = True
+
+        data = {}
+        value = request.cookies.get(self.anonymous_cookie_name)
+        if value:
+            try:
+                data = self.cookie_interface.get_signing_serializer(app).loads(value, max_age = total_seconds(app.permanent_session_lifetime))
+            except BadSignature:
+                pass
+
+        session = self.session_class(data, sid = None, permanent = self.permanent)
+        session.loaded = dict(data)
+        session.stale = stale
+
+        return session
+
+    def save_session(self, app, session, response):
+        if session.sid is not None:
+            return super().save_session(app, session, response)
+
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # Logging in moves the session and everything in it to Redis, under a new session id
+        if any(key in session for key in self.server_keys):
+            session.sid = self._generate_sid(self.sid_length)
+            response.delete_cookie(self.anonymous_cookie_name, domain = domain, path = path)
+            return super().save_session(app, session, response)
+
+        # Drop a session cookie whose Redis session is gone, so later requests don't look it up again
+        if getattr(session, 'stale', False):
+            response.delete_cookie(app.config["SESSION_COOKIE_NAME"], domain = domain, path = path)
+
+        if not session:
+            if session.loaded:
+                response.delete_cookie(self.anonymous_cookie_name, domain = domain, path = path)
+            return
+
+        if dict(session) == session.loaded and not (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']):
+            return
+
+        response.set_cookie(
+            self.anonymous_cookie_name,
+            self.cookie_interface.get_signing_serializer(app).dumps(dict(session)),
+            expires = self.get_expiration_time(app, session),
+            httponly = self.get_cookie_httponly(app),
+            domain = domain,
+            path = path,
+            secure = self.get_cookie_secure(app),
+            samesite = self.get_cookie_samesite(app)
+        )
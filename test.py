@@ -1,11 +1,52 @@
 import io
+import os
+import re
+import time
+import threading
+import json
+import msgpack
+import tempfile
+import redis
+import fakeredis
+from contextlib import contextmanager
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
 from unittest import TestCase
+from unittest.mock import Mock, patch
+from types import SimpleNamespace
 import base64
+from datetime import datetime
+from html import unescape
+from decimal import Decimal
 
 from app import create_app
-from flask import session
-
-from models import User, Product, db
+from flask import session, jsonify
+
+from PIL import Image, ImageDraw
+from sqlalchemy import event, text
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import downgrade, upgrade
+
+from models import User, Product, Tag, RelatedProduct, db
+from imagestore import get_image_store
+from migrateimages import migrate_images
+from backfillvariants import backfill_variants
+from relatedproducts import rebuild_related
+from sampling import permutation, randomrows, shuffledpage
+from search import notsearchobject, searchquery
+from checkplans import checkplans
+import imagepipeline
+import mistraldescription
+from mistralai.models import SDKError
+from ratelimiter import RateLimited, RateLimitedClient, RedisRateLimiter, get_rate_limiter
+from aicache import RedisAICache, SQLiteAICache, imagehash
+from jsonprovider import OrjsonProvider
+from cartstore import RedisCartStore, get_cart_store
+from passwordhashing import RedisHashingSlots, get_password_hasher
+from jobqueue import RedisJobQueue, get_job_queue, runjob
+from responsecache import invalidate
+from sessioninterface import CompactRedisSessionInterface, HybridSessionInterface
 
 from blueprints.apiroutes import apiroutes
 from blueprints.checkout import productcheckout
@@ -30,6 +71,12 @@ app.config['SESSION_TYPE'] = 'filesystem'
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['IMAGE_STORE_PATH'] = tempfile.mkdtemp()            # Keep test images out of the repo
+app.config['IMAGE_PIPELINE_SYNC'] = True                        # Make image variants inline so tests can check them
+app.config['BCRYPT_LOG_ROUNDS'] = 4                             # Cheapest bcrypt cost, tests don't need slow hashes
+app.config['MISTRAL_RATE_LIMITS'] = {'default': (100, 10)}      # Mistral is stubbed out, so no need to wait
+app.config['AI_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(), 'aicache.sqlite3')
+app.config['JOB_QUEUE_SYNC'] = True                             # Run queued jobs inline so tests can check their results
 
 # Initialize Flask-Session for testing
 from flask_session import Session
@@ -49,6 +96,116 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 app.config['WTF_CSRF_ENABLED'] = False
 
 
+@contextmanager
+def capturequeries():
+
+    """Collects the SQL statements run inside the block, so tests can check what routes actually fetch"""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class RecordingRedis:
+
+    """Just enough of a Redis client for the session interface, keeping every command it's sent so tests can count writes"""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append('GET')
+        return self.data[key][0] if key in self.data else None
+
+    def ttl(self, key):
+        self.commands.append('TTL')
+        return self.data[key][1] if key in self.data else -2
+
+    def set(self, key, value, ex = None):
+        self.commands.append('SET')
+        self.data[key] = (value, ex)
+
+    def expire(self, key, seconds):
+        self.commands.append('EXPIRE')
+
+    def delete(self, key):
+        self.commands.append('DEL')
+        self.data.pop(key, None)
+
+    def pipeline(self, transaction = True):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.calls = []
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+            def execute(self):
+                return [getattr(redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+        return Pipeline()
+
+    def writes(self):
+        return [command for command in self.commands if command in ('SET', 'EXPIRE', 'DEL')]
+
+
+def scratchredis():
+
+    """
+    A Redis client for testing the Redis backends. That's the server at REDIS_TEST_URL if it's set, whose database is
+    flushed first so point it at a scratch one, or fakeredis otherwise
+    """
+
+    if os.environ.get('REDIS_TEST_URL'):
+        client = redis.from_url(os.environ['REDIS_TEST_URL'])
+        client.flushdb()
+        return client
+
+    return fakeredis.FakeRedis()
+
+
+@contextmanager
+def usingredis():
+
+    """Runs the block with the app's backends in Redis (see scratchredis), and goes back to in-process ones after"""
+
+    client = scratchredis()
+    app.config['REDIS_CLIENT'] = client
+
+    try:
+        yield client
+    finally:
+        app.config.pop('REDIS_CLIENT')
+        for name in ('responsecache', 'cartstore', 'profilecache', 'passwordhasher', 'ratelimiter', 'aicache', 'jobqueue'):
+            app.extensions.pop(name, None)
+
+
+def addlistedproducts(n):
+
+    """Adds n products with images, so they show up on the listing pages"""
+
+    image = io.BytesIO()
+    Image.new('RGB', (10, 10), 'red').save(image, format = 'JPEG')
+
+    with app.app_context():
+        for x in range(n):
+            product = Product(productname = f'Listed {x}', price = 10, user_id = 1)
+            product.store_image(image.getvalue())
+            db.session.add(product)
+        db.session.commit()
+
+
 class FlaskTests(TestCase):
 
     """
@@ -67,6 +224,14 @@ class FlaskTests(TestCase):
         """
         Setting up fake users and products to test
         """
+        app.extensions.pop('responsecache', None)          # Every test starts with an empty response cache and carts (in memory, no REDIS_CLIENT)
+        app.extensions.pop('cartstore', None)
+        app.extensions.pop('profilecache', None)
+        app.extensions.pop('passwordhasher', None)
+        app.extensions.pop('ratelimiter', None)
+        app.extensions.pop('aicache', None)
+        app.extensions.pop('jobqueue', None)
+
         with app.app_context():
 
             db.drop_all()
@@ -168,7 +333,7 @@ class FlaskTests(TestCase):
     def test_addingtocart(self):
 
         """
-        Testing session state when we add to cart
+        Testing cart state when we add to cart
         """
 
         with app.test_client() as client:
@@ -176,20 +341,33 @@ class FlaskTests(TestCase):
                 change_session['userid'] = 1                    # We'll set the user id to 1 to simulate a logged in user
             client.post('/product/1/addtocart')
 
-            with client.session_transaction() as change_session:
-                self.assertEqual(change_session['cart'], [1])
+            with app.app_context():
+                self.assertEqual(get_cart_store().items(1), [(1, 1)])
 
-    def test_next_page(self):                                   # Testing to see if next page route changes session state appropriately
+    def test_next_page(self):                                   # Testing to see if next page links carry a cursor and leave the session alone
 
         """
         Testing the next page feature
         """
 
+        addlistedproducts(24)
+
         with app.test_client() as client:
-            client.get('/?page=next')
+            resp = client.get('/')
+            html = resp.get_data(as_text = True)
 
-            with client.session_transaction() as change_session:
-                self.assertEqual(change_session['page'], 1)
+            self.assertIn('/?after=20"', html)
+            self.assertNotIn('Previous Page', html)
+            self.assertNotIn('Set-Cookie', resp.headers)            # Browsing doesn't create a session
+
+            resp = client.get('/?after=20')
+            html = resp.get_data(as_text = True)
+
+            self.assertIn('Listed 23', html)
+            self.assertNotIn('Listed 18', html)
+            self.assertNotIn('Next Page', html)
+            self.assertIn('/?before=21"', html)
+            self.assertNotIn('Set-Cookie', resp.headers)
 
     def test_previous_page(self):
 
@@ -197,13 +375,85 @@ class FlaskTests(TestCase):
         Testing the previous page feature
         """
 
-        with app.test_client() as client:                       # Testing to see if previous page route changes session state appropriately
-            with client.session_transaction() as change_session:
-                change_session['page'] = 1
-            client.get('/?page=previous')
+        addlistedproducts(24)
+
+        with app.test_client() as client:                       # Testing to see if previous page goes back to the first 20 products
+            resp = client.get('/?before=21')
+            html = resp.get_data(as_text = True)
+
+            self.assertIn('Listed 18', html)
+            self.assertNotIn('Listed 19', html)
+            self.assertNotIn('Previous Page', html)
+            self.assertIn('/?after=20"', html)
 
             with client.session_transaction() as change_session:
-                self.assertEqual(change_session['page'], 0)
+                self.assertNotIn('page', change_session)
+
+    def test_shuffled_pages(self):                              # Testing that the shuffled home page keeps its order from page to page
+
+        """
+        Testing the shuffled home page
+        """
+
+        addlistedproducts(30)
+
+        with app.app_context():                                 # Gaps in the keys are skipped over
+            Product.query.filter(Product.productid.in_([5, 6, 7, 20])).delete()
+            db.session.commit()
+
+        def page(client, url):
+            html = client.get(url).get_data(as_text = True)
+            links = dict((label, unescape(href)) for href, label in re.findall(r'href\s*=\s*"([^"]*)">(Previous|Next) Page', html))
+            return [int(productid) for productid in re.findall(r"href = '/product/(\d+)'", html)], links
+
+        app.config['HOMEPAGE_SHUFFLE'] = True
+
+        try:
+            with app.test_client() as client:
+                first, links = page(client, '/')
+                self.assertNotIn('Previous', links)
+                self.assertIn('seed=', links['Next'])
+
+                second, links = page(client, links['Next'])
+                self.assertNotIn('Next', links)
+
+                # Every listed product shows up once
+                self.assertEqual(sorted(first + second), [productid for productid in range(2, 32) if productid not in (5, 6, 7, 20)])
+
+                # Going back gives the same first page, in the same order
+                self.assertEqual(page(client, links['Previous'])[0], first)
+
+                # Products listed after the shuffle started wait for the next one
+                addlistedproducts(1)
+                self.assertEqual(page(client, re.sub(r'&before=\d+', '', links['Previous']))[0], first)
+
+                # Spans from the URL are cut down to the products there are
+                products, links = page(client, '/?seed=1&span=1000000000')
+                self.assertTrue(products)
+                self.assertIn('span=32', links['Next'])
+        finally:
+            app.config['HOMEPAGE_SHUFFLE'] = False
+
+        # Every key comes up once, and not in key order
+        key = permutation(7, 1000)
+        order = [key(position) for position in range(1000)]
+        self.assertEqual(sorted(order), list(range(1, 1001)))
+        self.assertLess(sum(b == a + 1 for a, b in zip(order, order[1:])), 10)
+
+        with app.app_context():                                 # Pages that run out of probes come back short and the next one carries on
+            seen = []
+            after = None
+            for x in range(100):
+                found, previousbefore, after = shuffledpage(Product.query, Product.productid, 7, 31, 5, after = after, probes = 3)
+                seen.extend(product.productid for position, product in found)
+                if after is None:
+                    break
+            self.assertEqual(sorted(seen), [productid for productid in range(1, 32) if productid not in (5, 6, 7, 20)])
+
+        with app.app_context():                                 # Random picks for the tagging benchmark land on real products
+            picked = randomrows(Product.query, Product.productid, 10)
+            self.assertEqual(len(picked), 10)
+            self.assertTrue(all(product.productid not in (5, 6, 7, 20) for product in picked))
 
     def test_signingup(self):                                   # Testing to see if signing up a user works and we have a database entry
         
@@ -325,6 +575,429 @@ class FlaskTests(TestCase):
             self.assertIsNotNone(product)
             self.assertEqual(product.productname, 'New uploaded Product')
 
+    def test_uploadingproduct_imagestore(self):                 # Testing that uploaded images go to the image store and not the products table
+
+        """
+        Testing that an uploaded image is stored by content hash and can be read back
+        """
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['userid'] = 1
+
+            image = io.BytesIO()
+            Image.new('RGB', (300, 300), 'red').save(image, format = 'PNG')
+
+            data = {'productName': 'Stored Product', 'productDescription': 'Product for testing purposes', 'productPrice': '25'}
+            data['productImage'] = (io.BytesIO(image.getvalue()), 'test.png')
+            resp = client.post('/upload/1', data = data, content_type='multipart/form-data')
+
+            self.assertEqual(resp.status_code, 200)
+            product = Product.query.filter_by(productname = 'Stored Product').first()
+            self.assertIsNone(product.image)
+            self.assertEqual(len(product.image_hash), 64)
+            self.assertEqual(product.image_mimetype, 'image/png')
+
+            stored = get_image_store().get(product.image_hash)
+            self.assertEqual(len(stored), product.image_size)
+            self.assertEqual(product.get_image(), stored)
+
+            # Reading the original back through the image route goes through the store as well
+            resp = client.get(product.image_url)
+            self.assertEqual(resp.get_data(), stored)
+
+            # Files that aren't images are turned away with the other form errors
+            data['productImage'] = (io.BytesIO(b'not an image'), 'test.png')
+            resp = client.post('/upload/1', data = data, content_type='multipart/form-data')
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json['error']['productImage'], 'Invalid image file')
+
+    def test_uploadingproduct_variants(self):                   # Testing that uploads get resized image variants
+
+        """
+        Testing that an upload gets thumbnail, card and detail variants that fit their sizes and are exposed by the API
+        """
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['userid'] = 1
+
+            image = io.BytesIO()
+            Image.new('RGB', (1600, 1200), 'red').save(image, format = 'JPEG')
+
+            data = {'productName': 'Big Product', 'productDescription': 'Product for testing purposes', 'productPrice': '25'}
+            data['productImage'] = (io.BytesIO(image.getvalue()), 'test.jpg')
+            resp = client.post('/upload/1', data = data, content_type='multipart/form-data')
+            self.assertEqual(resp.status_code, 200)
+
+            product = Product.query.filter_by(productname = 'Big Product').first()
+            self.assertEqual(set(product.image_variants), {'thumbnail', 'card', 'detail'})
+            self.assertEqual((product.image_variants['detail']['width'], product.image_variants['detail']['height']), (1200, 900))
+            self.assertEqual(product.image_variants['thumbnail']['width'], 150)
+
+            resp = client.get(f'/v1/productsimages/{product.productid}')
+            self.assertEqual(set(resp.json['Product']['image_variants']), {'thumbnail', 'card', 'detail'})
+            self.assertEqual(resp.json['Product']['image_url'], product.variant_url('detail'))
+
+            resp = client.get(product.variant_url('thumbnail'))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'image/webp')
+            self.assertEqual(Image.open(io.BytesIO(resp.get_data())).size, (150, 113))
+
+            # Once the product is committed the upload has worked, even if the variants can't be started
+            data['productName'] = 'Listed Anyway'
+            data['productImage'] = (io.BytesIO(image.getvalue()), 'test.jpg')
+            with patch('blueprints.uploadroutes.generate_variants', side_effect = RuntimeError("pool is gone")):
+                resp = client.post('/upload/1', data = data, content_type='multipart/form-data')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(Product.query.filter_by(productname = 'Listed Anyway').count(), 1)
+
+        # A pool that broke (a child died) is swapped for a new one rather than failing every upload after it
+        class InlinePool:
+            def submit(self, function, *args):
+                future = Future()
+                future.set_result(function(*args))
+                return future
+            def shutdown(self, wait = True, cancel_futures = False):
+                pass
+
+        class BrokenPool(InlinePool):
+            def submit(self, function, *args):
+                raise BrokenProcessPool()
+
+        app.config['IMAGE_PIPELINE_SYNC'] = False
+
+        try:
+            with app.app_context(), patch.object(imagepipeline, '_pool', BrokenPool()), \
+                 patch.object(imagepipeline, 'ProcessPoolExecutor', lambda **kwargs: InlinePool()):
+                imagepipeline.generate_variants(1, image.getvalue())
+                self.assertIsInstance(imagepipeline._pool, InlinePool)
+                self.assertEqual(set(Product.query.get(1).image_variants), {'thumbnail', 'card', 'detail'})
+        finally:
+            app.config['IMAGE_PIPELINE_SYNC'] = True
+
+    def test_aiprocess(self):                                   # Testing AI titles and descriptions with Mistral's client stubbed out
+
+        """
+        Testing that /upload/aiprocess gets the title and description in one call, and falls back to two at once
+        """
+
+        def answer(content):
+            return SimpleNamespace(choices = [SimpleNamespace(message = SimpleNamespace(content = content))])
+
+        def upload(client):                                     # Jobs run inline in tests, so they're done by the time the upload returns
+            data = {'file': (io.BytesIO(b'not really a jpeg'), 'test.jpeg')}
+            resp = client.post('/upload/aiprocess', data = data, content_type = 'multipart/form-data')
+            self.assertEqual(resp.status_code, 202)
+            return client.get(resp.headers['Location'])
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['userid'] = 1
+
+            fenced = '```json\n{"title": " Red  Running Shoes ", "description": "Light mesh running shoes in red."}\n```'
+            with patch.object(mistraldescription.client.chat.chat, 'complete', return_value = answer(fenced)) as complete:
+                resp = upload(client)
+
+            self.assertEqual(resp.json['status'], 'done')
+            self.assertEqual(resp.json['result'], {'title': 'Red Running Shoes', 'description': 'Light mesh running shoes in red.'})
+            self.assertEqual(complete.call_count, 1)
+            self.assertEqual(complete.call_args.kwargs['response_format'], {'type': 'json_object'})
+
+            # A bad answer falls back to asking for each separately. The barrier only lets them through if they're made at the same time
+            together = threading.Barrier(2, timeout = 5)
+
+            def complete(model, messages, response_format = None):
+                if response_format:
+                    return answer('{"title": ""}')
+                together.wait()
+                prompt = messages[0]['content'][0]['text']
+                return answer('"Red Shoes"' if prompt == mistraldescription.TITLE_PROMPT else 'Shoes that are red.')
+
+            with patch.object(mistraldescription.client.chat.chat, 'complete', side_effect = complete):
+                resp = upload(client)
+
+            self.assertEqual(resp.json['result'], {'title': 'Red Shoes', 'description': 'Shoes that are red.'})
+
+        for bad in ['', 'no json here', '[1, 2]', '{"title": "x"}', '{"title": 5, "description": "y"}']:
+            with self.assertRaises(mistraldescription.ListingError):
+                mistraldescription.parselisting(bad)
+
+    def test_rate_limiter(self):                                # Testing that Mistral calls wait their turn, back off on a 429 and fail fast when told to
+
+        """
+        Testing the Mistral rate limiter
+        """
+
+        answer = SimpleNamespace(choices = [SimpleNamespace(message = SimpleNamespace(content = 'tags'))])
+        toomany = SDKError("Too many requests", status_code = 429, raw_response = SimpleNamespace(headers = {'retry-after': '0.3'}))
+        chat = SimpleNamespace(complete = Mock(side_effect = [toomany, answer, answer, answer]))
+        client = SimpleNamespace(chat = chat)
+
+        app.config['MISTRAL_RATE_LIMITS'] = {'default': (1, 1)}
+
+        try:
+            with app.app_context():
+                # A 429 blocks the model for its Retry-After, then the call goes through
+                start = time.monotonic()
+                self.assertIs(RateLimitedClient(client, wait = None).chat.complete(model = 'm', messages = []), answer)
+                self.assertGreaterEqual(time.monotonic() - start, 0.3)
+                self.assertEqual(chat.complete.call_count, 2)
+
+                # The bucket is empty now, so a call that can't wait is turned away without calling the API
+                with self.assertRaises(RateLimited) as limited:
+                    RateLimitedClient(client, wait = 0).chat.complete(model = 'm', messages = [])
+                self.assertGreater(limited.exception.retry_after, 0)
+                self.assertEqual(chat.complete.call_count, 2)
+
+                # Other models have their own bucket
+                RateLimitedClient(client, wait = 0).chat.complete(model = 'other', messages = [])
+
+            # AI jobs that can't get a turn fail and say when to come back
+            app.config['MISTRAL_RATE_LIMIT_WAIT'] = 0
+            with app.test_client() as client, patch.object(mistraldescription.client.chat.chat, 'complete', return_value = answer):
+                with client.session_transaction() as change_session:
+                    change_session['userid'] = 1
+
+                with app.app_context():
+                    get_rate_limiter().block(mistraldescription.model, 5)
+
+                resp = client.post('/upload/aiprocess', data = {'file': (io.BytesIO(b'jpeg'), 'test.jpeg')}, content_type = 'multipart/form-data')
+                self.assertEqual(resp.json['status'], 'failed')
+                self.assertEqual(resp.json['retry_after'], 5)
+        finally:
+            app.config['MISTRAL_RATE_LIMITS'] = {'default': (100, 10)}
+            app.config.pop('MISTRAL_RATE_LIMIT_WAIT', None)
+
+    def test_ai_cache(self):                                    # Testing that repeat and near identical images get cached AI answers
+
+        """
+        Testing the perceptual hash cache in front of Mistral
+        """
+
+        def jpeg(image, quality = 90):
+            data = io.BytesIO()
+            image.save(data, format = 'JPEG', quality = quality)
+            return base64.b64encode(data.getvalue()).decode('utf-8')
+
+        shoe = Image.new('RGB', (90, 80), 'white')
+        ImageDraw.Draw(shoe).ellipse((10, 10, 60, 70), fill = 'red')
+        ImageDraw.Draw(shoe).rectangle((50, 5, 85, 40), fill = 'blue')
+        edited = shoe.copy()
+        ImageDraw.Draw(edited).rectangle((0, 60, 12, 79), fill = 'black')
+        hat = Image.new('RGB', (90, 80), 'white')
+        ImageDraw.Draw(hat).rectangle((5, 40, 80, 75), fill = 'green')
+
+        def answer(**kwargs):
+            time.sleep(0.01)                                    # Takes a moment, like the real thing
+            return SimpleNamespace(choices = [SimpleNamespace(message = SimpleNamespace(content = 'Red shoe'))])
+
+        with app.app_context(), patch.object(mistraldescription.client.chat.chat, 'complete', side_effect = answer) as complete:
+            self.assertEqual(mistraldescription.getproductdescription(jpeg(shoe)), 'Red shoe')
+
+            # The same photo re-saved bigger and at a lower quality hashes within a bit or two, so it's a hit
+            self.assertEqual(mistraldescription.getproductdescription(jpeg(shoe.resize((180, 160)), 30)), 'Red shoe')
+            self.assertEqual(complete.call_count, 1)
+
+            # A different picture, or a different prompt, is asked about
+            mistraldescription.getproductdescription(jpeg(hat))
+            mistraldescription.getproductdescription(jpeg(shoe), 'Another prompt')
+            self.assertEqual(complete.call_count, 3)
+
+            # With the threshold at 0 only exact hash matches count
+            app.config['AI_CACHE_MAX_DISTANCE'] = 0
+            try:
+                mistraldescription.getproductdescription(jpeg(edited))
+            finally:
+                app.config.pop('AI_CACHE_MAX_DISTANCE')
+            self.assertEqual(complete.call_count, 4)
+
+        with app.test_client() as client:
+            stats = client.get('/v1/cachestats').json['AICache']
+            self.assertEqual((stats['lookups'], stats['hits'], stats['misses']), (5, 1, 4))
+            self.assertGreater(stats['saved_seconds'], 0)
+
+        # Past maxentries the least recently used answers go
+        cache = SQLiteAICache(os.path.join(tempfile.mkdtemp(), 'aicache.sqlite3'), ttl = 60, maxentries = 2)
+        for number, image in enumerate([shoe, hat, edited]):
+            cache.store(imagehash(base64.b64decode(jpeg(image))), 'prompt', str(number), 1.0)
+        self.assertIsNone(cache.lookup(imagehash(base64.b64decode(jpeg(shoe))), 'prompt', 0))
+        self.assertEqual(cache.lookup(imagehash(base64.b64decode(jpeg(hat))), 'prompt', 0), '1')
+
+    def test_job_queue(self):                                   # Testing that AI processing runs after the upload returns and can be polled
+
+        """
+        Testing the background job queue behind /upload/aiprocess
+        """
+
+        listing = '{"title": "Red Shoes", "description": "Shoes that are red."}'
+        answer = SimpleNamespace(choices = [SimpleNamespace(message = SimpleNamespace(content = listing))])
+        release = threading.Event()
+
+        def complete(**kwargs):
+            release.wait(5)                                     # Hold the job until the test lets it finish
+            return answer
+
+        def upload(client):
+            return client.post('/upload/aiprocess', data = {'file': (io.BytesIO(b'jpeg'), 'test.jpeg')}, content_type = 'multipart/form-data')
+
+        app.config['JOB_QUEUE_SYNC'] = False                    # Run jobs on the background thread like a local run
+
+        try:
+            with app.test_client() as client, patch.object(mistraldescription.client.chat.chat, 'complete', side_effect = complete):
+                self.assertEqual(upload(client).status_code, 401)
+
+                with client.session_transaction() as change_session:
+                    change_session['userid'] = 1
+
+                # The upload comes back with the job straight away, while the model is still working
+                resp = upload(client)
+                self.assertEqual(resp.status_code, 202)
+                self.assertIn(resp.json['status'], ('queued', 'running'))
+                self.assertEqual(resp.headers['Location'], resp.json['status_url'])
+                self.assertNotIn('result', client.get(resp.json['status_url']).json)
+
+                # Other users can't see it
+                with client.session_transaction() as change_session:
+                    change_session['userid'] = 2
+                self.assertEqual(client.get(resp.json['status_url']).status_code, 404)
+
+                with client.session_transaction() as change_session:
+                    change_session['userid'] = 1
+                self.assertEqual(client.get('/upload/aiprocess/nosuchjob').status_code, 404)
+
+                # Polling picks up the result once the job is done
+                release.set()
+                for x in range(100):
+                    status = client.get(resp.json['status_url']).json
+                    if status['status'] == 'done':
+                        break
+                    time.sleep(0.05)
+
+                self.assertEqual(status['status'], 'done')
+                self.assertEqual(status['result'], {'title': 'Red Shoes', 'description': 'Shoes that are red.'})
+        finally:
+            release.set()
+            app.config['JOB_QUEUE_SYNC'] = True
+
+    def test_productimage_conditional_get(self):                # Testing the binary image route's caching headers
+
+        """
+        Testing that the image route serves raw bytes with a strong ETag and answers If-None-Match with a 304
+        """
+
+        with app.test_client() as client:
+            image = io.BytesIO()
+            Image.new('RGB', (50, 50), 'blue').save(image, format = 'JPEG')
+
+            with app.app_context():
+                product = Product.query.get(1)
+                product.store_image(image.getvalue())
+                db.session.commit()
+                imagehash = product.image_hash
+
+            resp = client.get('/v1/products/1/image')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'image/jpeg')
+            self.assertEqual(resp.get_data(), image.getvalue())
+            self.assertEqual(resp.headers['ETag'], f'"{imagehash}"')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+
+            resp = client.get('/v1/products/1/image', headers = {'If-None-Match': f'"{imagehash}"'})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            # An image missing from the store is a 404, not an empty body cached for a year
+            with app.app_context():
+                get_image_store().delete(imagehash)
+            resp = client.get('/v1/products/1/image')
+            self.assertEqual(resp.status_code, 404)
+            self.assertNotIn('immutable', resp.headers.get('Cache-Control', ''))
+
+            # Products without images have nothing to serve
+            with app.app_context():
+                Product.query.get(1).image_hash = None
+                db.session.commit()
+            resp = client.get('/v1/products/1/image')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_migrating_legacy_images(self):                     # Testing moving images out of the legacy image column
+
+        """
+        Testing that legacy base64 and raw images both read back as raw bytes and get moved to the image store
+        """
+
+        jpeg = io.BytesIO()
+        Image.new('RGB', (20, 20), 'green').save(jpeg, format = 'JPEG')
+        png = io.BytesIO()
+        Image.new('RGB', (20, 20), 'white').save(png, format = 'PNG')
+
+        with app.app_context():
+            legacy_base64 = Product(productname = 'Legacy Base64', price = 10, user_id = 1, image = base64.b64encode(jpeg.getvalue()))
+            legacy_raw = Product(productname = 'Legacy Raw', price = 10, user_id = 1, image = png.getvalue())
+            db.session.add_all([legacy_base64, legacy_raw])
+            db.session.commit()
+
+            self.assertEqual(legacy_base64.get_image(), jpeg.getvalue())
+            self.assertEqual(legacy_raw.get_image(), png.getvalue())
+
+            self.assertEqual(migrate_images(batch_size = 1), 2)
+            self.assertEqual(migrate_images(batch_size = 1), 0)           # Rerunning has nothing left to do
+
+            db.session.expire_all()
+            self.assertIsNone(legacy_base64.image)
+            self.assertEqual(legacy_base64.image_mimetype, 'image/jpeg')
+            self.assertEqual(legacy_raw.image_mimetype, 'image/png')
+            self.assertEqual(legacy_base64.get_image(), jpeg.getvalue())
+            self.assertEqual(get_image_store().get(legacy_raw.image_hash), png.getvalue())
+
+            # Migrated images get their resized variants from the backfill, and a missing image is skipped
+            broken = Product(productname = 'Missing Image', price = 10, user_id = 1, image_hash = 'f' * 64)
+            db.session.add(broken)
+            db.session.commit()
+
+            self.assertEqual(backfill_variants(batch_size = 1), 2)
+            self.assertEqual(backfill_variants(), 0)
+            self.assertEqual(set(Product.query.get(legacy_raw.productid).image_variants), {'thumbnail', 'card', 'detail'})
+            self.assertIsNone(Product.query.get(broken.productid).image_variants)
+
+    def test_routes_skip_image_column(self):                   # Testing that catalog routes don't select the legacy image blob
+
+        """
+        Testing which product columns each route fetches - only the image route should load the deferred image column
+        """
+
+        routes = ['/', '/product/1', '/user/1', '/cart', '/v1/products', '/v1/products/1', '/v1/productimages',
+                  '/v1/productsimages/1', '/v1/users/1/products']
+
+        with app.app_context():
+            Product.query.get(1).image = base64.b64encode(b'legacy image')
+            db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['userid'] = 1
+
+            client.post('/product/1/addtocart')
+
+            for route in routes:
+                with capturequeries() as statements:
+                    resp = client.get(route)
+
+                self.assertEqual(resp.status_code, 200, route)
+                productqueries = [statement for statement in statements if 'FROM products' in statement]
+                self.assertTrue(productqueries, route)
+                for statement in productqueries:
+                    self.assertIn('products.productname', statement, route)
+                    self.assertNotIn('products.image AS', statement, route)
+
+            # The image route opts in to loading the image column
+            with capturequeries() as statements:
+                resp = client.get('/v1/products/1/image')
+
+            self.assertEqual(resp.get_data(), b'legacy image')
+            self.assertTrue(any('products.image AS' in statement for statement in statements))
+
     def test_APIgetallusers(self):
         
         """
@@ -350,6 +1023,681 @@ class FlaskTests(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertEqual(resp.json["Products"][0]["productname"], 'Product Name')
 
+    def test_APIpagination(self):
+        
+        """
+        Testing keyset pagination of the product and user list routes with limit and cursor
+        """
+
+        with app.app_context():
+            db.session.add_all([Product(productname = f'Paged {x}', price = 10, user_id = 1) for x in range(4)])
+            db.session.commit()
+
+        with app.test_client() as client:
+            seen = []
+            resp = client.get('/v1/products?limit=2')
+
+            while True:
+                self.assertEqual(resp.status_code, 200)
+                self.assertLessEqual(len(resp.json['Products']), 2)
+                seen += [product['productid'] for product in resp.json['Products']]
+
+                if resp.json['next_cursor'] is None:
+                    break
+                resp = client.get(f"/v1/products?limit=2&cursor={resp.json['next_cursor']}")
+
+            self.assertEqual(seen, [1, 2, 3, 4, 5])
+
+            resp = client.get('/v1/users/1/products?limit=4')
+            self.assertEqual(len(resp.json['User']['products']), 4)
+            resp = client.get(f"/v1/users/1/products?limit=4&cursor={resp.json['next_cursor']}")
+            self.assertEqual([product['productid'] for product in resp.json['User']['products']], [5])
+            self.assertIsNone(resp.json['next_cursor'])
+
+            # Page sizes are capped and bad parameters are rejected
+            resp = client.get('/v1/users?limit=100000')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(client.get('/v1/products?limit=abc').status_code, 400)
+            self.assertEqual(client.get('/v1/products?cursor=notacursor').status_code, 400)
+
+    def test_APIstreamingproducts(self):
+        
+        """
+        Testing the NDJSON and chunked JSON streaming modes of the product routes
+        """
+
+        with app.app_context():
+            db.session.add_all([Product(productname = f'Streamed {x}', price = 10, user_id = 1) for x in range(5)])
+            db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get('/v1/products?format=ndjson')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'application/x-ndjson')
+            lines = resp.get_data(as_text = True).splitlines()
+            self.assertEqual(len(lines), 6)
+            self.assertEqual(json.loads(lines[1])['productname'], 'Streamed 0')
+
+            # The chunked JSON mode returns the same products as the regular route, all in one go
+            resp = client.get('/v1/productimages?format=stream')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.get_data(as_text = True))['Products'], client.get('/v1/productimages').json['Products'])
+
+    def test_orjson_provider(self):
+
+        """
+        Testing that JSON responses go through orjson and handle the types the stdlib encoder did
+        """
+
+        with app.app_context():
+            resp = jsonify({2: 'integer key', 'price': Decimal('9.99'), 'image': b'bytes', 'listed': datetime(2024, 1, 2, 3, 4, 5)})
+            data = json.loads(resp.get_data())
+
+        self.assertIsInstance(app.json, OrjsonProvider)
+        self.assertEqual(data, {'2': 'integer key', 'price': '9.99', 'image': 'Ynl0ZXM=', 'listed': '2024-01-02T03:04:05'})
+        self.assertEqual(list(data), ['2', 'price', 'image', 'listed'])             # sort_keys = False keeps insertion order
+
+    def test_compact_redis_sessions(self):
+
+        """
+        Testing that Redis sessions are msgpack and only written when their contents change
+        """
+
+        redis = RecordingRedis()
+        filesystem = app.session_interface
+        app.session_interface = CompactRedisSessionInterface(redis, 'session:', True, False, 32)
+
+        try:
+            with app.test_client() as client:
+                client.get('/product/1')                        # Sets lastviewedproduct, so the session is created
+                self.assertEqual(redis.writes(), ['SET'])
+
+                (key, (value, ttl)), = redis.data.items()
+                self.assertEqual(msgpack.unpackb(value), {'lastviewedproduct': 1})
+
+                # Viewing the same product again reassigns the same value, which shouldn't be written
+                for x in range(5):
+                    resp = client.get('/product/1')
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertNotIn('Set-Cookie', resp.headers)
+                self.assertEqual(redis.writes(), ['SET'])
+
+                # A different product changes the session
+                addlistedproducts(1)
+                client.get('/product/2')
+                self.assertEqual(redis.writes(), ['SET', 'SET'])
+                self.assertEqual(msgpack.unpackb(redis.data[key][0]), {'lastviewedproduct': 2})
+
+                # Once most of the TTL is gone it's pushed back with EXPIRE instead of rewriting the session
+                redis.data[key] = (redis.data[key][0], 10)
+                client.get('/product/2')
+                self.assertEqual(redis.writes(), ['SET', 'SET', 'EXPIRE'])
+        finally:
+            app.session_interface = filesystem
+
+    def test_hybrid_sessions(self):
+
+        """
+        Testing that anonymous visitors' sessions stay in a cookie and move to Redis, with what they had, when they log in
+        """
+
+        redis = RecordingRedis()
+        filesystem = app.session_interface
+        app.session_interface = HybridSessionInterface(redis, 'session:', True, False, 32)
+
+        try:
+            with app.test_client() as client:
+                for route in ['/', '/product/1', '/product/1', '/user/1']:
+                    self.assertEqual(client.get(route).status_code, 200)
+
+                self.assertEqual(redis.commands, [])                        # Browsing never touched Redis
+                self.assertIsNotNone(client.get_cookie('anon_session'))
+                self.assertIsNone(client.get_cookie('session'))
+
+                resp = client.post('/login', json = {'username': 'johndoe', 'password': 'password'})
+                self.assertEqual(resp.json, 'johndoe')
+
+                self.assertEqual(redis.writes(), ['SET'])
+                (value, ttl), = redis.data.values()
+                self.assertEqual(msgpack.unpackb(value), {'_permanent': True, 'lastviewedproduct': 1, 'userid': 1})
+                self.assertIsNone(client.get_cookie('anon_session'))
+                self.assertIsNotNone(client.get_cookie('session'))
+
+                # Logged in requests read the session from Redis
+                resp = client.get('/@me')
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(redis.commands[-2:], ['GET', 'TTL'])
+
+                # Logging out deletes it from Redis
+                client.post('/logout')
+                self.assertEqual(redis.writes()[-1], 'DEL')
+                self.assertEqual(redis.data, {})
+
+                # A session that expired from Redis has its cookie cleared on the next request, so it's only looked up once
+                client.post('/login', json = {'username': 'johndoe', 'password': 'password'})
+                redis.data.clear()
+                self.assertEqual(client.get('/').status_code, 200)
+                self.assertIsNone(client.get_cookie('session'))
+
+                lookups = redis.commands.count('GET')
+                self.assertEqual(client.get('/').status_code, 200)
+                self.assertEqual(redis.commands.count('GET'), lookups)
+        finally:
+            app.session_interface = filesystem
+
+    def test_me_cached(self):
+
+        """
+        Testing that /@me is served from the profile cache with an ETag, and reloaded once the user changes
+        """
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['userid'] = 1
+
+            resp = client.get('/@me')
+            self.assertEqual(resp.json['user']['username'], 'johndoe')
+            etag = resp.headers['ETag']
+
+            # Polling again doesn't touch the database, and an unchanged profile is a 304
+            with capturequeries() as statements:
+                resp = client.get('/@me', headers = {'If-None-Match': etag})
+            self.assertEqual(statements, [])
+            self.assertEqual(resp.status_code, 304)
+
+            # Changing the user drops the cached profile
+            with app.app_context():
+                User.query.get(1).firstname = 'Jonathan'
+                db.session.commit()
+
+            resp = client.get('/@me', headers = {'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['user']['firstname'], 'Jonathan')
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_password_rehash(self):
+
+        """
+        Testing that a password hash made with an old cost is replaced at login
+        """
+
+        with app.app_context():
+            self.assertTrue(User.query.get(1).passwordhash.startswith('$2b$04$'))
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        app.extensions.pop('passwordhasher', None)
+
+        try:
+            with app.test_client() as client:
+                resp = client.post('/login', json = {'username': 'johndoe', 'password': 'password'})
+                self.assertEqual(resp.json, 'johndoe')
+
+            with app.app_context():
+                passwordhash = User.query.get(1).passwordhash
+                self.assertTrue(passwordhash.startswith('$2b$05$'))
+
+            # The new hash still checks out
+            with app.test_client() as client:
+                self.assertEqual(client.post('/login', json = {'username': 'johndoe', 'password': 'password'}).json, 'johndoe')
+                self.assertEqual(client.post('/login', json = {'username': 'johndoe', 'password': 'wrong'}).json, 'null')
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+    def test_password_hashing_busy(self):
+
+        """
+        Testing that logins get a 503 with Retry-After when every password hashing slot is taken
+        """
+
+        with app.app_context():
+            hasher = get_password_hasher()
+
+        tokens = []
+        while (token := hasher.slots.acquire()) is not None:    # Take every slot, like a burst of logins would
+            tokens.append(token)
+
+        try:
+            with app.test_client() as client:
+                resp = client.post('/login', json = {'username': 'johndoe', 'password': 'password'})
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn('Retry-After', resp.headers)
+        finally:
+            for token in tokens:
+                hasher.slots.release(token)
+
+        with app.test_client() as client:
+            self.assertEqual(client.post('/login', json = {'username': 'johndoe', 'password': 'password'}).json, 'johndoe')
+
+        # If the slots fill up between checking the password and rehashing it, the login still works and the rehash waits
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        app.extensions.pop('passwordhasher', None)
+
+        with app.app_context():
+            hasher = get_password_hasher()
+
+        check = hasher.check
+        tokens = []
+
+        def checkthenfill(passwordhash, password):
+            checked = check(passwordhash, password)
+            while (token := hasher.slots.acquire()) is not None:
+                tokens.append(token)
+            return checked
+
+        try:
+            with app.test_client() as client, patch.object(hasher, 'check', side_effect = checkthenfill):
+                resp = client.post('/login', json = {'username': 'johndoe', 'password': 'password'})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json, 'johndoe')
+                self.assertEqual(client.get('/@me').status_code, 200)
+
+            with app.app_context():
+                self.assertTrue(User.query.get(1).passwordhash.startswith('$2b$04$'))
+        finally:
+            for token in tokens:
+                hasher.slots.release(token)
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+    def test_related_products(self):
+
+        """
+        Testing that related products are kept up to date as tags change and match a full rebuild
+        """
+
+        addlistedproducts(4)
+
+        with app.app_context():
+            a, b, c = Tag(tagname = 'a'), Tag(tagname = 'b'), Tag(tagname = 'c')
+            tags = {1: [a, b], 2: [a, b], 3: [a], 4: [c], 5: [a, b, c]}
+            for productid, producttags in tags.items():
+                Product.query.get(productid).tags = producttags
+            db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.post('/product/1/related')
+            self.assertEqual([product['productid'] for product in resp.json['RelatedProducts']], [2, 5, 3])
+
+            # Product 3 gets the same tags as product 1, so it moves up product 1's list
+            with app.app_context():
+                tag = Tag.query.filter_by(tagname = 'b').one()
+                tag.products.append(Product.query.get(3))
+                db.session.commit()
+
+            resp = client.post('/product/1/related')
+            self.assertEqual([product['productid'] for product in resp.json['RelatedProducts']], [2, 3, 5])
+
+            # The lookup is one query against the related products table
+            with capturequeries() as statements:
+                client.post('/product/4/related')
+            self.assertEqual(len(statements), 1)
+            self.assertIn('related_products', statements[0])
+
+            self.assertEqual(client.post('/product/999/related').status_code, 404)
+
+        # Updating as tags change gives the same table as rebuilding it from scratch
+        with app.app_context():
+            incremental = db.session.execute(db.select(RelatedProduct.productid, RelatedProduct.relatedid, RelatedProduct.score)).all()
+
+            # Other connections see the whole table after every batch, never one that's been emptied for the rebuild
+            counts = []
+
+            def aftercommit(session):
+                with db.engine.connect() as connection:
+                    counts.append(connection.execute(db.select(db.func.count()).select_from(RelatedProduct)).scalar())
+
+            event.listen(db.session(), 'after_commit', aftercommit)
+            try:
+                rebuild_related(batch_size = 2)
+            finally:
+                event.remove(db.session(), 'after_commit', aftercommit)
+
+            rebuilt = db.session.execute(db.select(RelatedProduct.productid, RelatedProduct.relatedid, RelatedProduct.score)).all()
+
+        self.assertEqual(sorted(incremental), sorted(rebuilt))
+        self.assertEqual(counts, [len(incremental)] * len(counts))
+        self.assertGreater(len(counts), 1)
+
+    def checksearch(self, searchapp):
+
+        """Checks /v1/search against a few tagged products. Shared by the Postgres and SQLite search tests"""
+
+        with searchapp.app_context():
+            shoes, red, blue, sweater = Tag(tagname = 'shoes'), Tag(tagname = 'red'), Tag(tagname = 'blue'), Tag(tagname = 'sweater')
+            for name, tags in [('Red Running Shoes', [shoes, red]), ('Blue Running Shoes', [shoes, blue]), ('Red Wool Sweater', [sweater, red])]:
+                db.session.add(Product(productname = name, productdescription = 'Barely worn', price = 10, user_id = 1, tags = tags))
+            db.session.commit()
+
+        def search(query):
+            resp = client.get('/v1/search?' + query)
+            self.assertEqual(resp.status_code, 200, query)
+            return [product['productid'] for product in resp.json['Products']]
+
+        with searchapp.test_client() as client:
+            self.assertEqual(search('q=running'), [2, 3])
+            self.assertEqual(search('q=shoe'), [2, 3])                    # Stemmed on Postgres, a prefix on SQLite
+            self.assertEqual(search('q=runn'), [2, 3])                    # Partial words
+            self.assertEqual(search('q=worn'), [2, 3, 4])                 # Descriptions too
+            self.assertEqual(search('q=nothinglikethis'), [])
+
+            self.assertEqual(search('tags=red'), [2, 4])
+            self.assertEqual(search('tags=red,shoes'), [2])
+            self.assertEqual(search('tags=red,shoes&match=any'), [2, 3, 4])
+            self.assertEqual(search('q=sweater&tags=shoes'), [])
+
+            resp = client.get('/v1/search?q=running')
+            self.assertEqual(resp.json['facets'], [{'tag': 'shoes', 'count': 2}, {'tag': 'blue', 'count': 1}, {'tag': 'red', 'count': 1}])
+
+            # Paged with cursors, only the first page has facets
+            resp = client.get('/v1/search?q=running&limit=1')
+            self.assertEqual([product['productid'] for product in resp.json['Products']], [2])
+            resp = client.get(f"/v1/search?q=running&limit=1&cursor={resp.json['next_cursor']}")
+            self.assertEqual([product['productid'] for product in resp.json['Products']], [3])
+            self.assertNotIn('facets', resp.json)
+
+            self.assertEqual(client.get('/v1/search?tags=red&match=some').status_code, 400)
+
+    def test_search(self):
+
+        """
+        Testing product search by text and tags on Postgres, which uses a tsvector column
+        """
+
+        self.checksearch(app)
+
+    def test_search_sqlite(self):
+
+        """
+        Testing product search on SQLite, which uses an FTS5 table
+        """
+
+        sqliteapp = create_app('sqlite://')
+        sqliteapp.config['IMAGE_STORE_PATH'] = app.config['IMAGE_STORE_PATH']
+        sqliteapp.config['BCRYPT_LOG_ROUNDS'] = 4
+        sqliteapp.register_blueprint(apiroutes, url_prefix = "/v1")
+
+        with sqliteapp.app_context():
+            upgrade()                                           # The schema comes from the migrations, search index included
+            db.session.add(User.hashpassword('johndoe', 'password', 'John', 'Doe'))
+            db.session.add(Product(productname = 'Product Name', productdescription = 'A product description', price = 25, user_id = 1))
+            db.session.commit()
+
+        self.checksearch(sqliteapp)
+
+    def test_migrations(self):
+
+        """
+        Testing that the migrations build the same schema as the models, and that no route query needs a full table scan
+        """
+
+        sqliteapp = create_app('sqlite://')
+
+        with sqliteapp.app_context():
+            upgrade()
+
+            with db.engine.connect() as connection:
+                context = MigrationContext.configure(connection, opts = {'include_object': notsearchobject, 'compare_type': True})
+                self.assertEqual(compare_metadata(context, db.metadata), [])
+
+            self.assertEqual(checkplans(), {})
+
+            downgrade(revision = 'base')
+
+        with create_app('sqlite://').app_context():             # Without the indexes, the profile page and tagging read whole tables
+            upgrade(revision = '7c2e9a4d1b63')
+            flagged = checkplans()
+            self.assertIn('/user/<id> products', flagged)
+            self.assertIn('tagging', flagged)
+
+        with create_app('sqlite://').app_context():             # A database from before migrations upgrades to the models' schema
+            upgrade(revision = '4117550308eb')
+            with db.engine.begin() as connection:
+                connection.execute(text("INSERT INTO users (username, passwordhash, firstname) VALUES ('janedoe', 'x', 'Jane')"))
+                connection.execute(text("INSERT INTO products (productname, price, image, user_id) VALUES ('Red Shoes', 25, :image, 1)"),
+                                   {'image': base64.b64encode(b'legacy image')})
+
+            upgrade()
+
+            with db.engine.connect() as connection:
+                context = MigrationContext.configure(connection, opts = {'include_object': notsearchobject, 'compare_type': True})
+                self.assertEqual(compare_metadata(context, db.metadata), [])
+
+            product = Product.query.one()
+            self.assertIsNone(product.image_hash)
+            self.assertEqual(product.get_image(), b'legacy image')
+            self.assertEqual(searchquery('shoes', []).all(), [product])    # Rows from before the search index are in it
+            self.assertEqual(RelatedProduct.query.count(), 0)
+
+        with app.app_context():                                 # And on Postgres, where sequential scans are turned off for the check
+            self.assertEqual(checkplans(), {})
+
+    def test_response_cache(self):
+
+        """
+        Testing that catalog responses are cached until a product is uploaded or deleted, and that hits and misses are counted
+        """
+
+        with app.test_client() as client:
+            resp = client.get('/v1/products/1')
+            self.assertEqual(resp.headers['X-Cache'], 'MISS')
+
+            # Second request comes from the cache without touching the database
+            with capturequeries() as statements:
+                resp = client.get('/v1/products/1')
+            self.assertEqual(resp.headers['X-Cache'], 'HIT')
+            self.assertEqual(resp.json['Product']['productname'], 'Product Name')
+            self.assertEqual(statements, [])
+
+            # Query args are normalized so their order doesn't matter
+            client.get('/v1/products?limit=5&cursor=eyJhZnRlciI6MH0')
+            resp = client.get('/v1/products?cursor=eyJhZnRlciI6MH0&limit=5')
+            self.assertEqual(resp.headers['X-Cache'], 'HIT')
+
+            # Uploading drops the cached lists
+            with client.session_transaction() as change_session:
+                change_session['userid'] = 1
+
+            image = io.BytesIO()
+            Image.new('RGB', (50, 50), 'blue').save(image, format = 'PNG')
+            data = {'productName': 'Cached Product', 'productDescription': 'Product for testing purposes', 'productPrice': '25',
+                    'productImage': (io.BytesIO(image.getvalue()), 'test.png')}
+            client.post('/upload/1', data = data, content_type='multipart/form-data')
+
+            resp = client.get('/v1/products?limit=5&cursor=eyJhZnRlciI6MH0')
+            self.assertEqual(resp.headers['X-Cache'], 'MISS')
+            self.assertIn('Cached Product', [product['productname'] for product in resp.json['Products']])
+
+            # Deleting drops the product's own cached responses
+            client.delete('/product/1/delete')
+            self.assertEqual(client.get('/v1/products/1').status_code, 404)
+
+            stats = client.get('/v1/cachestats').json['CacheStats']
+            self.assertEqual(stats['apiroutes.getsingleproduct']['hits'], 1)
+            self.assertEqual(stats['apiroutes.getsingleproduct']['misses'], 2)          # The 404 is counted but not cached
+            self.assertEqual(stats['apiroutes.getproducts']['lookups'], 3)
+
+    def test_redis_response_cache(self):
+
+        """
+        Testing the response cache with Redis behind it - hits, invalidation and the counts shared through the stats hash
+        """
+
+        with usingredis() as client, app.test_client() as testclient:
+            self.assertEqual(testclient.get('/v1/products/1').headers['X-Cache'], 'MISS')
+            self.assertEqual(testclient.get('/v1/products/1').headers['X-Cache'], 'HIT')
+
+            with app.app_context():
+                invalidate('product:1')
+            self.assertEqual(testclient.get('/v1/products/1').headers['X-Cache'], 'MISS')
+
+            stats = testclient.get('/v1/cachestats').json['CacheStats']['apiroutes.getsingleproduct']
+            self.assertEqual((stats['lookups'], stats['hits'], stats['misses']), (3, 1, 2))
+            self.assertTrue(client.exists('cache:stats'))
+
+    def test_redis_rate_limiter(self):
+
+        """
+        Testing the token bucket script - the burst goes straight through, then callers wait for the refill, and a block stops everyone
+        """
+
+        limiter = RedisRateLimiter(scratchredis(), {'default': (10, 2)})
+
+        self.assertEqual(limiter.take('model'), 0)
+        self.assertEqual(limiter.take('model'), 0)
+
+        wait = limiter.take('model')                            # Bucket's empty, the next token is about 100ms away
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.1)
+
+        time.sleep(0.15)
+        self.assertEqual(limiter.take('model'), 0)
+
+        # A 429 blocks that model until it expires, other models carry on
+        limiter.block('model', 0.3)
+        self.assertGreater(limiter.take('model'), 0.2)
+        self.assertEqual(limiter.take('other'), 0)
+
+        time.sleep(0.35)
+        self.assertEqual(limiter.take('model'), 0)
+
+    def test_redis_cart_store(self):
+
+        """
+        Testing Redis carts, especially that taking away the last of a product drops it from the cart and its order
+        """
+
+        client = scratchredis()
+        carts = RedisCartStore(client, ttl = 60)
+
+        carts.add(1, 5, 2)
+        carts.add(1, 3)
+        carts.add(1, 5)
+        self.assertEqual(carts.items(1), [(5, 3), (3, 1)])         # In the order first added
+
+        self.assertEqual(carts.remove(1, 5), 2)
+        self.assertEqual(carts.remove(1, 3), 0)                    # The last one goes and takes the product with it
+        self.assertEqual(carts.items(1), [(5, 2)])
+        self.assertEqual(client.zrange('cart:1:order', 0, -1), [b'5'])
+        self.assertIsNone(carts.remove(1, 3))                      # It's not in the cart any more
+
+        self.assertEqual(carts.remove(1, 5, 10), 0)                # Taking more than there are empties the cart
+        self.assertEqual(carts.items(1), [])
+        self.assertFalse(client.exists('cart:1', 'cart:1:order'))
+
+        carts.add(1, 7)
+        self.assertGreater(client.ttl('cart:1'), 0)
+        carts.clear(1)
+        self.assertEqual(carts.items(1), [])
+
+    def test_redis_hashing_slots(self):
+
+        """
+        Testing the hashing slot script - slots run out, come back when released, and free themselves when never released
+        """
+
+        slots = RedisHashingSlots(scratchredis(), count = 2, ttl = 0.3)
+
+        first, second = slots.acquire(), slots.acquire()
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(slots.acquire())
+
+        slots.release(first)
+        third = slots.acquire()
+        self.assertIsNotNone(third)
+        self.assertIsNone(slots.acquire())
+
+        time.sleep(0.35)                                        # Nobody gave second or third back, like a worker that died mid hash
+        self.assertIsNotNone(slots.acquire())
+
+    def test_redis_job_queue(self):
+
+        """
+        Testing the Redis job queue - enqueue, next, finish and status, jobs that expire, and an upload run by a worker
+        """
+
+        client = scratchredis()
+        jobqueue = RedisJobQueue(client, ttl = 60)
+
+        jobid = jobqueue.enqueue('aiprocess', {'image_data': 'abc'}, 1)
+        self.assertEqual(jobqueue.status(jobid), {'owner': 1, 'status': 'queued'})
+
+        self.assertEqual(jobqueue.next(1), (jobid, 'aiprocess', {'image_data': 'abc'}))
+        self.assertEqual(jobqueue.status(jobid), {'owner': 1, 'status': 'running'})
+        self.assertFalse(client.hexists(jobqueue.jobkey(jobid), 'payload'))      # Dropped once it's picked up
+
+        jobqueue.finish(jobid, 'done', result = {'title': 'Red Shoes'})
+        self.assertEqual(jobqueue.status(jobid), {'owner': 1, 'status': 'done', 'result': {'title': 'Red Shoes'}})
+        self.assertGreater(client.ttl(jobqueue.jobkey(jobid)), 0)
+
+        # A job that expires while it's running isn't brought back by finishing it
+        jobid = jobqueue.enqueue('aiprocess', {}, 1)
+        jobqueue.next(1)
+        client.delete(jobqueue.jobkey(jobid))
+        jobqueue.finish(jobid, 'failed', error = "Too late")
+        self.assertFalse(client.exists(jobqueue.jobkey(jobid)))
+        self.assertIsNone(jobqueue.status(jobid))
+
+        # One that expires while it's queued is skipped
+        jobid = jobqueue.enqueue('aiprocess', {}, 1)
+        client.delete(jobqueue.jobkey(jobid))
+        self.assertIsNone(jobqueue.next(1))
+        self.assertIsNone(jobqueue.status('nosuchjob'))
+
+        # Through the routes, the upload only queues the job and the worker's run shows up when polled
+        listing = '{"title": "Red Shoes", "description": "Shoes that are red."}'
+        answer = SimpleNamespace(choices = [SimpleNamespace(message = SimpleNamespace(content = listing))])
+
+        with usingredis(), app.test_client() as testclient:
+            with testclient.session_transaction() as change_session:
+                change_session['userid'] = 1
+
+            resp = testclient.post('/upload/aiprocess', data = {'file': (io.BytesIO(b'jpeg'), 'test.jpeg')}, content_type = 'multipart/form-data')
+            self.assertEqual(resp.status_code, 202)
+            self.assertEqual(resp.json['status'], 'queued')
+
+            with app.app_context(), patch.object(mistraldescription.client.chat.chat, 'complete', return_value = answer):
+                jobqueue = get_job_queue()
+                self.assertIsInstance(jobqueue, RedisJobQueue)
+                runjob(jobqueue, *jobqueue.next(1))
+
+            status = testclient.get(resp.json['status_url']).json
+            self.assertEqual(status['status'], 'done')
+            self.assertEqual(status['result'], {'title': 'Red Shoes', 'description': 'Shoes that are red.'})
+
+    def test_redis_ai_cache(self):
+
+        """
+        Testing the Redis AI cache - exact and near matches through the band sets, stats, and eviction past maxentries
+        """
+
+        cache = RedisAICache(scratchredis(), ttl = 60, maxentries = 2)
+        value = 0x0123456789abcdef
+
+        self.assertIsNone(cache.lookup(value, 'prompt', 4))
+        cache.store(value, 'prompt', 'Red shoe', 1.5)
+
+        self.assertEqual(cache.lookup(value, 'prompt', 0), 'Red shoe')
+        self.assertEqual(cache.lookup(value ^ 0b101, 'prompt', 4), 'Red shoe')          # Two bits off still shares bands
+        self.assertIsNone(cache.lookup(value ^ 0b101, 'prompt', 1))
+        self.assertIsNone(cache.lookup(value, 'another prompt', 4))
+
+        counters = cache.counters()
+        self.assertEqual((counters['lookups'], counters['hits']), (5, 2))
+        self.assertEqual(counters['saved_seconds'], 3.0)
+
+        # Past maxentries the least recently used answers go, along with their band entries
+        time.sleep(0.01)
+        cache.store(~value & 0xffffffffffffffff, 'prompt', 'Hat', 1.0)
+        time.sleep(0.01)
+        cache.lookup(value, 'prompt', 0)                        # Keeps the shoe fresh
+        time.sleep(0.01)
+        cache.store(0x1111111111111111, 'prompt', 'Bag', 1.0)
+
+        self.assertEqual(cache.lookup(value, 'prompt', 0), 'Red shoe')
+        self.assertIsNone(cache.lookup(~value & 0xffffffffffffffff, 'prompt', 4))
+        self.assertEqual(cache.lookup(0x1111111111111111, 'prompt', 0), 'Bag')
+
     #########################################################################
     # ADDITIONAL TESTS FOR CORE FUNCTIONALITY
     #########################################################################
@@ -407,17 +1755,63 @@ class FlaskTests(TestCase):
             
             # Add product to cart
             client.post('/product/1/addtocart')
-            with client.session_transaction() as change_session:
-                self.assertEqual(change_session['cart'], [1])
+            with app.app_context():
+                self.assertEqual(get_cart_store().items(1), [(1, 1)])
             
             # Add another product
             client.post('/product/1/addtocart')
-            with client.session_transaction() as change_session:
-                self.assertEqual(change_session['cart'], [1, 1])
+            with app.app_context():
+                self.assertEqual(get_cart_store().items(1), [(1, 2)])
             
             # Test cart page loads
             resp = client.get('/cart')
             self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['1']['quantity'], 2)
+            self.assertEqual(resp.json['cart_subtotal'], 50)
+
+            # Removing takes one off the quantity, then drops the product
+            self.assertEqual(client.post('/product/1/removefromcart').status_code, 200)
+            self.assertEqual(client.post('/product/1/removefromcart').status_code, 200)
+            self.assertEqual(client.post('/product/1/removefromcart').status_code, 401)
+            with app.app_context():
+                self.assertEqual(get_cart_store().items(1), [])
+
+            # The cart isn't kept in the session
+            client.post('/product/1/addtocart')
+            with client.session_transaction() as change_session:
+                self.assertNotIn('cart', change_session)
+
+    def test_cart_single_query(self):
+
+        """
+        Testing that the cart loads all its products in one query, keeps their order and drops ids that no longer exist
+        """
+
+        addlistedproducts(30)
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['userid'] = 1
+
+            with app.app_context():
+                for productid in list(range(31, 0, -1)) + [5, 999]:
+                    get_cart_store().add(1, productid)
+
+            with capturequeries() as statements:
+                resp = client.get('/cart')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len([statement for statement in statements if 'FROM products' in statement]), 1)
+            self.assertNotIn('products.image,', statements[-1])
+
+            output = json.loads(resp.get_data())
+            self.assertEqual(list(output)[:3], ['31', '30', '29'])
+            self.assertEqual(output['cart_subtotal'], 25 + 31 * 10)              # Product 5 is in twice
+
+            self.assertEqual(output['5']['quantity'], 2)
+
+            with app.app_context():
+                self.assertEqual(get_cart_store().items(1), [(productid, 2 if productid == 5 else 1) for productid in range(31, 0, -1)])
 
     def test_pagination_edge_cases(self):
         """
@@ -425,15 +1819,20 @@ class FlaskTests(TestCase):
         """
         with app.test_client() as client:
             # Test going to previous page when already at first page
-            resp = client.get('/?page=previous')
-            with client.session_transaction() as change_session:
-                self.assertEqual(change_session['page'], 0)
+            resp = client.get('/?before=1')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('No More Products', resp.get_data(as_text = True))
             
-            # Test going to next page multiple times
-            client.get('/?page=next')
-            client.get('/?page=next')
-            with client.session_transaction() as change_session:
-                self.assertEqual(change_session['page'], 2)
+            # Test paging past the end, previous page goes back to the last page
+            resp = client.get('/?after=50')
+            html = resp.get_data(as_text = True)
+            self.assertIn('No More Products', html)
+            self.assertIn('/?before=51"', html)
+
+            # Test junk cursors fall back to the first page
+            resp = client.get('/?after=abc')
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn('Previous Page', resp.get_data(as_text = True))
 
     def test_product_search_functionality(self):
         """